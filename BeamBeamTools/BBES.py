@@ -2,6 +2,12 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from dotdict import *
+from optics import getElementIndex
+from instrumentation import timed, count, countArrays
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 #from helpers import *
 
 
@@ -13,39 +19,97 @@ def _bunch_BB_pattern(Bunch,BBMatrixLHC):
     The returned array is ordered with respect to the positive direction of B1 (clockwise in LHC).
     WARNING: the bunch number is defined wrt the negative direction of each beam.
     '''
-    BBVector=BBMatrixLHC[Bunch,:]
-    numberOfLRToConsider=len(np.where(BBMatrixLHC[Bunch,:]==10)[0])/2
-    HO_in_IP=BBVector==1
-    LR_in_IP=BBVector==10
-    aux=np.where((LR_in_IP) | (HO_in_IP))[0]
-    np.where(aux==Bunch)[0]
-    B1=np.roll(aux,  int(numberOfLRToConsider-np.where(aux==np.where(HO_in_IP)[0][0])[0]))
-    B2=B1[::-1]
-    resultsB1={'IR1':B1,
-         'IR5':B1}
-    resultsB2={'IR1':B2,
-         'IR5':B2}
-    HO_in_IP=BBVector==2
-    LR_in_IP=BBVector==20
-    aux=np.where((LR_in_IP) | (HO_in_IP))[0]
-    np.where(aux==Bunch)[0]
-    B1=np.roll(aux, int(numberOfLRToConsider-np.where(aux==np.where(HO_in_IP)[0][0])[0]))
-    B2=B1[::-1]
-    resultsB1.update({'IR2':B1})
-    resultsB2.update({'IR2':B2})
-
-    HO_in_IP=BBVector==8
-    LR_in_IP=BBVector==80
-    aux=np.where((LR_in_IP) | (HO_in_IP))[0]
-    np.where(aux==Bunch)[0]
-    B1=np.roll(aux, int(numberOfLRToConsider-np.where(aux==np.where(HO_in_IP)[0][0])[0]))
-    B2=B1[::-1]
-    resultsB1.update({'IR8':B1})
-    resultsB2.update({'IR8':B2})
+    # The window of each experiment is given by its own HO slot and number of LR (see encounterParameters?)
+    availableBunchSlot,numberOfLR,IPslots=encounterParameters(BBMatrixLHC)
+    resultsB1={}
+    resultsB2={}
+    for exp in ['IR1','IR5','IR2','IR8']:
+        B1=(Bunch+IPslots[exp]+np.arange(-numberOfLR[exp],numberOfLR[exp]+1))%availableBunchSlot
+        B2=B1[::-1]
+        resultsB1.update({exp:B1})
+        resultsB2.update({exp:B2})
     results={'B1':resultsB1, 'B2':resultsB2}
     return results
 
 
+def encounterParameters(BBMatrixLHC):
+    """
+    It returns the number of bunch slots, the number of LR to consider in each experiment and the slot offset of the 
+    HO of each experiment of a beam-beam matrix (dense or compact, see computeBBMatrix?).
+    For a dense matrix, IR5 has the parameters of IR1 unless the 5/50 codes are used.
+    """
+    if isinstance(BBMatrixLHC,compactBBMatrix):
+        return BBMatrixLHC.availableBunchSlot,BBMatrixLHC.numberOfLR,BBMatrixLHC.IPslots
+    BBVector=np.asarray(BBMatrixLHC[0,:])
+    codes={'IR1':(1,10),'IR2':(2,20),'IR5':(5,50) if np.any(BBVector==5) else (1,10),'IR8':(8,80)}
+    numberOfLR={exp:len(np.where(BBVector==LR)[0])//2 for exp,(HO,LR) in codes.items()}
+    IPslots={exp:np.where(BBVector==HO)[0][0] for exp,(HO,LR) in codes.items()}
+    return len(BBVector),numberOfLR,IPslots
+
+
+@timed()
+def beam_BB_encounters(BBMatrixLHC,B1_fillingScheme=np.array([0,1,2,3]),B2_fillingScheme=np.array([0,1,2,3])):
+    """
+    It returns the BB encounters of all the bunches of B1 and B2 as flat arrays, computed at once for each beam and 
+    experiment (no loop on the bunches).
+    - BBMatrixLHC [adimensional integer array]: the LHC BB matrix (dense or compact, see computeBBMatrix?)
+    - B1_fillingScheme [adimensional integer array]: the B1 filling scheme.
+    - B2_fillingScheme [adimensional integer array]: the B2 filling scheme.
+    The dictionary structure has the following hierarchy:
+    - BEAM >> EXPERIMENT >> BUNCHES: the bunches of the filling scheme
+    - BEAM >> EXPERIMENT >> COUNTS: the number of encounters of each bunch
+    - BEAM >> EXPERIMENT >> PARTNER: the partner of each encounter (concatenated over the bunches)
+    - BEAM >> EXPERIMENT >> RDV_INDEX: the RDV index of each encounter (concatenated over the bunches)
+    The encounters of a bunch are ordered as the RDV_index of _beam_BB_pattern and each partner is aligned to its 
+    RDV index (in _beam_BB_pattern the partners are sorted by bunch number).
+    All the positions are referred to the positive direction of B1 (clockwise in LHC).
+    WARNING: the bunch number is defined wrt the negative direction of each beam.
+    """
+    results=dotdict({})
+    results.update({'B1':bunches_BB_encounters(BBMatrixLHC,'B1',B1_fillingScheme,B2_fillingScheme)})
+    results.update({'B2':bunches_BB_encounters(BBMatrixLHC,'B2',B2_fillingScheme,B1_fillingScheme)})
+    return results
+
+
+@timed('pattern extraction')
+def bunches_BB_encounters(BBMatrixLHC,beam,bunches,otherFillingScheme):
+    """
+    It returns the BB encounters of some bunches of a beam ('B1' or 'B2') with the filling scheme of the other beam, 
+    as flat arrays for each experiment (see beam_BB_encounters?).
+    The dictionaries are plain dicts and not dotdicts, whose reference cycles are freed by the garbage collector 
+    only: the encounters of a chunk of bunches are freed as soon as they are not used (see BBESStore.writeBBESChunked?).
+    """
+    experiments=['IR1','IR2','IR5','IR8']
+    availableBunchSlot,numberOfLR,IPslots=encounterParameters(BBMatrixLHC)
+    bunches=np.asarray(bunches)
+    otherBunches=np.asarray(otherFillingScheme)
+    otherBunches=otherBunches[(otherBunches>=0) & (otherBunches<availableBunchSlot)]
+    isFilled=np.zeros(availableBunchSlot,dtype=bool)
+    isFilled[otherBunches.astype(int)]=True
+    partnerType=np.result_type(np.intp,otherBunches.dtype)
+    results={}
+    for exp in experiments:
+        # Position j of the encounter in the (reversed) BB pattern of the bunch, visited as in _beam_BB_pattern
+        j=np.arange(2*numberOfLR[exp],-1,-1)
+        center=(len(j)-1)/2
+        slots=(bunches.astype(int)[:,None]+IPslots[exp]+numberOfLR[exp]-j[None,:])%availableBunchSlot
+        myEncounters=isFilled[slots]
+        row,column=np.nonzero(myEncounters)
+        if beam=='B1':
+            myPosition=-(j[column]-center)
+        else:
+            myPosition=(j[column]-center)
+        results.update({exp: {'bunches':bunches,
+                              'counts':myEncounters.sum(axis=1),
+                              'partner':slots[row,column].astype(partnerType),
+                              'RDV_index':myPosition}})
+        count('encounters',len(row))
+        countArrays(slots,myEncounters,row,column,myPosition)
+    count('bunches processed',len(bunches))
+    return results
+
+
+@timed()
 def _beam_BB_pattern(BBMatrixLHC,B1_fillingScheme=np.array([0,1,2,3]),B2_fillingScheme=np.array([0,1,2,3])):
     """
     It returns a dictionary structure with the BB encounters of B1 and B2 taking into account the filling schemes.
@@ -57,149 +121,744 @@ def _beam_BB_pattern(BBMatrixLHC,B1_fillingScheme=np.array([0,1,2,3]),B2_filling
     - BEAM >> BUNCH >> EXPERIMENT >> RDV_INDEX
     All the positions are referred to the positive direction of B1 (clockwise in LHC).
     WARNING: the bunch number is defined wrt the negative direction of each beam.
+    The encounters are computed for all the bunches at once (see beam_BB_encounters?).
+    """
+    encounters=beam_BB_encounters(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme)
+    return _nested_BB_pattern(encounters)
+
+
+@timed('nested structure')
+def _nested_BB_pattern(encounters,windows=None):
+    """
+    It returns the BEAM >> BUNCH >> EXPERIMENT dotdict structure of the flat encounters (see beam_BB_encounters?).
+    If the RDV windows are given (see RDV_windows?), the B1 and B2 RDV positions are added.
+    As in the original structure, the partners are sorted by bunch number and the positions by RDV index.
     """
     experiments=['IR1','IR2','IR5','IR8']
-    #B1
-    B1_BB_pattern=dotdict({})
-    for i in B1_fillingScheme:
-        bunch_aux=dotdict({})
-        results=_bunch_BB_pattern(Bunch=i,BBMatrixLHC=BBMatrixLHC)
-        for j in experiments:
-            bunch_exp=dotdict({})
-            B1=results['B2'][j]
-            aux = np.intersect1d(B1,B2_fillingScheme)
-            myPosition = -((np.where(np.in1d(B1,aux))[0])-(len(B1)-1)/2)
-            bunch_exp.update({'partners' : aux,'RDV_index':myPosition[-1::-1]})
-            bunch_aux.update({str(j): bunch_exp})
-        B1_BB_pattern.update({'b'+str(i):bunch_aux})
-    #B2
-    B2_BB_pattern=dotdict({})
-    for i in B2_fillingScheme:
-        bunch_aux=dotdict({})
-        results=_bunch_BB_pattern(Bunch=i,BBMatrixLHC=BBMatrixLHC)
-        for j in experiments:
-            bunch_exp=dotdict({})
-            B2=results['B2'][j] # Full machine --> TODO: write it in a more symmetric way...
-            aux = np.intersect1d(B2,B1_fillingScheme)
-            myPosition = ((np.where(np.in1d(B2,aux))[0])-(len(B2)-1)/2)
-            bunch_exp.update({'partners' : aux,'RDV_index':myPosition[-1::-1]})
-            bunch_aux.update({str(j): bunch_exp})
-        B2_BB_pattern.update({'b'+str(i):bunch_aux})
-
-    beam_BB_pattern={'B1':B1_BB_pattern,'B2':B2_BB_pattern}
+    beam_BB_pattern={}
+    for beam in encounters:
+        # Splitting the flat arrays bunch by bunch
+        splitted={}
+        for exp in experiments:
+            aux=encounters[beam][exp]
+            bunchIndex=np.repeat(np.arange(len(aux['counts'])),aux['counts'])
+            stops=np.cumsum(aux['counts'])
+            starts=stops-aux['counts']
+            myColumns={'partners':aux['partner'][np.lexsort((aux['partner'],bunchIndex))],
+                       'RDV_index':aux['RDV_index']}
+            if windows is not None:
+                order=np.lexsort((aux['RDV_index'],bunchIndex))
+                for key,positions in RDV_positions(aux['RDV_index'],windows[exp]).items():
+                    myColumns[key]=positions[order]
+            splitted[exp]={key: [column[i:j] for i,j in zip(starts,stops)] for key,column in myColumns.items()}
+            for key in ['B1_RDV_position','B2_RDV_position']:
+                if key in myColumns and np.isnan(myColumns[key]).any():
+                    splitted[exp][key]=[e[~np.isnan(e)] for e in splitted[exp][key]]
+        beam_pattern=dotdict({})
+        for k,i in enumerate(encounters[beam]['IR1']['bunches']):
+            bunch_aux=dotdict({})
+            for exp in experiments:
+                bunch_aux.update({exp: dotdict({key: splitted[exp][key][k] for key in splitted[exp]})})
+            beam_pattern.update({'b'+str(i):bunch_aux})
+        beam_BB_pattern.update({beam:beam_pattern})
+        count('bunches processed',len(beam_pattern))
     return dotdict(beam_BB_pattern)
 
 
-def optics_BB_pattern(BBMatrixLHC,B1_fillingScheme, B2_fillingScheme,B1Optics_BB,B2Optics_BB):
+def flat_BB_pattern(encounters,windows,experiments=['IR1','IR2','IR5','IR8']):
+    """
+    It returns, for each key of the BBES structure, the values of the flat encounters of some bunches of a beam (see
+    bunches_BB_encounters?) concatenated bunch by bunch and then experiment by experiment, together with the number
+    of values of each (bunch, experiment), e.g. to append them to a BBES store (see BBESStore.writeBBESChunked?).
+    The values of each bunch follow the conventions of the nested structure (see _nested_BB_pattern?) and the RDV
+    positions are given by the RDV windows (see RDV_windows?).
+    """
+    numberOfBunches=len(encounters[experiments[0]]['bunches'])
+    columns={}
+    for expCode,exp in enumerate(experiments):
+        aux=encounters[exp]
+        bunchIndex=np.repeat(np.arange(numberOfBunches),aux['counts'])
+        myColumns={'partners':aux['partner'][np.lexsort((aux['partner'],bunchIndex))],
+                   'RDV_index':aux['RDV_index']}
+        order=np.lexsort((aux['RDV_index'],bunchIndex))
+        for key,positions in RDV_positions(aux['RDV_index'],windows[exp]).items():
+            myColumns[key]=positions[order]
+        for key,values in myColumns.items():
+            columns.setdefault(key,[]).append((bunchIndex*len(experiments)+expCode,values))
+    results={}
+    for key,segments in columns.items():
+        mySegments=np.concatenate([e[0] for e in segments])
+        values=np.concatenate([e[1] for e in segments])
+        order=np.argsort(mySegments,kind='stable')
+        mySegments=mySegments[order]
+        values=values[order]
+        if values.dtype.kind=='f' and key!='RDV_index':
+            isNumber=~np.isnan(values)
+            mySegments=mySegments[isNumber]
+            values=values[isNumber]
+        results[key]=(values,np.bincount(mySegments,minlength=numberOfBunches*len(experiments)))
+    return results
+
+
+@timed()
+def optics_BB_pattern(BBMatrixLHC,B1_fillingScheme, B2_fillingScheme,B1Optics_BB,B2Optics_BB,output='nested'):
         """It returns the final BBES structure as a dot_dict, containing also the RDV position wrt B1 and B2 optics.
         - B1_fillingScheme [adimensional integer array]: the B1 filling scheme.
         - B2_fillingScheme [adimensional integer array]: the B2 filling scheme.
         - B1Optics_BB [pnd DF]: B1 optics.
         - B2Optics_BB [pnd DF]: B2 optics.
+        - output [string]: 'nested' (default) for the dot_dict, 'table' for the columnar table (see BB_pattern_table?),
+          'classes' for the bunch-pattern equivalence classes (see BB_pattern_classes?).
         The dictionary structure has the following hierarchy:
         - BEAM >> BUNCH >> EXPERIMENT >> PARTNERS
         - BEAM >> BUNCH >> EXPERIMENT >> RDV_INDEX
         - BEAM >> BUNCH >> EXPERIMENT >> B1_RDV_POSITION
         - BEAM >> BUNCH >> EXPERIMENT >> B2_RDV_POSITION
         """
-        length = len(B1Optics_BB[B1Optics_BB['NAME'].str.contains('BBLR_IP1_R_')])
-        opticsIndex = np.arange(-length/2,1+length/2) 
-        results=_beam_BB_pattern(BBMatrixLHC,B1_fillingScheme, B2_fillingScheme)
-
-        # ***ATLAS***
-
-        aux1=B1Optics_BB[(B1Optics_BB['S']<260) & (B1Optics_BB['S']>-260)]
-        aux1=aux1['S'].values
-
-        aux2=B2Optics_BB[(B2Optics_BB['S']<260) & (B2Optics_BB['S']>-260)]
-        aux2=aux2['S'].values
-
-        #B1
-        bunches = ['b'+str(e) for e in B1_fillingScheme]
-        for i in bunches:
-            exp = results['B1'][i]['IR1']
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-
-        #B2
-        bunches = ['b'+str(e) for e in B2_fillingScheme]
-        for i in bunches:
-            exp = results['B2'][i]['IR1']
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-
-        # ***ALICE***
-
-        aux1=B1Optics_BB[(B1Optics_BB['S']<3600) & (B1Optics_BB['S']>3070)]
-        aux1=aux1['S'].values
-
-        aux2=B2Optics_BB[(B2Optics_BB['S']<3600) & (B2Optics_BB['S']>3070)]
-        aux2=aux2['S'].values
-
-        #B1
-        bunches = ['b'+str(e) for e in B1_fillingScheme]
-        for i in bunches:
-            exp = results['B1'][i]['IR2']
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-
-        #B2
-        bunches = ['b'+str(e) for e in B2_fillingScheme]
-        for i in bunches:
-            exp = results['B2'][i]['IR2']
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-
-
-        # ***CMS***
-
-        aux1=B1Optics_BB[(B1Optics_BB['S']<13590) & (B1Optics_BB['S']>13061)]
-        aux1=aux1['S'].values
-
-        aux2=B2Optics_BB[(B2Optics_BB['S']<13590) & (B2Optics_BB['S']>13061)]
-        aux2=aux2['S'].values
-
-        #B1
-        bunches = ['b'+str(e) for e in B1_fillingScheme]
-        for i in bunches:
-            exp = results['B1'][i]['IR5']
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-
-        #B2
-        bunches = ['b'+str(e) for e in B2_fillingScheme]
-        for i in bunches:
-            exp = results['B2'][i]['IR5']
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-
-        # ***LHCB***
-
-        aux1=B1Optics_BB[(B1Optics_BB['S']<23580) & (B1Optics_BB['S']>23057.2)]
-        aux1=aux1['S'].values
-
-        aux2=B2Optics_BB[(B2Optics_BB['S']<23580) & (B2Optics_BB['S']>23057.2)]
-        aux2=aux2['S'].values
-
-        #B1
-        bunches = ['b'+str(e) for e in B1_fillingScheme]
-        for i in bunches:
-            exp = results['B1'][i]['IR8']
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-
-        #B2
-        bunches = ['b'+str(e) for e in B2_fillingScheme]
-        for i in bunches:
-            exp = results['B2'][i]['IR8']
-            exp.update({'B2_RDV_position': aux2[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
-            exp.update({'B1_RDV_position': aux1[np.where(np.in1d(opticsIndex,exp['RDV_index']))]})
+        if output not in ['nested','table','classes']:
+            raise ValueError("output must be 'nested', 'table' or 'classes'.")
+        if output=='table':
+            return BB_pattern_table(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB)
+        if output=='classes':
+            return BB_pattern_classes(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB)
+        # Single pass on all the IPs and bunches
+        encounters=beam_BB_encounters(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme)
+        return _nested_BB_pattern(encounters,RDV_windows(B1Optics_BB,B2Optics_BB))
+
+
+def affectedBunches(BBMatrixLHC,modifiedSlots):
+    """
+    It returns the bunch slots whose partners can change when the slots modifiedSlots of the other beam are filled 
+    or emptied, i.e. the slots within numberOfLRToConsider of a modified slot at each IP.
+    """
+    availableBunchSlot,numberOfLR,IPslots=encounterParameters(BBMatrixLHC)
+    modifiedSlots=np.asarray(modifiedSlots,dtype=int)
+    results=[]
+    for exp in IPslots:
+        LR=np.arange(-numberOfLR[exp],numberOfLR[exp]+1)
+        results.append((modifiedSlots[:,None]-IPslots[exp]-LR[None,:]).ravel()%availableBunchSlot)
+    return np.unique(np.concatenate(results))
+
+
+@timed()
+def update_BB_pattern(BBES,BBMatrixLHC,B1_added=None,B1_removed=None,B2_added=None,B2_removed=None,
+                      B1Optics_BB=None,B2Optics_BB=None):
+    """
+    It returns the BBES structure updated after a change of the filling schemes by a few bunches, e.g. during the 
+    injection, without recomputing the whole structure.
+    - BBES [dotdict]: the previous BBES structure (see _beam_BB_pattern? or optics_BB_pattern?).
+    - BBMatrixLHC [adimensional integer array]: the LHC BB matrix used to compute the previous structure.
+    - B1_added, B1_removed [adimensional integer array]: the bunches added to/removed from the B1 filling scheme.
+    - B2_added, B2_removed [adimensional integer array]: the bunches added to/removed from the B2 filling scheme.
+    - B1Optics_BB, B2Optics_BB [pnd DF]: the optics, to be given if the previous structure contains the RDV positions.
+    Only the added bunches and the bunches within numberOfLRToConsider slots of a modified slot of the other beam at 
+    each IP are recomputed, the other ones being taken from the previous structure.
+    The bunches of the new structure are sorted by bunch number, as with sorted filling schemes.
+
+    ===== EXAMPLE =====
+    BBES = optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB)
+    BBES = update_BB_pattern(BBES,BBMatrixLHC,B1_added=np.arange(100,148),B2_added=np.arange(100,148),
+                             B1Optics_BB=B1Optics_BB,B2Optics_BB=B2Optics_BB)
+    """
+    changes={'B1':{'added':B1_added,'removed':B1_removed},'B2':{'added':B2_added,'removed':B2_removed}}
+    fillingSchemes={}
+    for beam in ['B1','B2']:
+        for change in ['added','removed']:
+            changes[beam][change]=np.unique(np.asarray(changes[beam][change] if changes[beam][change] is not None 
+                                                       else [],dtype=int))
+        previous=np.array([int(e[1:]) for e in BBES[beam]],dtype=int)
+        fillingSchemes[beam]=np.union1d(np.setdiff1d(previous,changes[beam]['removed']),changes[beam]['added'])
+    
+    withOptics=(B1Optics_BB is not None) and (B2Optics_BB is not None)
+    encounters=dotdict({})
+    for beam,otherBeam in [('B1','B2'),('B2','B1')]:
+        modifiedSlots=np.union1d(changes[otherBeam]['added'],changes[otherBeam]['removed'])
+        toUpdate=np.intersect1d(affectedBunches(BBMatrixLHC,modifiedSlots),fillingSchemes[beam])
+        toUpdate=np.union1d(toUpdate,changes[beam]['added'])
+        encounters.update({beam:bunches_BB_encounters(BBMatrixLHC,beam,toUpdate,fillingSchemes[otherBeam])})
+    updated=_nested_BB_pattern(encounters,RDV_windows(B1Optics_BB,B2Optics_BB) if withOptics else None)
+
+    results=dotdict({})
+    for beam in ['B1','B2']:
+        beam_pattern=dotdict({})
+        for i in fillingSchemes[beam]:
+            key='b'+str(i)
+            beam_pattern.update({key:updated[beam][key] if key in updated[beam] else BBES[beam][key]})
+        results.update({beam:beam_pattern})
+    return results
+
+
+@timed('optics windowing')
+def RDV_windows(B1Optics_BB,B2Optics_BB,experiments=['IR1','IR2','IR5','IR8']):
+    """
+    It returns, for each experiment, the S positions of the B1 and B2 optics where the RDV can take place, together 
+    with the RDV index of the first position.
+    The window of an experiment is made of the 'BBLR_IPn_' elements of the optics that surround its HO element 
+    ('BBLR_IPn_HO'), the number of LR per side being given by the 'BBLR_IPn_R_' elements. 
+    When the optics has been mirrored (see optics.preparingOpticsFromMADX?), the HO with a positive S is used.
+    """
+    results=dotdict({exp: dotdict({}) for exp in experiments})
+    for beam,Optics_BB in [('B1',B1Optics_BB),('B2',B2Optics_BB)]:
+        myIndex=getElementIndex(Optics_BB)
+        S=Optics_BB['S'].values
+        count('rows scanned',len(S))
+        for exp in experiments:
+            myIP='IP'+exp[2]
+            BBLR_S=np.sort(S[myIndex.mask('^BBLR_'+myIP+'_')])
+            numberOfLR=len(np.unique(myIndex.codes[myIndex.mask('^BBLR_'+myIP+'_R_')]))
+            HO_S=S[myIndex.mask('^BBLR_'+myIP+'_HO')]
+            if len(HO_S)==0:
+                raise ValueError('No BBLR_'+myIP+'_HO element found in the '+beam+' optics.')
+            HO_S=np.min(HO_S[HO_S>=0]) if np.any(HO_S>=0) else np.max(HO_S)
+            center=np.searchsorted(BBLR_S,HO_S)
+            window=BBLR_S[max(center-numberOfLR,0):center+numberOfLR+1]
+            results[exp].update({beam:window,'firstRDV_index':float(-numberOfLR)})
+    for exp in experiments:
+        # In case the B1 and B2 windows do not match, only their common part is considered
+        length=min(len(results[exp]['B1']),len(results[exp]['B2']))
+        results[exp].update({'B1':results[exp]['B1'][:length],'B2':results[exp]['B2'][:length]})
+    return results
+
+
+def RDV_positions(RDV_index,window):
+    """
+    It returns the B1 and B2 S positions of the RDV indices by direct indexing of the RDV window 
+    (see RDV_windows?). The positions of the RDV indices outside of the window are NaN.
+    """
+    k=RDV_index-window['firstRDV_index']
+    isInWindow=(k==np.round(k)) & (k>=0) & (k<len(window['B1']))
+    k=np.where(isInWindow,k,0).astype(int)
+    results={}
+    for beam in ['B1','B2']:
+        positions=np.full(len(k),np.nan)
+        if len(window[beam]):
+            positions=np.where(isInWindow,window[beam][k],np.nan)
+        results.update({beam+'_RDV_position':positions})
+    return results
+
+
+@timed()
+def BB_pattern_table(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB=None,B2Optics_BB=None):
+    """
+    It returns the BBES structure as a flat, columnar pandas DataFrame with one row per encounter.
+    - BBMatrixLHC [adimensional integer array]: the LHC BB matrix
+    - B1_fillingScheme [adimensional integer array]: the B1 filling scheme.
+    - B2_fillingScheme [adimensional integer array]: the B2 filling scheme.
+    - B1Optics_BB [pnd DF]: B1 optics (optional).
+    - B2Optics_BB [pnd DF]: B2 optics (optional).
+    The DataFrame is indexed by (beam, bunch, IR), beam and IR being categorical, and has the columns
+    - partner: the bunch of the other beam met at the RDV
+    - RDV_index
+    - B1_RDV_position, B2_RDV_position: the S of the RDV in the B1/B2 optics (only if the optics are given).
+    The rows follow the order of the filling schemes, then of the experiments and then of the RDV_index. 
+    Contrary to the nested structure, each partner is aligned with its RDV index and positions.
+    The filling schemes are kept in the attrs of the DataFrame in order to rebuild the nested structure 
+    (see BB_pattern_from_table?).
+
+    ===== EXAMPLE =====
+    myTable = BB_pattern_table(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB)
+    myTable.groupby(level=['beam','IR'],observed=True)['partner'].count()
+    """
+    experiments=['IR1','IR2','IR5','IR8']
+    encounters=beam_BB_encounters(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme)
+    withOptics=(B1Optics_BB is not None) and (B2Optics_BB is not None)
+    if withOptics:
+        windows=RDV_windows(B1Optics_BB,B2Optics_BB)
+
+    columns={'beam':[],'bunch':[],'IR':[],'partner':[],'RDV_index':[],'B1_RDV_position':[],'B2_RDV_position':[]}
+    for beamCode,beam in enumerate(['B1','B2']):
+        aux={'bunchIndex':[],'IR':[],'bunch':[],'partner':[],'RDV_index':[],'B1_RDV_position':[],'B2_RDV_position':[]}
+        for expCode,exp in enumerate(experiments):
+            myEncounters=encounters[beam][exp]
+            bunchIndex=np.repeat(np.arange(len(myEncounters['counts'])),myEncounters['counts'])
+            aux['bunchIndex'].append(bunchIndex)
+            aux['IR'].append(np.full(len(bunchIndex),expCode,dtype=np.int8))
+            aux['bunch'].append(np.asarray(myEncounters['bunches'])[bunchIndex])
+            aux['partner'].append(myEncounters['partner'])
+            aux['RDV_index'].append(myEncounters['RDV_index'])
+            if withOptics:
+                for key,positions in RDV_positions(myEncounters['RDV_index'],windows[exp]).items():
+                    aux[key].append(positions)
+        # Sorting by bunch and experiment, keeping the RDV order
+        bunchIndex=np.concatenate(aux['bunchIndex'])
+        IR=np.concatenate(aux['IR'])
+        order=np.lexsort((IR,bunchIndex))
+        columns['beam'].append(np.full(len(order),beamCode,dtype=np.int8))
+        columns['IR'].append(IR[order])
+        for key in ['bunch','partner','RDV_index']+(['B1_RDV_position','B2_RDV_position'] if withOptics else []):
+            columns[key].append(np.concatenate(aux[key])[order])
+
+    table=pd.DataFrame({'partner':np.concatenate(columns['partner']),
+                        'RDV_index':np.concatenate(columns['RDV_index'])})
+    if withOptics:
+        table['B1_RDV_position']=np.concatenate(columns['B1_RDV_position'])
+        table['B2_RDV_position']=np.concatenate(columns['B2_RDV_position'])
+    table.index=pd.MultiIndex.from_arrays(
+        [pd.Categorical.from_codes(np.concatenate(columns['beam']),categories=['B1','B2']),
+         np.concatenate(columns['bunch']),
+         pd.Categorical.from_codes(np.concatenate(columns['IR']),categories=experiments)],
+        names=['beam','bunch','IR'])
+    # Kept as lists, as pandas compares the attrs when concatenating DataFrames
+    table.attrs['B1_fillingScheme']=np.asarray(B1_fillingScheme).tolist()
+    table.attrs['B2_fillingScheme']=np.asarray(B2_fillingScheme).tolist()
+    countArrays(*[table[e].values for e in table.columns])
+    return table
+
+
+@timed()
+def BB_pattern_classes(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB=None,B2Optics_BB=None):
+    """
+    It returns the BB pattern grouped in equivalence classes, experiment by experiment: the bunches of a beam with the 
+    same encounter signature in an experiment (the RDV indices populated) have the same BB pattern in that experiment 
+    up to a slot shift of their partners. The RDV indices and positions are therefore computed and stored only once 
+    per experiment and class.
+    - BBMatrixLHC [adimensional integer array]: the LHC BB matrix
+    - B1_fillingScheme, B2_fillingScheme [adimensional integer array]: the filling schemes.
+    - B1Optics_BB, B2Optics_BB [pnd DF]: the optics (optional), to add the RDV positions.
+    The dictionary structure has the following hierarchy:
+    - BEAM >> EXPERIMENT >> CLASS >> PARTNERS: the partners of the first bunch of the class
+    - BEAM >> EXPERIMENT >> CLASS >> PARTNER_OFFSETS: the slot offset of each partner wrt the bunch, aligned to 
+      RDV_INDEX
+    - BEAM >> EXPERIMENT >> CLASS >> RDV_INDEX (>> B1_RDV_POSITION, B2_RDV_POSITION if the optics are given)
+    - BEAM >> EXPERIMENT >> CLASS >> BUNCHES: the bunches of the class
+    - classOf >> BEAM >> EXPERIMENT: the bunch >> class mapping (pnd Series)
+    The classes of each experiment are named 'c0', 'c1', ... in the order of their first bunch in the filling scheme.
+    The optics can be filtered once per class (see optics.filterOpticsDF?). The BBES structure is recovered with 
+    BB_pattern_from_classes?.
+
+    ===== EXAMPLE =====
+    myClasses = BB_pattern_classes(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB)
+    myClasses.classOf.B1.IR5.value_counts()
+    filterOpticsDF(myClasses,'B1','IR5',myClasses.classOf.B1.IR5[400],B1Optics_BB,B2Optics_BB)
+    """
+    encounters=beam_BB_encounters(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme)
+    withOptics=(B1Optics_BB is not None) and (B2Optics_BB is not None)
+    windows=RDV_windows(B1Optics_BB,B2Optics_BB) if withOptics else None
+    availableBunchSlot,numberOfLR,IPslots=encounterParameters(BBMatrixLHC)
+    return _BB_pattern_classes(encounters,availableBunchSlot,numberOfLR,windows)
+
+
+def _BB_pattern_classes(encounters,availableBunchSlot,numberOfLR,windows=None):
+    """
+    It returns the equivalence classes of the flat encounters (see beam_BB_encounters? and BB_pattern_classes?).
+    """
+    experiments=['IR1','IR2','IR5','IR8']
+    results=dotdict({'classOf':dotdict({})})
+    for beam in encounters:
+        bunches=np.asarray(encounters[beam]['IR1']['bunches'])
+        beam_classes=dotdict({})
+        beam_classOf=dotdict({})
+        for exp in experiments:
+            aux=encounters[beam][exp]
+            bunchIndex=np.repeat(np.arange(len(bunches)),aux['counts'])
+            # Signature of each bunch: the populated RDV indices of the experiment
+            signatures=np.zeros((len(bunches),2*numberOfLR[exp]+1),dtype=bool)
+            signatures[bunchIndex,np.round(aux['RDV_index']).astype(int)+numberOfLR[exp]]=True
+            _,firstBunch,inverse=np.unique(np.packbits(signatures,axis=1),axis=0,return_index=True,
+                                           return_inverse=True)
+            # Classes numbered in the order of their first bunch
+            order=np.argsort(firstBunch)
+            rank=np.empty(len(order),dtype=int)
+            rank[order]=np.arange(len(order))
+            classOf=rank[np.ravel(inverse)]
+            count('classes',len(order))
+
+            # Flat encounters of the first bunch of each class, sorted by class
+            isFirst=np.zeros(len(bunches),dtype=bool)
+            isFirst[firstBunch]=True
+            myFilter=isFirst[bunchIndex]
+            myClasses=classOf[bunchIndex[myFilter]]
+            byClass=np.argsort(myClasses,kind='stable')
+            myClasses=myClasses[byClass]
+            partners=aux['partner'][myFilter][byClass]
+            RDV_index=aux['RDV_index'][myFilter][byClass]
+            stops=np.cumsum(aux['counts'][firstBunch[order]])
+            starts=stops-aux['counts'][firstBunch[order]]
+            myColumns={'partners':partners[np.lexsort((partners,myClasses))],
+                       'partnerOffsets':((partners-bunches[bunchIndex[myFilter][byClass]])%availableBunchSlot)
+                                        .astype(partners.dtype),
+                       'RDV_index':RDV_index}
+            if windows is not None:
+                RDV_order=np.lexsort((RDV_index,myClasses))
+                for key,positions in RDV_positions(RDV_index,windows[exp]).items():
+                    myColumns[key]=positions[RDV_order]
+            splitted={key: [column[i:j] for i,j in zip(starts,stops)] for key,column in myColumns.items()}
+            for key in ['B1_RDV_position','B2_RDV_position']:
+                if key in myColumns and np.isnan(myColumns[key]).any():
+                    splitted[key]=[e[~np.isnan(e)] for e in splitted[key]]
+
+            classBunches=np.split(bunches[np.argsort(classOf,kind='stable')],
+                                  np.cumsum(np.bincount(classOf,minlength=len(order)))[:-1])
+            exp_classes=dotdict({})
+            for myClass in range(len(order)):
+                class_aux=dotdict({key: splitted[key][myClass] for key in splitted})
+                class_aux.update({'bunches':classBunches[myClass]})
+                exp_classes.update({'c'+str(myClass):class_aux})
+            beam_classes.update({exp:exp_classes})
+            beam_classOf.update({exp:pd.Series(['c'+str(e) for e in classOf],index=bunches,name='class')})
+        results.update({beam:beam_classes})
+        results.classOf.update({beam:beam_classOf})
+    return results
 
+
+def BB_pattern_from_classes(classes,availableBunchSlot=3564):
+    """
+    It returns the BBES structure (see _beam_BB_pattern? or optics_BB_pattern?) of the equivalence classes 
+    (see BB_pattern_classes?). The partners of each bunch are obtained from the partner offsets of its class, the 
+    RDV indices and positions are shared by the bunches of a class (the same arrays).
+    """
+    results=dotdict({})
+    for beam in ['B1','B2']:
+        experiments=list(classes.classOf[beam])
+        beam_pattern=dotdict({})
+        for bunch in classes.classOf[beam][experiments[0]].index:
+            beam_pattern.update({'b'+str(bunch):dotdict({})})
+        for exp in experiments:
+            for bunch,myClass in classes.classOf[beam][exp].items():
+                exp_class=classes[beam][exp][myClass]
+                offsets=exp_class['partnerOffsets']
+                exp_aux=dotdict({'partners':np.sort(((bunch+offsets)%availableBunchSlot).astype(offsets.dtype)),
+                                 'RDV_index':exp_class['RDV_index']})
+                for key in ['B1_RDV_position','B2_RDV_position']:
+                    if key in exp_class:
+                        exp_aux.update({key:exp_class[key]})
+                beam_pattern['b'+str(bunch)].update({exp:exp_aux})
+        results.update({beam:beam_pattern})
+    return results
+
+
+class _beamView(Mapping):
+    """
+    A read-only, lazy BEAM >> BUNCH >> EXPERIMENT view on a BB pattern table (see BB_pattern_from_table?).
+    The dotdict of a bunch is built (and cached) only when the bunch is accessed.
+    """
+    def __init__(self,table,beam,fillingScheme):
+        IR=table.index.get_level_values('IR')
+        beamRows=np.flatnonzero(np.asarray(table.index.get_level_values('beam')==beam))
+        rows=slice(beamRows[0],beamRows[-1]+1) if len(beamRows) else slice(0,0)
+        self._experiments=list(IR.categories)
+        self._columns={key: table[key].values[rows] for key in table.columns}
+        self._bunch=np.asarray(table.index.get_level_values('bunch'))[rows]
+        self._IR=np.asarray(IR.codes)[rows]
+        # First and last row of each bunch, the rows of a bunch being contiguous
+        edges=np.flatnonzero(np.diff(self._bunch))+1
+        starts=np.concatenate([[0],edges]) if len(self._bunch) else np.array([],dtype=int)
+        stops=np.concatenate([edges,[len(self._bunch)]]) if len(self._bunch) else np.array([],dtype=int)
+        self._rows={'b'+str(self._bunch[i]):(i,j) for i,j in zip(starts,stops)}
+        self._keys=['b'+str(i) for i in fillingScheme]
+        self._cache={}
+
+    def __getitem__(self,key):
+        if key in self._cache:
+            return self._cache[key]
+        if key not in self._rows and key not in self._keys:
+            raise KeyError(key)
+        start,stop=self._rows.get(key,(0,0))
+        IR=self._IR[start:stop]
+        bunch_aux=dotdict({})
+        for expCode,exp in enumerate(self._experiments):
+            rows=slice(start+np.searchsorted(IR,expCode,side='left'),start+np.searchsorted(IR,expCode,side='right'))
+            RDV_index=self._columns['RDV_index'][rows]
+            # Nested structure conventions: partners sorted by bunch number, positions sorted by RDV index
+            bunch_exp=dotdict({'partners':np.sort(self._columns['partner'][rows]),'RDV_index':RDV_index})
+            order=np.argsort(RDV_index,kind='stable')
+            for key_position in ['B1_RDV_position','B2_RDV_position']:
+                if key_position in self._columns:
+                    positions=self._columns[key_position][rows][order]
+                    bunch_exp.update({key_position:positions[~np.isnan(positions)]})
+            bunch_aux.update({exp:bunch_exp})
+        self._cache[key]=bunch_aux
+        return bunch_aux
+
+    def __iter__(self):
+        return iter(dict.fromkeys(self._keys))
+
+    def __len__(self):
+        return len(dict.fromkeys(self._keys))
+
+    def __getattr__(self,key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __dir__(self):
+        return list(self._keys)
+
+
+def BB_pattern_from_table(table,B1_fillingScheme=None,B2_fillingScheme=None):
+    """
+    It returns the nested BEAM >> BUNCH >> EXPERIMENT view of a BB pattern table (see BB_pattern_table?).
+    The bunches are built lazily, when accessed, with the same content as _beam_BB_pattern/optics_BB_pattern.
+    If not given, the filling schemes are taken from the attrs of the table.
+    """
+    fillingSchemes={'B1':B1_fillingScheme,'B2':B2_fillingScheme}
+    results=dotdict({})
+    for beam in ['B1','B2']:
+        fillingScheme=fillingSchemes[beam]
+        if fillingScheme is None:
+            fillingScheme=table.attrs.get(beam+'_fillingScheme',None)
+        if fillingScheme is None:
+            fillingScheme=pd.unique(table.xs(beam,level='beam').index.get_level_values('bunch'))
+        results.update({beam:_beamView(table,beam,fillingScheme)})
+    return results
+
+
+class partnerIndex:
+    """
+    A reverse index of a BB pattern table (see BB_pattern_table?), built once, answering without walking the bunches:
+    - which bunches of a beam meet a given bunch of the other beam in an experiment (see meeting?),
+    - which bunches meet at a given RDV position (e.g. a BBLR element, see atS?),
+    - how many partners each slot has (see numberOfPartners?).
+    The encounters are kept in CSR form: for each (beam, IR) the rows of the table sorted by partner with the offsets 
+    of each partner slot, and for each beam the rows sorted by RDV position with the offsets of each position, so 
+    that a lookup costs O(1) (O(log(positions)) for atS) plus the number of encounters returned.
+    - table [pnd DF]: the BB pattern table (with or without the RDV positions).
+    - availableBunchSlot [adimensional integer]: the number of bunch slots.
+
+    ===== EXAMPLE =====
+    myTable = optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB,output='table')
+    myIndex = partnerIndex(myTable)
+    myIndex.meeting(400,'IR5',beam='B1',removeHO=True).bunches   # B1 bunches meeting B2 bunch 400 at LR in IR5
+    myIndex.atS(B1Optics_BB.loc[B1Optics_BB.NAME=='BBLR_IP5_R_3.B1'].index.max(),beam='B1').bunches   # positive S
+    myIndex.numberOfPartners('B2','IR8')
+    """
+    def __init__(self,table,availableBunchSlot=3564):
+        self.table=table
+        self.availableBunchSlot=availableBunchSlot
+        self.experiments=list(table.index.levels[2])
+        self._columns={key: table[key].values for key in table.columns}
+        self._bunch=np.asarray(table.index.get_level_values('bunch'))
+        self._IR=np.asarray(table.index.codes[2])
+        beamCodes=np.asarray(table.index.codes[0])
+        self._byPartner={}
+        self._byS={}
+        self._counts={}
+        for beamCode,beam in enumerate(table.index.levels[0]):
+            beamRows=np.flatnonzero(beamCodes==beamCode)
+            for expCode,exp in enumerate(self.experiments):
+                rows=beamRows[self._IR[beamRows]==expCode]
+                partners=self._columns['partner'][rows].astype(int)
+                order=np.argsort(partners,kind='stable')
+                offsets=np.zeros(availableBunchSlot+1,dtype=np.int64)
+                offsets[1:]=np.cumsum(np.bincount(partners,minlength=availableBunchSlot))
+                self._byPartner[(beam,exp)]=(rows[order],offsets)
+                self._counts[(beam,exp)]=np.bincount(self._bunch[rows].astype(int),minlength=availableBunchSlot)
+                countArrays(order,offsets)
+            key=beam+'_RDV_position'
+            if key in self._columns:
+                positions=self._columns[key][beamRows]
+                beamRows=beamRows[~np.isnan(positions)]
+                positions=positions[~np.isnan(positions)]
+                order=np.argsort(positions,kind='stable')
+                uniquePositions,starts=np.unique(positions[order],return_index=True)
+                self._byS[beam]=(beamRows[order],uniquePositions,np.append(starts,len(order)))
+        count('rows scanned',len(table))
+
+    def _result(self,rows,keys):
+        results=dotdict({'bunches':self._bunch[rows]})
+        if 'IR' in keys:
+            results.update({'IR':np.asarray(self.experiments,dtype=object)[self._IR[rows]]})
+        for key in keys:
+            if key in self._columns:
+                results.update({key:self._columns[key][rows]})
         return results
-    
-    
-  
-def computeBBMatrix(numberOfLRToConsider=20):
+
+    def meeting(self,partner,exp,beam='B1',removeHO=False):
+        """
+        It returns the bunches of the beam meeting the bunch partner of the other beam in the experiment exp, with 
+        the RDV_index (and RDV positions) of each encounter, in O(number of encounters).
+        NB: the encounters are the ones of the beam in the table, i.e. the bunches having partner in their BB pattern.
+        """
+        rows,offsets=self._byPartner[(beam,exp)]
+        rows=rows[offsets[partner]:offsets[partner+1]]
+        if removeHO:
+            rows=rows[self._columns['RDV_index'][rows]!=0]
+        return self._result(rows,['RDV_index','B1_RDV_position','B2_RDV_position'])
+
+    def atS(self,S,beam='B1'):
+        """
+        It returns the bunches of the beam having an encounter at the RDV position S of its optics (e.g. the S of a 
+        BBLR element), with their partner, IR and RDV_index.
+        NB: the prepared optics are mirrored, so each element has two rows (S<0 and S>0) and only the one of the 
+        RDV window is an RDV position, e.g. S>0 on the right of IP5 and S<0 on the left of IP1 (see RDV_windows?).
+        """
+        if beam not in self._byS:
+            raise ValueError('The BB pattern table has no RDV positions.')
+        rows,positions,offsets=self._byS[beam]
+        k=np.searchsorted(positions,S)
+        if k==len(positions) or positions[k]!=S:
+            rows=rows[:0]
+        else:
+            rows=rows[offsets[k]:offsets[k+1]]
+        return self._result(rows,['partner','IR','RDV_index'])
+
+    def numberOfPartners(self,beam='B1',exp=None):
+        """
+        It returns the number of partners of each slot of the beam (array of availableBunchSlot integers), in the 
+        experiment exp or in all of them (exp=None).
+        """
+        experiments=self.experiments if exp is None else [exp]
+        return np.sum([self._counts[(beam,e)] for e in experiments],axis=0)
+
+
+class compactBBMatrix:
+    """
+    A compact, read-only version of the LHC beam-beam matrix (see computeBBMatrix?).
+
+    The beam-beam matrix is circulant: the code of BBMatrixLHC[i,j] only depends on the slot offset (j-i) modulo 3564.
+    Only this offset vector (3564 int8 codes) is stored and any row or element is obtained by a modular lookup,
+    i.e. ~3.5 kB instead of the ~100 MB of the dense float64 matrix.
+    The codes are the same as in the dense matrix:
+    - 1,2,5,8 when there is a HO respectively in IP1,2,5,8.
+    - 10,20,50,80 when there is a LR respectively in IP1,2,5,8.
+    As IP1 and IP5 share the same pattern, only the 1 and 10 codes are used for both of them (the 5 and 50 codes are 
+    used only if IP5 is moved to another slot).
+
+    The encounter model can be configured for each experiment ('IR1','IR2','IR5','IR8'):
+    - numberOfLRToConsider [integer or dict]: the number of LR per side, for all the experiments or for each of them.
+    - IPslots [dict]: the slot offsets of the HO to change wrt the LHC ones (IR1/5: 0, IR2: 891, IR8: 2670), 
+      e.g. for another IP8 shift convention.
+    The encounters of a single bunch are obtained in O(number of LR) with encounters?, without any matrix.
+
+    It supports the numpy indexing used on the dense matrix (e.g. BBMatrixLHC[N,:], BBMatrixLHC[i,j]) and 
+    np.asarray(BBMatrixLHC) returns the dense matrix (e.g. for plotting), as a read-only view of the offset codes 
+    (no copy, the full matrix or any slice costs ~7 kB). When IP1 and IP5 have the same slot but not
+    the same number of LR, the codes cannot represent the encounter model and the dense matrix is not available 
+    (ValueError): use encounters? or the BB pattern functions, which use the compact matrix directly.
+    The encounters of the experiments cannot overlap (ValueError), apart from IP1 and IP5 on the same slot.
+
+    Example:
+    myMatrix=compactBBMatrix(numberOfLRToConsider=20)
+    myMatrix[400,:]
+    myMatrix=compactBBMatrix(numberOfLRToConsider={'IR1':25,'IR2':20,'IR5':25,'IR8':20},IPslots={'IR8':2673})
+    myMatrix.encounters(400,'IR8',otherFillingScheme=B2_fillingScheme)
+    """
+    def __init__(self,numberOfLRToConsider=20,availableBunchSlot=3564,IPslots=None):
+        experiments=['IR1','IR2','IR5','IR8']
+        self.numberOfLRToConsider=numberOfLRToConsider
+        self.availableBunchSlot=availableBunchSlot
+        if isinstance(numberOfLRToConsider,dict):
+            if set(numberOfLRToConsider)!=set(experiments):
+                raise ValueError('numberOfLRToConsider must be given for '+', '.join(experiments)+'.')
+            self.numberOfLR={exp:int(numberOfLRToConsider[exp]) for exp in experiments}
+        else:
+            self.numberOfLR={exp:int(numberOfLRToConsider) for exp in experiments}
+        # Slot offsets of the HO in IP1/5, IP2 and IP8 (see computeBBMatrix?)
+        self.IPslots={'IR1':0,
+                      'IR2':int(availableBunchSlot/4),
+                      'IR5':0,
+                      'IR8':int(availableBunchSlot/4*3-3)}
+        if IPslots is not None:
+            if not set(IPslots)<=set(experiments):
+                raise ValueError('The IPslots can only be given for '+', '.join(experiments)+'.')
+            self.IPslots.update({exp:int(slot)%availableBunchSlot for exp,slot in IPslots.items()})
+        for i,exp1 in enumerate(experiments):
+            for exp2 in experiments[i+1:]+[exp1]:
+                distance=(self.IPslots[exp2]-self.IPslots[exp1])%availableBunchSlot
+                distance=min(distance,availableBunchSlot-distance) if exp2!=exp1 else availableBunchSlot
+                if {exp1,exp2}=={'IR1','IR5'} and distance==0:
+                    continue
+                if distance<=self.numberOfLR[exp1]+self.numberOfLR[exp2]:
+                    raise ValueError('The encounters of '+exp1+' and '+exp2+' overlap (IPslots='+str(self.IPslots)+
+                                     ', numberOfLRToConsider='+str(self.numberOfLR)+').')
+        sharedIP15=self.IPslots['IR5']==self.IPslots['IR1']
+        self.codes={'IR1':(1,10),'IR2':(2,20),'IR5':(1,10) if sharedIP15 else (5,50),'IR8':(8,80)}
+        # The dense matrix has a single code per slot offset: IP1 and IP5 on the same slot need the same number of LR
+        self.isDense=not sharedIP15 or self.numberOfLR['IR1']==self.numberOfLR['IR5']
+
+        # Same filling order as the dense matrix: IP1/5, IP2 and then IP8
+        offsetCodes=np.zeros(availableBunchSlot,dtype=np.int8)
+        for exp in ['IR1','IR2','IR8'] if sharedIP15 else ['IR1','IR5','IR2','IR8']:
+            slot=self.IPslots[exp]
+            LR=np.arange(1,self.numberOfLR[exp]+1)
+            offsetCodes[slot]=self.codes[exp][0]
+            offsetCodes[(slot+LR)%availableBunchSlot]=self.codes[exp][1]
+            offsetCodes[(slot-LR)%availableBunchSlot]=self.codes[exp][1]
+        self.offsetCodes=offsetCodes
+
+    def encounters(self,bunch,ip,beam='B1',otherFillingScheme=None):
+        """
+        It returns the encounters of a bunch of a beam ('B1' or 'B2') in an experiment ('IR5' or 'IP5') as a dotdict
+        with the partners and the RDV_index (as in _beam_BB_pattern?, but each partner is aligned to its RDV index).
+        The cost is proportional to the number of LR of the experiment.
+        - otherFillingScheme: the filling scheme of the other beam, as a sorted array of bunches or as a boolean 
+          array of availableBunchSlot elements (e.g. BUNCH_FILL_PATTERN). By default all the slots are filled.
+        """
+        exp='IR'+str(ip)[-1]
+        numberOfLR=self.numberOfLR[exp]
+        j=np.arange(2*numberOfLR,-1,-1)
+        center=(len(j)-1)/2
+        partners=(int(bunch)+self.IPslots[exp]+numberOfLR-j)%self.availableBunchSlot
+        RDV_index=-(j-center) if beam=='B1' else (j-center)
+        if otherFillingScheme is not None:
+            otherFillingScheme=np.asarray(otherFillingScheme)
+            if otherFillingScheme.dtype==bool and len(otherFillingScheme)==self.availableBunchSlot:
+                myFilter=otherFillingScheme[partners]
+            else:
+                k=np.minimum(np.searchsorted(otherFillingScheme,partners),max(len(otherFillingScheme)-1,0))
+                myFilter=(otherFillingScheme[k]==partners) if len(otherFillingScheme) else np.zeros(len(j),bool)
+            partners=partners[myFilter]
+            RDV_index=RDV_index[myFilter]
+        return dotdict({'partners':partners,'RDV_index':RDV_index})
+
+    @property
+    def shape(self):
+        return (self.availableBunchSlot,self.availableBunchSlot)
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return self.offsetCodes.dtype
+
+    def __len__(self):
+        return self.availableBunchSlot
+
+    def __repr__(self):
+        return 'compactBBMatrix(numberOfLRToConsider='+str(self.numberOfLRToConsider)+ \
+               ', availableBunchSlot='+str(self.availableBunchSlot)+', IPslots='+str(self.IPslots)+')'
+
+    def _checkDense(self):
+        if not self.isDense:
+            raise ValueError('The beam-beam matrix cannot represent IP1 and IP5 on the same slot with a different '
+                             'number of LR (numberOfLRToConsider='+str(self.numberOfLR)+'): use encounters?.')
+
+    def row(self,Bunch):
+        """
+        It returns the BB pattern of the bunch Bunch of B1, i.e. the row BBMatrixLHC[Bunch,:].
+        """
+        self._checkDense()
+        return np.roll(self.offsetCodes,Bunch)
+
+    def _circulantView(self):
+        """
+        It returns the dense matrix as a read-only view of the offset codes, without any copy: the codes are 
+        repeated twice and each row starts one element before the previous one.
+        """
+        self._checkDense()
+        codes=np.concatenate([self.offsetCodes,self.offsetCodes])
+        return np.lib.stride_tricks.as_strided(codes[self.availableBunchSlot:],shape=self.shape,
+                                               strides=(-codes.strides[0],codes.strides[0]),writeable=False)
+
+    def __getitem__(self,key):
+        if isinstance(key,tuple) and len(key)>2:
+            raise IndexError('The beam-beam matrix has only two dimensions.')
+        return self._circulantView()[key]
+
+    def __array__(self,dtype=None,copy=None):
+        dense=self._circulantView()
+        if dtype is not None:
+            return dense.astype(dtype)
+        return dense.copy() if copy else dense
+
+
+@timed()
+def computeBBMatrix(numberOfLRToConsider=20,compact=True,IPslots=None):
         """
         It returns a beam-beam matrix. 
         To obtain the BB pattern of the bunch N of B1 you have to consider the N-row (e.g., BBMatrix[N,:]).
@@ -212,66 +871,16 @@ def computeBBMatrix(numberOfLRToConsider=20):
         2. B1 Bunch 0 meets B2 Bunch 891 in IP2.
         2. B1 Bunch 0 meets B2 Bunch 2670 in IP8.
 
+        By default the matrix is returned as a compactBBMatrix (see compactBBMatrix?), that stores only the slot 
+        offsets of the encounters. Set "compact" to False to obtain the dense 3564x3564 float64 numpy array (not 
+        available when IP1 and IP5 share their slot with a different number of LR, see compactBBMatrix?).
+        The number of LR can be given for each experiment and the IP slots can be changed (see compactBBMatrix?), 
+        e.g. computeBBMatrix(numberOfLRToConsider={'IR1':25,'IR2':20,'IR5':25,'IR8':20}).
+
         Example:
         myMatrix=computeBBMatrix(numberOfLRToConsider=20)
         """ 
-        availableBunchSlot=3564
-        BBMatrixLHC =np.zeros([availableBunchSlot,availableBunchSlot]);
-
-        #numberOfLRToConsider=20;
-
-        # HO in IP1 and IP5
-        index=np.arange(availableBunchSlot)
-        BBMatrixLHC[index,index]=1
-
-        # BBLR in IP1 and IP5
-        for i in range(1,numberOfLRToConsider+1):
-            index=np.arange(availableBunchSlot-i)
-            BBMatrixLHC[index,index+i]=10
-            BBMatrixLHC[index,index-i]=10
-            BBMatrixLHC[index+i,index]=10
-            BBMatrixLHC[index-i,index]=10
-
-        # HO in IP2
-        IP2slot=int(availableBunchSlot/4)
-        index=np.arange(availableBunchSlot-IP2slot)
-        BBMatrixLHC[index,index+IP2slot]=2
-        index=np.arange(availableBunchSlot-IP2slot,availableBunchSlot)
-        BBMatrixLHC[index,index-(availableBunchSlot-IP2slot)]=2
-
-        # BBLR in IP2
-        for i in range(1,numberOfLRToConsider+1):
-            index=np.arange(availableBunchSlot-IP2slot-i)
-            BBMatrixLHC[index,index+IP2slot+i]=20
-            BBMatrixLHC[index+i,index+IP2slot]=20
-            BBMatrixLHC[index,index+IP2slot-i]=20
-            BBMatrixLHC[index-i,index+IP2slot]=20
-            index=np.arange(availableBunchSlot-IP2slot,availableBunchSlot-i)
-            BBMatrixLHC[index,index-(availableBunchSlot-IP2slot)+i]=20
-            BBMatrixLHC[index+i,index-(availableBunchSlot-IP2slot)]=20
-            BBMatrixLHC[index,index-(availableBunchSlot-IP2slot)-i]=20
-            BBMatrixLHC[index-i,index-(availableBunchSlot-IP2slot)]=20
-
-        # HO in IP8
-        IP8slot=int(availableBunchSlot/4*3-3)
-        index=np.arange(availableBunchSlot-IP8slot)
-        BBMatrixLHC[index,index+IP8slot]=8
-        index=np.arange(availableBunchSlot-IP8slot,availableBunchSlot)
-        BBMatrixLHC[index,index-(availableBunchSlot-IP8slot)]=8
-
-        # BBLR in IP8
-        for i in range(1,numberOfLRToConsider+1):
-            index=np.arange(availableBunchSlot-IP8slot-i)
-            BBMatrixLHC[index,index+IP8slot+i]=80
-            BBMatrixLHC[index+i,index+IP8slot]=80
-            BBMatrixLHC[index,index+IP8slot-i]=80
-            BBMatrixLHC[index-i,index+IP8slot]=80
-            index=np.arange(availableBunchSlot-IP8slot,availableBunchSlot-i)
-            BBMatrixLHC[index,index-(availableBunchSlot-IP8slot)+i]=80
-            BBMatrixLHC[index+i,index-(availableBunchSlot-IP8slot)]=80
-            BBMatrixLHC[index,index-(availableBunchSlot-IP8slot)-i]=80
-            BBMatrixLHC[index-i,index-(availableBunchSlot-IP8slot)]=80
-
-        return BBMatrixLHC;
-    
-   
+        BBMatrixLHC=compactBBMatrix(numberOfLRToConsider=numberOfLRToConsider,IPslots=IPslots)
+        if compact:
+            return BBMatrixLHC
+        return np.asarray(BBMatrixLHC,dtype=float)
@@ -0,0 +1,278 @@
+import os
+import json
+import struct
+import shutil
+import tracemalloc
+import numpy as np
+import pandas as pd
+from dotdict import *
+from helpers import temporaryFolder
+from BBES import encounterParameters, bunches_BB_encounters, flat_BB_pattern, RDV_windows
+from instrumentation import timed, timer, count
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# To be increased when the layout of the files changes
+storeVersion='1'
+
+
+def writeBBES(BBES,path,overwrite=False):
+    """
+    It writes a BBES structure (see BBES._beam_BB_pattern? or BBES.optics_BB_pattern?) in the folder path as flat
+    arrays, that can be memory-mapped to read single bunches or experiments (see readBBES?).
+    For each beam and key (partners, RDV_index, B1_RDV_position, B2_RDV_position) the arrays of all the bunches and
+    experiments are concatenated in a .npy file, with a table of offsets: the array of the bunch k in the experiment
+    e is values[offsets[k*numberOfExperiments+e]:offsets[k*numberOfExperiments+e+1]].
+    The integer arrays (e.g. the partners) are stored with the smallest integer type and read with their own type.
+    The files are written in a temporary folder that is then renamed, so that a store is never partially written.
+    - overwrite [boolean]: replace the store path if it already exists.
+
+    ===== EXAMPLE =====
+    writeBBES(BBES,'/eos/user/.../fill6666_BBES')
+    myBBES=readBBES('/eos/user/.../fill6666_BBES')
+    myBBES.B1.b400.IR5.partners
+    """
+    path=os.path.abspath(path)
+    if os.path.exists(path) and not overwrite:
+        raise ValueError(path+' already exists (set overwrite to True to replace it).')
+    temporaryPath=temporaryFolder(os.path.dirname(path))
+    meta={'version':storeVersion,'beams':{}}
+    for beam in BBES:
+        bunches=list(BBES[beam])
+        firstBunch=BBES[beam][bunches[0]] if len(bunches) else {}
+        experiments=list(firstBunch)
+        keys=list(firstBunch[experiments[0]]) if len(experiments) else ['partners','RDV_index']
+        dtypes={}
+        np.save(os.path.join(temporaryPath,beam+'_bunches.npy'),np.array([int(e[1:]) for e in bunches],dtype=int))
+        for key in keys:
+            arrays=[np.asarray(BBES[beam][bunch][exp][key]) for bunch in bunches for exp in experiments]
+            offsets=np.zeros(len(arrays)+1,dtype=np.int64)
+            offsets[1:]=np.cumsum([len(e) for e in arrays])
+            values=np.concatenate(arrays) if len(arrays) else np.array([],dtype=int)
+            dtypes[key]=values.dtype.str
+            if values.dtype.kind in 'iu' and len(values):
+                values=values.astype(np.promote_types(np.min_scalar_type(values.min()),
+                                                      np.min_scalar_type(values.max())))
+            np.save(os.path.join(temporaryPath,beam+'_'+key+'.npy'),values)
+            np.save(os.path.join(temporaryPath,beam+'_'+key+'_offsets.npy'),offsets)
+        meta['beams'][beam]={'experiments':experiments,'keys':keys,'dtypes':dtypes}
+    with open(os.path.join(temporaryPath,'meta.json'),'w') as myFile:
+        json.dump(meta,myFile)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temporaryPath,path)
+
+
+def readBBES(path):
+    """
+    It returns the BEAM >> BUNCH >> EXPERIMENT view of a BBES store (see writeBBES?).
+    The arrays are memory-mapped: only the accessed bunches (or experiments, see _storedBeamView.experiment?) are
+    read from the file.
+    """
+    with open(os.path.join(path,'meta.json')) as myFile:
+        meta=json.load(myFile)
+    if meta['version']!=storeVersion:
+        raise ValueError('The BBES store '+path+' has the version '+meta['version']+' instead of '+storeVersion+'.')
+    results=dotdict({})
+    for beam,beamMeta in meta['beams'].items():
+        results.update({beam:_storedBeamView(path,beam,beamMeta['experiments'],beamMeta['keys'],beamMeta['dtypes'])})
+    return results
+
+
+class _storedBeamView(Mapping):
+    """
+    A read-only, lazy BUNCH >> EXPERIMENT view on the memory-mapped arrays of a beam of a BBES store.
+    The dotdict of a bunch is copied from the files only when the bunch is accessed.
+    """
+    def __init__(self,path,beam,experiments,keys,dtypes):
+        self._experiments=experiments
+        self._dtypes={key:np.dtype(dtype) for key,dtype in dtypes.items()}
+        self._bunches=np.load(os.path.join(path,beam+'_bunches.npy'))
+        self._rows={'b'+str(e):k for k,e in enumerate(self._bunches)}
+        self._values={}
+        self._offsets={}
+        for key in keys:
+            self._values[key]=np.load(os.path.join(path,beam+'_'+key+'.npy'),mmap_mode='r')
+            self._offsets[key]=np.load(os.path.join(path,beam+'_'+key+'_offsets.npy'),mmap_mode='r')
+
+    def _array(self,key,k,expCode):
+        i=k*len(self._experiments)+expCode
+        return np.array(self._values[key][self._offsets[key][i]:self._offsets[key][i+1]],dtype=self._dtypes[key])
+
+    def __getitem__(self,key):
+        k=self._rows[key]
+        bunch_aux=dotdict({})
+        for expCode,exp in enumerate(self._experiments):
+            bunch_aux.update({exp:dotdict({key_value:self._array(key_value,k,expCode) for key_value in self._values})})
+        return bunch_aux
+
+    def experiment(self,exp):
+        """
+        It returns the BUNCH >> dotdict of the experiment exp only (e.g. 'IR5').
+        """
+        expCode=self._experiments.index(exp)
+        return dotdict({bunch:dotdict({key:self._array(key,k,expCode) for key in self._values})
+                        for bunch,k in self._rows.items()})
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getattr__(self,key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __dir__(self):
+        return list(self._rows)
+
+
+# Number of bunches of the first chunk of each beam, whose peak memory is measured to size the next ones, and
+# fraction of maxMemory used by the next chunks, whose peak per bunch varies by about 10% (see writeBBESChunked?)
+calibrationBunches=32
+memoryMargin=0.8
+
+
+class _appendableArray:
+    """
+    A 1D array written to a .npy file by appending chunks: the header has a fixed size and is rewritten with the
+    final length when the file is closed.
+    """
+    headerSize=128
+
+    def __init__(self,fileName,dtype):
+        self.dtype=np.dtype(dtype)
+        self.length=0
+        self._file=open(fileName,'wb')
+        self._file.write(self._header())
+
+    def _header(self):
+        text=repr({'descr':np.lib.format.dtype_to_descr(self.dtype),'fortran_order':False,'shape':(self.length,)})
+        # Magic string, version and header length are 10 bytes
+        text=text.ljust(self.headerSize-11)+'\n'
+        return b'\x93NUMPY\x01\x00'+struct.pack('<H',len(text))+text.encode('latin1')
+
+    def append(self,values):
+        values=np.ascontiguousarray(values,dtype=self.dtype)
+        self._file.write(values.tobytes())
+        self.length+=len(values)
+
+    def close(self):
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.close()
+
+
+@timed()
+def writeBBESChunked(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB,path,chunkSize=None,
+                     maxMemory=200e6,overwrite=False):
+    """
+    It computes the BBES structure (see BBES.optics_BB_pattern?) by chunks of bunches and appends each chunk to the
+    store path as soon as it is computed, so that the memory does not grow with the number of bunches.
+    The store is the same as the one of writeBBES(optics_BB_pattern(...),path) and is read with readBBES?.
+    - chunkSize [integer]: number of bunches per chunk. By default, it is chosen to keep the peak memory of a chunk
+      below maxMemory [B]: the peak memory of a first chunk of calibrationBunches bunches of each beam is measured
+      with tracemalloc and the next chunks are sized in proportion (see memoryMargin).
+    - overwrite [boolean]: replace the store path if it already exists.
+    As for writeBBES?, the store is written in a temporary folder that is renamed at the end.
+
+    ===== EXAMPLE =====
+    writeBBESChunked(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB,'/tmp/fill6666_BBES',
+                     maxMemory=100e6)
+    myBBES=readBBES('/tmp/fill6666_BBES')
+    """
+    path=os.path.abspath(path)
+    if os.path.exists(path) and not overwrite:
+        raise ValueError(path+' already exists (set overwrite to True to replace it).')
+    experiments=['IR1','IR2','IR5','IR8']
+    availableBunchSlot=encounterParameters(BBMatrixLHC)[0]
+    windows,heldMemory,_=_measuredCall(RDV_windows,B1Optics_BB,B2Optics_BB)
+    # Partners are slots: they are stored with the smallest integer type of the slots (see writeBBES?)
+    partnerStoreType=np.min_scalar_type(availableBunchSlot-1)
+    temporaryPath=temporaryFolder(os.path.dirname(path))
+    meta={'version':storeVersion,'beams':{}}
+    for beam,fillingScheme,otherFillingScheme in [('B1',B1_fillingScheme,B2_fillingScheme),
+                                                  ('B2',B2_fillingScheme,B1_fillingScheme)]:
+        # As in the nested structure, a bunch appears once
+        bunches=pd.unique(np.asarray(fillingScheme))
+        np.save(os.path.join(temporaryPath,beam+'_bunches.npy'),bunches.astype(int))
+        if len(bunches)==0:
+            for key in ['partners','RDV_index']:
+                np.save(os.path.join(temporaryPath,beam+'_'+key+'.npy'),np.array([],dtype=int))
+                np.save(os.path.join(temporaryPath,beam+'_'+key+'_offsets.npy'),np.zeros(1,dtype=np.int64))
+            meta['beams'][beam]={'experiments':[],'keys':['partners','RDV_index'],
+                                 'dtypes':{'partners':np.dtype(int).str,'RDV_index':np.dtype(int).str}}
+            continue
+        values={}
+        offsets={}
+        dtypes={}
+        myChunkSize=chunkSize
+        start=0
+        while start<len(bunches):
+            with timer('chunk'):
+                if myChunkSize is None:
+                    myBunches=bunches[:calibrationBunches]
+                    _,_,peak=_measuredCall(_appendChunk,BBMatrixLHC,beam,myBunches,otherFillingScheme,windows,
+                                           experiments,partnerStoreType,temporaryPath,values,offsets,dtypes)
+                    myChunkSize=max(int(memoryMargin*(maxMemory-heldMemory)*len(myBunches)//max(peak,1)),1)
+                else:
+                    myBunches=bunches[start:start+myChunkSize]
+                    _appendChunk(BBMatrixLHC,beam,myBunches,otherFillingScheme,windows,experiments,partnerStoreType,
+                                 temporaryPath,values,offsets,dtypes)
+                count('bunches processed',len(myBunches))
+            start+=len(myBunches)
+        for key in values:
+            values[key].close()
+            offsets[key].close()
+        meta['beams'][beam]={'experiments':experiments,'keys':list(values),'dtypes':dtypes}
+    with open(os.path.join(temporaryPath,'meta.json'),'w') as myFile:
+        json.dump(meta,myFile)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temporaryPath,path)
+
+
+def _appendChunk(BBMatrixLHC,beam,bunches,otherFillingScheme,windows,experiments,partnerStoreType,temporaryPath,
+                 values,offsets,dtypes):
+    """
+    It computes the flat BBES structure of some bunches of a beam (see BBES.flat_BB_pattern?) and appends it to the
+    files of the store being written in temporaryPath (values, offsets and dtypes are updated, see writeBBESChunked?).
+    """
+    encounters=bunches_BB_encounters(BBMatrixLHC,beam,bunches,otherFillingScheme)
+    myChunk=flat_BB_pattern(encounters,windows,experiments)
+    del encounters
+    for key,(myValues,myCounts) in myChunk.items():
+        if key not in values:
+            dtypes[key]=myValues.dtype.str
+            storeType=partnerStoreType if key=='partners' else myValues.dtype
+            values[key]=_appendableArray(os.path.join(temporaryPath,beam+'_'+key+'.npy'),storeType)
+            offsets[key]=_appendableArray(os.path.join(temporaryPath,beam+'_'+key+'_offsets.npy'),np.int64)
+            offsets[key].append([0])
+        offsets[key].append(values[key].length+np.cumsum(myCounts))
+        values[key].append(myValues)
+
+
+def _measuredCall(function,*args):
+    """
+    It returns the result of function(*args), the memory [B] it still holds and the peak of the memory [B] allocated
+    during the call, measured with tracemalloc. If tracemalloc is already tracing, its peak is not reset: the peak is
+    then an upper bound.
+    """
+    isTracing=tracemalloc.is_tracing()
+    if not isTracing:
+        tracemalloc.start()
+    try:
+        start=tracemalloc.get_traced_memory()[0]
+        result=function(*args)
+        current,peak=tracemalloc.get_traced_memory()
+        return result,current-start,peak-start
+    finally:
+        if not isTracing:
+            tracemalloc.stop()
@@ -0,0 +1,135 @@
+import re
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from dotdict import *
+from optics import elementFamilies, dictOpticsFromMADX
+from instrumentation import timed, count
+
+# Columns used by the package (see preparingOpticsFromMADX?)
+TFSColumns={'Twiss':['NAME','S','X','Y','MUX','MUY','BETX','BETY'],
+            'Survey':['NAME','S','X','Y','Z','THETA']}
+
+# Markers needed by preparingOpticsFromMADX? in addition to the element families (phase advances at the IPs)
+IPMarkers=['IP1.L1']+['IP'+str(e) for e in range(1,9)]
+
+# Types of the TFS formats
+_TFSTypes={'s':object,'e':np.float64,'f':np.float64,'g':np.float64,'d':np.int64,'i':np.int64}
+
+
+def _TFSType(myFormat):
+    return _TFSTypes.get(myFormat.strip()[-1],object)
+
+
+def _headerValue(myFormat,value):
+    value=value.strip()
+    myType=_TFSType(myFormat)
+    if myType is object:
+        return value.strip('"')
+    return myType(float(value)) if myType is np.int64 else myType(value)
+
+
+def _readHeader(myFile):
+    """
+    It reads the header of the TFS file myFile up to the '$' line and returns the dotdict of the '@' values and the
+    list of (column, format).
+    """
+    header=dotdict({})
+    names=None
+    for line in myFile:
+        if line.startswith('@'):
+            key,myFormat,value=line[1:].split(None,2)
+            header[key]=_headerValue(myFormat,value)
+        elif line.startswith('*'):
+            names=line[1:].split()
+        elif line.startswith('$'):
+            formats=line[1:].split()
+            if names is None or len(formats)!=len(names):
+                raise ValueError('The "*" and "$" lines of '+str(myFile.name)+' do not match.')
+            return header,list(zip(names,formats))
+    raise ValueError(str(myFile.name)+' is not a TFS file (no "*" and "$" lines).')
+
+
+def opticsRowFilter(beam):
+    """
+    It returns the regular expression of the NAME of the rows used by preparingOpticsFromMADX? for the beam: the
+    element families of elementIndex.BBFilter? and the IP markers (see IPMarkers).
+    The expression is anchored at the beginning of the NAME (see readTFS?), which is much faster to evaluate than
+    the alternative of the unanchored families.
+    """
+    patterns=[elementFamilies['MB.'+beam],elementFamilies['E.'],elementFamilies['BBLR'],elementFamilies['S.']]
+    patterns=[e[1:] if e.startswith('^') else '.*'+e for e in patterns]
+    return '(?:'+'|'.join(patterns+[re.escape(e)+'$' for e in IPMarkers])+')'
+
+
+@timed()
+def readTFS(fileName,columns=None,rowFilter=None,index='S',chunkSize=100000):
+    """
+    It returns the table of the MAD-X TFS file fileName as a DataFrame, with the '@' values of the header in
+    myDF.attrs['header'].
+    The file is streamed by chunks of chunkSize rows and only the required columns and rows are kept:
+    - columns [list]: the columns to parse (e.g. TFSColumns['Twiss']), the ones missing in the file are ignored.
+      None for all the columns.
+    - rowFilter [string]: regular expression matching the beginning of the NAME of the rows to keep (re.match, e.g.
+      opticsRowFilter('B1')). The last row of the table is always kept, since its S is the length of the sequence (see _mirroredRows?).
+    - index [string]: column used as index (by default S, as expected by preparingOpticsFromMADX?), None for a
+      RangeIndex.
+
+    ===== EXAMPLE =====
+    B1_twiss = readTFS('twiss_b1.tfs',columns=TFSColumns['Twiss'],rowFilter=opticsRowFilter('B1'))
+    B1_twiss.attrs['header']['Q1']
+    """
+    with open(fileName) as myFile:
+        header,myColumns=_readHeader(myFile)
+        names=[e[0] for e in myColumns]
+        if columns is None:
+            usecols=names
+        else:
+            usecols=[e for e in names if e in columns or e==index or (e=='NAME' and rowFilter is not None)]
+        dtypes={name:_TFSType(myFormat) for name,myFormat in myColumns if name in usecols}
+        if rowFilter is not None:
+            myMatch=re.compile(rowFilter).match
+        chunks=[]
+        lastRow=None
+        numberOfRows=0
+        for chunk in pd.read_csv(myFile,sep=r'\s+',header=None,names=names,usecols=usecols,dtype=dtypes,
+                                 quotechar='"',chunksize=chunkSize):
+            numberOfRows+=len(chunk)
+            if rowFilter is not None:
+                myFilter=np.array([myMatch(e) is not None for e in chunk['NAME'].values],dtype=bool)
+                lastRow=None if myFilter[-1] else chunk.iloc[-1:]
+                chunk=chunk[myFilter]
+            chunks.append(chunk)
+        if lastRow is not None:
+            chunks.append(lastRow)
+    count('rows scanned',numberOfRows)
+    if chunks:
+        myDF=pd.concat(chunks,ignore_index=True)
+    else:
+        myDF=pd.DataFrame({name:pd.Series(dtype=dtypes[name]) for name in usecols})
+    if index is not None and index in usecols:
+        myDF.index=myDF[index].values
+    if columns is not None:
+        myDF=myDF[[e for e in usecols if e in columns]]
+    myDF.attrs['header']=dict(header)
+    return myDF
+
+
+def dictOpticsFromTFS(B1_twiss,B2_twiss,B1_survey,B2_survey,columns=TFSColumns,filterRows=False,threads=4):
+    """
+    It reads the 4 TFS files of an optics concurrently (threads) and returns them as the dotdict of
+    dictOpticsFromMADX?, ready for preparingOpticsFromMADX?.
+    - columns [dict]: the columns to parse for the 'Twiss' and the 'Survey' (see TFSColumns), None for all.
+    - filterRows [boolean]: keep only the rows used by preparingOpticsFromMADX? (see opticsRowFilter?), the
+      prepared optics is unchanged.
+
+    ===== EXAMPLE =====
+    MADX_DICT = preparingOpticsFromMADX(dictOpticsFromTFS('twiss_b1.tfs','twiss_b2.tfs','survey_b1.tfs',
+                                                          'survey_b2.tfs',filterRows=True))
+    """
+    files=[('B1','Twiss',B1_twiss),('B2','Twiss',B2_twiss),('B1','Survey',B1_survey),('B2','Survey',B2_survey)]
+    with ThreadPoolExecutor(max_workers=threads) as myExecutor:
+        futures=[myExecutor.submit(readTFS,fileName,None if columns is None else columns[table],
+                                   opticsRowFilter(beam) if filterRows else None)
+                 for beam,table,fileName in files]
+        return dictOpticsFromMADX(*[e.result() for e in futures])
@@ -0,0 +1,74 @@
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from dotdict import *
+from optics import preparingOpticsFromMADX
+from BBES import BB_pattern_table
+
+# Inputs shared by all the scenarios, sent once to each worker (see _initWorker)
+_shared=dotdict({})
+
+
+def _initWorker(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,function,loader,cache):
+    _shared.update({'BBMatrixLHC':BBMatrixLHC,
+                    'B1_fillingScheme':B1_fillingScheme,
+                    'B2_fillingScheme':B2_fillingScheme,
+                    'function':function,
+                    'loader':loader,
+                    'cache':cache})
+
+
+def _runScenario(scenario):
+    """
+    It prepares the optics of a scenario and returns its BB pattern table (or the output of the shared function).
+    """
+    if isinstance(scenario,dict):
+        MADX_DICT=scenario
+    elif _shared.loader is not None:
+        MADX_DICT=_shared.loader(scenario)
+    else:
+        raise ValueError('The scenario is not a MAD-X dotdict (see dictOpticsFromMADX?) and no loader is given.')
+    myOptics=preparingOpticsFromMADX(MADX_DICT,cache=_shared.cache)
+    table=BB_pattern_table(_shared.BBMatrixLHC,_shared.B1_fillingScheme,_shared.B2_fillingScheme,
+                           myOptics.B1.Twiss,myOptics.B2.Twiss)
+    if _shared.function is not None:
+        return _shared.function(table,myOptics)
+    return table
+
+
+def batch_optics_BB_pattern(scenarios,BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,function=None,processes=None,
+                            loader=None,cache=None):
+    """
+    It evaluates the same filling schemes against many optics scenarios (e.g. crossing-angle or beta* levelling scans)
+    on a pool of processes and returns one DataFrame with the results of all the scenarios.
+    - scenarios [dict]: scenario name >> MAD-X dotdict (see dictOpticsFromMADX?), or any object that the loader
+      turns into such a dotdict in the worker (e.g. the file names of the twiss and survey).
+    - BBMatrixLHC [adimensional integer array]: the LHC BB matrix.
+    - B1_fillingScheme, B2_fillingScheme [adimensional integer array]: the filling schemes.
+    - function [function]: f(table,preparedOptics) returning a DataFrame, applied in the worker to the BB pattern
+      table of the scenario (see BBES.BB_pattern_table?) and its prepared optics. By default the table is returned.
+    - processes [integer]: the number of processes (default: the number of cores). With 1 the scenarios are
+      evaluated in the current process.
+    - loader [function]: the function loading a scenario that is not a MAD-X dotdict.
+    - cache [opticsCache or string]: the optics cache used by preparingOpticsFromMADX (optional).
+    The BB matrix, the filling schemes and the functions are sent once to each process, not with each scenario.
+    Therefore function and loader have to be defined at the top level of a module (to be pickled).
+    The results are concatenated with an additional 'scenario' index level, in the order of the scenarios.
+
+    ===== EXAMPLE =====
+    scenarios={angle: dictOpticsFromMADX(B1_twiss[angle],B2_twiss[angle],B1_survey,B2_survey) for angle in angles}
+    myTable=batch_optics_BB_pattern(scenarios,BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,processes=16)
+    myTable.groupby(level=['scenario','IR'],observed=True)['partner'].count()
+    """
+    names=list(scenarios.keys())
+    initargs=(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,function,loader,cache)
+    if processes is None:
+        processes=os.cpu_count() or 1
+    processes=max(1,min(processes,len(names)))
+    if processes==1:
+        _initWorker(*initargs)
+        results=[_runScenario(scenarios[name]) for name in names]
+    else:
+        with ProcessPoolExecutor(max_workers=processes,initializer=_initWorker,initargs=initargs) as executor:
+            results=list(executor.map(_runScenario,[scenarios[name] for name in names]))
+    return pd.concat(results,keys=names,names=['scenario'])
@@ -0,0 +1,192 @@
+"""
+Command-line batch processing of LHC fills: for each filling-scheme snapshot of an input directory, the BB pattern
+is computed against the optics of the directory and the per-bunch results are written in one folder per fill.
+
+===== EXAMPLE =====
+python BeamBeamTools/cli.py /eos/user/.../run2018 /eos/user/.../run2018_results --processes 8 --energy 6500 --intensity 1.1e11
+
+The input directory contains the MAD-X TFS files of the optics (see --opticsFiles) and the snapshots, as JSON files
+{"B1": [...], "B2": [...]} with the bunch numbers or the 0/1 BUNCH_FILL_PATTERN of each beam.
+For a snapshot fill6666.json, the folder fill6666 of the output directory contains
+- BBES: the BBES store (see BBESStore.readBBES?),
+- longRange.csv: the LR kicks and tune shifts of each bunch in each experiment (see longRange.longRangeEffects?),
+- separation.csv: the minimum normalised separation of each bunch (see longRange.minimumSeparation?),
+- meta.json: the inputs of the fill.
+Each fill is written in a temporary folder renamed at the end: an interrupted run is resumed by running the same
+command, the fills already computed with the same inputs and parameters being skipped.
+"""
+import os
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dotdict import *
+from helpers import temporaryFolder
+from opticsCache import opticsCache
+from optics import preparingOpticsFromMADX
+from TFS import dictOpticsFromTFS, TFSColumns
+from BBES import computeBBMatrix, BB_pattern_table
+from BBESStore import writeBBESChunked
+from longRange import longRangeEffects, separationTable, minimumSeparation
+from streaming import fillingSchemeBunches
+
+outputs=['BBES','longRange','separation']
+
+# Inputs shared by all the fills, sent once to each worker (see _initWorker)
+_shared=dotdict({})
+
+
+def _initWorker(BBMatrixLHC,B1Optics_BB,B2Optics_BB,parameters):
+    _shared.update({'BBMatrixLHC':BBMatrixLHC,
+                    'B1Optics_BB':B1Optics_BB,
+                    'B2Optics_BB':B2Optics_BB,
+                    'parameters':parameters})
+
+
+def readFillingScheme(fileName):
+    """
+    It returns the B1 and B2 bunches of a snapshot file {"B1": [...], "B2": [...]} (bunch numbers or 0/1 patterns).
+    """
+    with open(fileName) as myFile:
+        mySnapshot=json.load(myFile)
+    return fillingSchemeBunches(mySnapshot['B1']),fillingSchemeBunches(mySnapshot['B2'])
+
+
+def fillKey(fileName,opticsKey,parameters):
+    """
+    It returns the hash of the inputs of a fill: its snapshot file, the optics and the parameters.
+    """
+    myHash=hashlib.sha1((opticsKey+json.dumps(parameters,sort_keys=True)).encode())
+    with open(fileName,'rb') as myFile:
+        myHash.update(myFile.read())
+    return myHash.hexdigest()
+
+
+def isDone(path,key):
+    """
+    It returns True if the fill folder path has been computed with the inputs key (see fillKey?).
+    """
+    try:
+        with open(os.path.join(path,'meta.json')) as myFile:
+            return json.load(myFile)['key']==key
+    except (IOError,OSError,ValueError,KeyError):
+        return False
+
+
+def _runFill(fileName,path,key):
+    """
+    It computes the outputs of the snapshot fileName in a temporary folder, renamed path at the end.
+    """
+    parameters=_shared.parameters
+    B1Optics_BB=_shared.B1Optics_BB
+    B2Optics_BB=_shared.B2Optics_BB
+    B1_fillingScheme,B2_fillingScheme=readFillingScheme(fileName)
+    temporaryPath=temporaryFolder(os.path.dirname(path),os.path.basename(path))
+    if 'BBES' in parameters['outputs']:
+        writeBBESChunked(_shared.BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB,
+                         os.path.join(temporaryPath,'BBES'),maxMemory=parameters['maxMemory'])
+    if 'longRange' in parameters['outputs'] or 'separation' in parameters['outputs']:
+        table=BB_pattern_table(_shared.BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB)
+        if 'longRange' in parameters['outputs']:
+            longRangeEffects(table,B1Optics_BB,B2Optics_BB,parameters['intensity'],parameters['intensity'],
+                             emittance=parameters['emittance'],
+                             energy=parameters['energy']).to_csv(os.path.join(temporaryPath,'longRange.csv'))
+        if 'separation' in parameters['outputs']:
+            mySeparations=separationTable(table,B1Optics_BB,B2Optics_BB,emittance=parameters['emittance'],
+                                          energy=parameters['energy'])
+            minimumSeparation(mySeparations).to_csv(os.path.join(temporaryPath,'separation.csv'))
+    with open(os.path.join(temporaryPath,'meta.json'),'w') as myFile:
+        json.dump({'key':key,'fillingScheme':os.path.abspath(fileName),'parameters':parameters,
+                   'B1 bunches':len(B1_fillingScheme),'B2 bunches':len(B2_fillingScheme)},myFile,indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temporaryPath,path)
+    return path
+
+
+def run(inputDirectory,outputDirectory,processes=1,pattern='*.json',
+        opticsFiles=['twiss_b1.tfs','twiss_b2.tfs','survey_b1.tfs','survey_b2.tfs'],numberOfLR=20,intensity=1.15e11,
+        emittance=2.5e-6,energy=7000.,maxMemory=200e6,outputs=outputs,cache=None,force=False,verbose=True):
+    """
+    It processes the snapshots (files pattern) of inputDirectory against its optics (opticsFiles) on processes
+    workers and returns the list of the fill folders written in outputDirectory (see the module documentation).
+    The fills already computed with the same inputs are skipped, unless force is True.
+    - numberOfLR [integer]: the number of LR per side of each IP (see BBES.computeBBMatrix?).
+    - intensity [protons], emittance [m], energy [GeV]: the beam parameters (see longRange.longRangeEffects?).
+    - maxMemory [B]: the memory target of the BBES generation (see BBESStore.writeBBESChunked?).
+    - outputs [list]: the outputs to write, among 'BBES', 'longRange' and 'separation'.
+    - cache [string]: the folder of the optics cache (see opticsCache?).
+    """
+    fileNames=sorted(e for e in glob.glob(os.path.join(inputDirectory,pattern)) if os.path.isfile(e))
+    opticsFileNames=[os.path.join(inputDirectory,e) for e in opticsFiles]
+    parameters={'numberOfLR':numberOfLR,'intensity':intensity,'emittance':emittance,'energy':energy,
+                'maxMemory':maxMemory,'outputs':list(outputs)}
+    # The loader options are part of the optics key: other columns or rows give other prepared optics
+    opticsOptions={'columns':TFSColumns,'filterRows':True}
+    opticsKey=opticsCache.keyFromFiles(opticsFileNames,opticsOptions)
+    if not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+    units=[]
+    for fileName in fileNames:
+        path=os.path.join(outputDirectory,os.path.splitext(os.path.basename(fileName))[0])
+        key=fillKey(fileName,opticsKey,parameters)
+        if force or not isDone(path,key):
+            units.append((fileName,path,key))
+    if verbose:
+        print(str(len(fileNames)-len(units))+' of '+str(len(fileNames))+' fills already computed.')
+    if len(units)==0:
+        return []
+
+    # On a cache hit, the TFS files are not even read
+    if cache is not None and not isinstance(cache,opticsCache):
+        cache=opticsCache(cache)
+    myOptics=cache.load(opticsKey) if cache is not None else None
+    if myOptics is None:
+        myOptics=preparingOpticsFromMADX(dictOpticsFromTFS(*opticsFileNames,**opticsOptions),cache=cache,
+                                         key=opticsKey)
+    initargs=(computeBBMatrix(numberOfLR),myOptics.B1.Twiss,myOptics.B2.Twiss,parameters)
+    processes=max(1,min(processes,len(units)))
+    results=[]
+    if processes==1:
+        _initWorker(*initargs)
+        for unit in units:
+            results.append(_runFill(*unit))
+            if verbose:
+                print(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=processes,initializer=_initWorker,initargs=initargs) as executor:
+            futures=[executor.submit(_runFill,*unit) for unit in units]
+            for future in as_completed(futures):
+                results.append(future.result())
+                if verbose:
+                    print(results[-1])
+    return results
+
+
+def main(arguments=None):
+    parser=argparse.ArgumentParser(description='Batch computation of the BB pattern and per-bunch results of LHC '
+                                               'fills (see the documentation of BeamBeamTools/cli.py).')
+    parser.add_argument('inputDirectory',help='directory of the snapshots and of the TFS files of the optics')
+    parser.add_argument('outputDirectory',help='directory of the results (one folder per fill)')
+    parser.add_argument('--processes',type=int,default=1,help='number of worker processes')
+    parser.add_argument('--pattern',default='*.json',help='file pattern of the snapshots')
+    parser.add_argument('--opticsFiles',nargs=4,default=['twiss_b1.tfs','twiss_b2.tfs','survey_b1.tfs','survey_b2.tfs'],
+                        metavar=('B1_TWISS','B2_TWISS','B1_SURVEY','B2_SURVEY'),help='TFS files of the optics')
+    parser.add_argument('--numberOfLR',type=int,default=20,help='number of LR per side of each IP')
+    parser.add_argument('--intensity',type=float,default=1.15e11,help='bunch intensity [protons]')
+    parser.add_argument('--emittance',type=float,default=2.5e-6,help='normalised emittance [m]')
+    parser.add_argument('--energy',type=float,default=7000.,help='beam energy [GeV]')
+    parser.add_argument('--maxMemory',type=float,default=200e6,help='memory target of the BBES generation [B]')
+    parser.add_argument('--outputs',nargs='+',default=outputs,choices=outputs,help='outputs to write')
+    parser.add_argument('--cache',help='folder of the optics cache')
+    parser.add_argument('--force',action='store_true',help='recompute the fills already computed')
+    args=parser.parse_args(arguments)
+
+    run(args.inputDirectory,args.outputDirectory,args.processes,args.pattern,args.opticsFiles,args.numberOfLR,
+        args.intensity,args.emittance,args.energy,args.maxMemory,args.outputs,args.cache,args.force)
+
+
+if __name__=='__main__':
+    main()
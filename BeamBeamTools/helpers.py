@@ -1,3 +1,22 @@
+import os
+import uuid
+import shutil
+
+
+def temporaryFolder(directory,name=None):
+    """
+    It creates a new hidden folder '.tmp_<name>' in directory and returns its path, to write files that are then 
+    moved in place with os.rename (e.g. a BBES store or an optics cache entry), so that they are never partially 
+    written. By default the name is unique, otherwise a folder left by an interrupted run is replaced.
+    Unlike tempfile.mkdtemp (mode 0700), the folder has the default permissions (umask), that are kept once renamed.
+    """
+    path=os.path.join(directory,'.tmp_'+(uuid.uuid4().hex if name is None else name))
+    if name is not None and os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+
 class utilityFunctions:
     '''
     This class contains several usuful functions. 
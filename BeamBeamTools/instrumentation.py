@@ -0,0 +1,207 @@
+import time
+import json
+import functools
+import tracemalloc
+import pandas as pd
+from dotdict import *
+
+# The profiler collecting the measurements (None: the instrumentation is disabled)
+_active=None
+
+
+class profiler:
+    """
+    It collects, while enabled, the wall time, the number of calls, the peak memory and the counters (e.g. bunches
+    processed, rows scanned, arrays allocated) of the stages of BBES and optics (see timer? and count?).
+    - memory [boolean]: sample the peak memory of each stage with tracemalloc (slower).
+    - reporter [function]: f(event) called at the end of each stage, event being a dotdict with the 'stage',
+      its 'time' [s], 'peak memory' [B] and 'counters' (see printReporter?).
+    The stages are named by their path, e.g. 'optics_BB_pattern/pattern extraction'.
+    When no profiler is enabled, the timers and counters return immediately.
+
+    ===== EXAMPLE =====
+    with profiler(memory=True) as myProfiler:
+        BBES = optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB)
+    myProfiler.report()
+    myProfiler.dump('profile.json')
+    """
+    def __init__(self,memory=False,reporter=None):
+        self.memory=memory
+        self.reporter=reporter
+        self.stages={}
+        self.counters={}
+        self._stack=[]
+        # Peak memory of the enabled period, including the stages (see _stageTimer)
+        self.childPeak=0
+        self._previous=None
+        self._startedTracing=False
+
+    def __enter__(self):
+        global _active
+        self._previous=_active
+        _active=self
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing=True
+        self._start=time.perf_counter()
+        return self
+
+    def __exit__(self,*args):
+        global _active
+        self.time=time.perf_counter()-self._start
+        if self.memory and tracemalloc.is_tracing():
+            self.childPeak=max(self.childPeak,tracemalloc.get_traced_memory()[1])
+        if self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing=False
+        _active=self._previous
+        return False
+
+    def _stagePath(self):
+        return '/'.join(e.name for e in self._stack)
+
+    def _record(self,path,wallTime,peak,counters):
+        if path not in self.stages:
+            self.stages[path]=dotdict({'calls':0,'time':0.,'peak memory':0})
+        myStage=self.stages[path]
+        myStage['calls']+=1
+        myStage['time']+=wallTime
+        myStage['peak memory']=max(myStage['peak memory'],peak)
+        if self.reporter is not None:
+            self.reporter(dotdict({'stage':path,'time':wallTime,'peak memory':peak,'counters':counters}))
+
+    def count(self,name,value=1):
+        path=self._stagePath()
+        if path not in self.counters:
+            self.counters[path]={}
+        self.counters[path][name]=self.counters[path].get(name,0)+value
+        if self._stack:
+            self._stack[-1].counters[name]=self._stack[-1].counters.get(name,0)+value
+
+    def report(self):
+        """
+        It returns a DataFrame with, for each stage, the number of calls, the total wall time [s], the peak memory
+        [MB] (if sampled) and the counters.
+        """
+        rows={}
+        for path,myStage in self.stages.items():
+            rows[path]={'calls':myStage['calls'],'time [s]':myStage['time'],
+                        'peak memory [MB]':myStage['peak memory']/1e6 if self.memory else float('nan')}
+        for path,myCounters in self.counters.items():
+            rows.setdefault(path,{}).update(myCounters)
+        return pd.DataFrame.from_dict(rows,orient='index')
+
+    def dump(self,fileName):
+        """
+        It writes the profile report to fileName, as JSON if the file name ends with '.json' and as text otherwise.
+        """
+        myReport=self.report()
+        with open(fileName,'w') as myFile:
+            if fileName.endswith('.json'):
+                json.dump({'stages':json.loads(myReport.to_json(orient='index')),
+                           'time [s]':getattr(self,'time',None),
+                           'peak memory [MB]':self.childPeak/1e6 if self.memory else None},myFile,indent=1)
+            else:
+                myFile.write(myReport.to_string()+'\n')
+
+
+class _stageTimer:
+    """
+    The context manager timing a stage of the enabled profiler (see timer?).
+    With the memory sampling, the tracemalloc peak is reset at the beginning of the stage and the peaks of the
+    nested stages are propagated to their parent.
+    """
+    def __init__(self,myProfiler,name):
+        self.profiler=myProfiler
+        self.name=name
+        self.counters={}
+        self.childPeak=0
+
+    def __enter__(self):
+        myProfiler=self.profiler
+        self.parent=myProfiler._stack[-1] if myProfiler._stack else myProfiler
+        myProfiler._stack.append(self)
+        self.path=myProfiler._stagePath()
+        if myProfiler.memory and tracemalloc.is_tracing():
+            current,peak=tracemalloc.get_traced_memory()
+            self.parent.childPeak=max(self.parent.childPeak,peak)
+            tracemalloc.reset_peak()
+            self.startMemory=current
+        self.start=time.perf_counter()
+        return self
+
+    def __exit__(self,*args):
+        wallTime=time.perf_counter()-self.start
+        myProfiler=self.profiler
+        peak=0
+        if myProfiler.memory and tracemalloc.is_tracing():
+            absolutePeak=max(tracemalloc.get_traced_memory()[1],self.childPeak)
+            self.parent.childPeak=max(self.parent.childPeak,absolutePeak)
+            peak=absolutePeak-self.startMemory
+        myProfiler._stack.pop()
+        myProfiler._record(self.path,wallTime,peak,self.counters)
+        return False
+
+
+class _noTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return False
+
+_noTimer=_noTimer()
+
+
+def timer(name):
+    """
+    It returns the context manager timing the stage name in the enabled profiler (see profiler?), or a no-op one.
+
+    ===== EXAMPLE =====
+    with timer('survey rotation'):
+        ...
+    """
+    if _active is None:
+        return _noTimer
+    return _stageTimer(_active,name)
+
+
+def timed(name=None):
+    """
+    It returns a decorator timing each call of a function as the stage name (by default the function name).
+    """
+    def decorator(function):
+        stageName=function.__name__ if name is None else name
+        @functools.wraps(function)
+        def wrapper(*args,**kwargs):
+            if _active is None:
+                return function(*args,**kwargs)
+            with _stageTimer(_active,stageName):
+                return function(*args,**kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name,value=1):
+    """
+    It increases the counter name of the current stage by value, if a profiler is enabled.
+    """
+    if _active is not None:
+        _active.count(name,value)
+
+
+def countArrays(*arrays):
+    """
+    It counts the numpy arrays allocated by the current stage ('arrays allocated' and 'bytes allocated').
+    """
+    if _active is not None:
+        _active.count('arrays allocated',len(arrays))
+        _active.count('bytes allocated',sum(e.nbytes for e in arrays))
+
+
+def printReporter(event):
+    """
+    A reporter printing one line per stage (see profiler?).
+    """
+    counters=', '.join(str(key)+'='+str(value) for key,value in event['counters'].items())
+    print('%-60s %10.4f s %10.2f MB %s'%(event['stage'],event['time'],event['peak memory']/1e6,counters))
@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+from dotdict import *
+from optics import getElementIndex
+from instrumentation import timed, count, countArrays
+
+# Classical radius [m] and rest energy [GeV] of the proton
+protonRadius=1.5346982e-18
+protonMass=0.93827208816
+
+# Complex distance to the other beam in the optics of each beam (see optics.preparingOpticsFromMADX?)
+distanceColumns={'B1':'B2-B1 complex distance','B2':'B1-B2 complex distance'}
+
+
+def _beamValue(value,beam):
+    """
+    It returns the value of the beam if value is a dict (e.g. {'B1':2.5e-6,'B2':3e-6}), value otherwise.
+    """
+    return value[beam] if isinstance(value,dict) else value
+
+
+def _intensityOfBunches(intensity,bunches):
+    """
+    It returns the intensity [protons] of the bunches from a scalar, a pd.Series indexed by bunch or an array indexed
+    by slot.
+    """
+    if np.ndim(intensity)==0:
+        return np.full(len(bunches),float(intensity))
+    if isinstance(intensity,pd.Series):
+        results=intensity.reindex(bunches).values.astype(float)
+        if np.isnan(results).any():
+            raise ValueError('The intensity of some bunches is missing.')
+        return results
+    return np.asarray(intensity,dtype=float)[bunches]
+
+
+def _roundBeamFunctions(separation2,sigma2):
+    """
+    It returns h and dh/ds of the round Gaussian beam field E(r) ~ r*h(r^2), with h(s)=(1-exp(-s/(2*sigma2)))/s,
+    without loss of precision at small separations (HO).
+    """
+    u=separation2/(2.*sigma2)
+    isSmall=u<1e-6
+    u_aux=np.where(isSmall,1.,u)
+    phi=np.where(isSmall,1.-u/2.,-np.expm1(-u_aux)/u_aux)
+    dphi=np.where(isSmall,-0.5+u/3.,(np.exp(-u_aux)*(1.+u_aux)-1.)/u_aux**2)
+    return phi/(2.*sigma2),dphi/(4.*sigma2**2)
+
+
+def _encounterRows(BBESTable,beam,Optics_BB,otherOptics_BB,rows):
+    """
+    It returns the rows, in the optics of the beam and of the other beam, of the encounters rows of the BBES table
+    (-1 if the RDV is not in the optics, see elementIndex.rowsAtS?).
+    """
+    otherBeam='B2' if beam=='B1' else 'B1'
+    ownRows=getElementIndex(Optics_BB).rowsAtS(BBESTable[beam+'_RDV_position'].values[rows])
+    otherRows=getElementIndex(otherOptics_BB).rowsAtS(BBESTable[otherBeam+'_RDV_position'].values[rows])
+    return ownRows,otherRows
+
+
+@timed()
+def longRangeEffects(BBESTable,B1Optics_BB,B2Optics_BB,B1_intensity,B2_intensity,emittance=2.5e-6,energy=7000.,
+                     removeHO=True,chunkSize=1000000):
+    """
+    It returns the beam-beam kicks and linear tune shifts of each bunch in each experiment, summed over its encounters.
+    - BBESTable [pnd DF]: the BB pattern table with the RDV positions (see BBES.optics_BB_pattern(...,output='table')?).
+    - B1Optics_BB, B2Optics_BB [pnd DF]: the prepared optics used to compute the table (see
+      optics.preparingOpticsFromMADX?), with the BETX and BETY columns.
+    - B1_intensity, B2_intensity [protons]: the bunch intensity of each beam, as a scalar, a pd.Series indexed by
+      bunch or an array indexed by slot.
+    - emittance [m]: the normalised emittance, the same for both beams or a dict {'B1':..,'B2':..}.
+    - energy [GeV]: the beam energy.
+    - removeHO [boolean]: consider only the LR encounters (set it to False to add the HO).
+    - chunkSize [integer]: number of encounters processed at once, to bound the memory.
+    The other beam is a round Gaussian beam of r.m.s. size sqrt(sqrt(BETX*BETY)*emittance/(beta*gamma)) at the RDV.
+    For each encounter, the kick of a particle on the closed orbit is computed from the complex distance between the
+    beams (see optics.preparingOpticsFromMADX?), and the tune shifts from the exact gradient of the kick at that
+    distance (-xi for the HO, +/-beta*N*r_p/(2*pi*gamma*d^2) in the far field). The counter-rotating proton beams
+    repel each other.
+    The DataFrame is indexed by (beam, bunch, IR) as the table and has the columns
+    - encounters: the number of encounters considered
+    - kick x, kick y [rad]: the sum of the kicks
+    - tune shift x, tune shift y: the sum of the linear tune shifts.
+    NB: the nested BBES structure cannot be used, since its partners are not aligned with the RDV positions.
+
+    ===== EXAMPLE =====
+    myTable = optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB,output='table')
+    myEffects = longRangeEffects(myTable,B1Optics_BB,B2Optics_BB,1.15e11,1.15e11,emittance=2.5e-6,energy=6500.)
+    myEffects.groupby(level=['beam','bunch']).sum().loc['B1']
+    """
+    for column in ['B1_RDV_position','B2_RDV_position']:
+        if column not in BBESTable:
+            raise ValueError('The BBES table has no '+column+' column (please give the optics to BB_pattern_table).')
+    gamma=energy/protonMass
+    betaGamma=np.sqrt(gamma**2-1.)
+    index=BBESTable.index
+    beamCodes=np.asarray(index.codes[0])
+    bunches=np.asarray(index.get_level_values('bunch'))
+    IRCodes=np.asarray(index.codes[2])
+    # The rows of a (beam, bunch, IR) are contiguous in the table
+    isFirst=np.ones(len(index),dtype=bool)
+    isFirst[1:]=(beamCodes[1:]!=beamCodes[:-1]) | (bunches[1:]!=bunches[:-1]) | (IRCodes[1:]!=IRCodes[:-1])
+    groups=np.cumsum(isFirst)-1
+    numberOfGroups=groups[-1]+1 if len(groups) else 0
+    sums={key:np.zeros(numberOfGroups) for key in ['encounters','kick x','kick y','tune shift x','tune shift y']}
+
+    optics={'B1':B1Optics_BB,'B2':B2Optics_BB}
+    intensity={'B1':B1_intensity,'B2':B2_intensity}
+    for beamCode,beam in enumerate(['B1','B2']):
+        otherBeam='B2' if beam=='B1' else 'B1'
+        Optics_BB=optics[beam]
+        otherOptics_BB=optics[otherBeam]
+        distance=Optics_BB[distanceColumns[beam]].values
+        BETX=Optics_BB['BETX'].values
+        BETY=Optics_BB['BETY'].values
+        otherBeta=np.sqrt(otherOptics_BB['BETX'].values*otherOptics_BB['BETY'].values)
+        otherEmittance=_beamValue(emittance,otherBeam)/betaGamma
+        beamRows=np.flatnonzero(beamCodes==beamCode)
+        for start in range(0,len(beamRows),chunkSize):
+            rows=beamRows[start:start+chunkSize]
+            ownRows,otherRows=_encounterRows(BBESTable,beam,Optics_BB,otherOptics_BB,rows)
+            myFilter=(ownRows>=0) & (otherRows>=0)
+            if removeHO:
+                myFilter&=BBESTable['RDV_index'].values[rows]!=0
+            rows=rows[myFilter]
+            ownRows=ownRows[myFilter]
+            otherRows=otherRows[myFilter]
+            d=distance[ownRows]
+            dx=d.real
+            dy=d.imag
+            h,dh=_roundBeamFunctions(dx**2+dy**2,otherBeta[otherRows]*otherEmittance)
+            k=2.*_intensityOfBunches(intensity[otherBeam],BBESTable['partner'].values[rows])*protonRadius/gamma
+            # The particle is at -d from the other beam
+            myGroups=groups[rows]
+            sums['encounters']+=np.bincount(myGroups,minlength=numberOfGroups)
+            sums['kick x']+=np.bincount(myGroups,-k*h*dx,minlength=numberOfGroups)
+            sums['kick y']+=np.bincount(myGroups,-k*h*dy,minlength=numberOfGroups)
+            sums['tune shift x']+=np.bincount(myGroups,-BETX[ownRows]/(4.*np.pi)*k*(h+2.*dx**2*dh),
+                                              minlength=numberOfGroups)
+            sums['tune shift y']+=np.bincount(myGroups,-BETY[ownRows]/(4.*np.pi)*k*(h+2.*dy**2*dh),
+                                              minlength=numberOfGroups)
+            count('encounters',len(rows))
+            countArrays(ownRows,otherRows,d,h,dh,k)
+    results=pd.DataFrame(sums,index=index[isFirst])
+    results['encounters']=results['encounters'].astype(int)
+    return results
+
+
+@timed()
+def separationTable(BBESTable,B1Optics_BB,B2Optics_BB,emittance=2.5e-6,energy=7000.,removeHO=True):
+    """
+    It returns the normalised separation of the two beams at every encounter of every bunch, gathered from the optics
+    arrays (no filtering of the optics bunch by bunch, see optics.filterOpticsDF?).
+    - BBESTable [pnd DF]: the BB pattern table with the RDV positions (see BBES.optics_BB_pattern(...,output='table')?).
+    - B1Optics_BB, B2Optics_BB [pnd DF]: the prepared optics used to compute the table, with the BETX and BETY columns.
+    - emittance [m]: the normalised emittance, the same for both beams or a dict {'B1':..,'B2':..}.
+    - energy [GeV]: the beam energy.
+    - removeHO [boolean]: remove the HO encounters.
+    The DataFrame is indexed by (beam, bunch, IR) as the table and has the columns
+    - partner, RDV_index
+    - S: the position of the RDV in the optics of the beam
+    - dx, dy, d: the separation (complex distance to the other beam) in units of the sigma of the beam
+    - dx (other beam), dy (other beam), d (other beam): the separation in units of the sigma of the other beam.
+
+    ===== EXAMPLE =====
+    mySeparations = separationTable(myTable,B1Optics_BB,B2Optics_BB,emittance=2.5e-6,energy=6500.)
+    minimumSeparation(mySeparations).query('d<10')
+    """
+    for column in ['B1_RDV_position','B2_RDV_position']:
+        if column not in BBESTable:
+            raise ValueError('The BBES table has no '+column+' column (please give the optics to BB_pattern_table).')
+    betaGamma=np.sqrt((energy/protonMass)**2-1.)
+    beamCodes=np.asarray(BBESTable.index.codes[0])
+    optics={'B1':B1Optics_BB,'B2':B2Optics_BB}
+    results=[]
+    for beamCode,beam in enumerate(['B1','B2']):
+        otherBeam='B2' if beam=='B1' else 'B1'
+        Optics_BB=optics[beam]
+        otherOptics_BB=optics[otherBeam]
+        rows=np.flatnonzero(beamCodes==beamCode)
+        ownRows,otherRows=_encounterRows(BBESTable,beam,Optics_BB,otherOptics_BB,rows)
+        myFilter=(ownRows>=0) & (otherRows>=0)
+        if removeHO:
+            myFilter&=BBESTable['RDV_index'].values[rows]!=0
+        rows=rows[myFilter]
+        ownRows=ownRows[myFilter]
+        otherRows=otherRows[myFilter]
+        d=Optics_BB[distanceColumns[beam]].values[ownRows]
+        mySeparations=pd.DataFrame({'partner':BBESTable['partner'].values[rows],
+                                    'RDV_index':BBESTable['RDV_index'].values[rows],
+                                    'S':BBESTable[beam+'_RDV_position'].values[rows]},
+                                   index=BBESTable.index[rows])
+        for suffix,myOptics,myRows,myBeam in [('',Optics_BB,ownRows,beam),
+                                              (' (other beam)',otherOptics_BB,otherRows,otherBeam)]:
+            myEmittance=_beamValue(emittance,myBeam)/betaGamma
+            dx=d.real/np.sqrt(myOptics['BETX'].values[myRows]*myEmittance)
+            dy=d.imag/np.sqrt(myOptics['BETY'].values[myRows]*myEmittance)
+            mySeparations['dx'+suffix]=dx
+            mySeparations['dy'+suffix]=dy
+            mySeparations['d'+suffix]=np.sqrt(dx**2+dy**2)
+        results.append(mySeparations)
+        count('encounters',len(rows))
+    return pd.concat(results)
+
+
+@timed()
+def minimumSeparation(separations,column='d',by=['beam','bunch']):
+    """
+    It returns the minimum separation of each bunch (or of each group of the levels by, e.g. ['beam','bunch','IR']) 
+    of a separation table (see separationTable?), with the IR, RDV_index, partner and S where it occurs.
+
+    ===== EXAMPLE =====
+    myMinimum = minimumSeparation(separationTable(myTable,B1Optics_BB,B2Optics_BB,energy=6500.))
+    myMinimum[myMinimum['d']<8.]
+    """
+    index=separations.index
+    codes=[np.asarray(index.codes[index.names.index(level)]) for level in by]
+    values=separations[column].values
+    # Sorted by group and then by separation: the first row of each group is its minimum
+    order=np.lexsort([values]+codes[::-1])
+    isFirst=np.ones(len(order),dtype=bool)
+    for myCodes in codes:
+        sortedCodes=myCodes[order]
+        isFirst[1:]&=sortedCodes[1:]==sortedCodes[:-1]
+    isFirst[1:]=~isFirst[1:]
+    rows=order[isFirst]
+    results=pd.DataFrame({column:values[rows]},index=index[rows].droplevel([e for e in index.names if e not in by]))
+    for key in ['IR','RDV_index','partner','S']:
+        if key in by:
+            continue
+        results[key]=index.get_level_values(key)[rows] if key in index.names else separations[key].values[rows]
+    count('rows scanned',len(values))
+    return results
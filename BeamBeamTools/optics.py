@@ -1,6 +1,123 @@
 import numpy as np
 import pandas as pd
+import weakref
 from dotdict import *
+from opticsCache import opticsCache
+from instrumentation import timer, timed, count, countArrays
+
+# Element families used to filter the optics (see preparingOpticsFromMADX?)
+elementFamilies={'MB.B1':r'^MB\..*B1$',
+                 'MB.B2':r'^MB\..*B2$',
+                 'E.':r'^E\.',
+                 'BBLR':'BBLR',
+                 'S.':r'^S\.'}
+
+
+class elementIndex:
+    """
+    An element-classification index of an optics DataFrame (twiss or survey), built once per optics:
+    - NAME: the NAME column as a pandas Categorical
+    - families: the boolean masks of the element families (see elementFamilies)
+    - rows: a dict name >> integer row of its first occurrence
+    The regular expressions are evaluated only once per distinct name and the masks are cached.
+    Use getElementIndex(opticsDF) to reuse the index of a DataFrame across the modules.
+
+    ===== EXAMPLE =====
+    myIndex = getElementIndex(B1_twiss)
+    B1_twiss[myIndex.BBFilter('B1')]
+    B1_twiss['MUX'].values[myIndex.rows['IP5']]
+    """
+    def __init__(self,opticsDF):
+        self.length=len(opticsDF)
+        # Copy of the names, to check that the DataFrame has not been modified (see isValid?)
+        self._names=np.array(opticsDF['NAME'].values,dtype=object)
+        self.NAME=pd.Categorical(self._names)
+        self.codes=np.asarray(self.NAME.codes)
+        categories=np.asarray(self.NAME.categories,dtype=object)
+        aux,firstRows=np.unique(self.codes,return_index=True)
+        myRows=aux>=0
+        self.rows=dict(zip(categories[aux[myRows]],firstRows[myRows]))
+        self._masks={}
+        # Index (S) of the DataFrame, sorted at the first call of rowsAtS
+        self._index=np.asarray(opticsDF.index)
+        self._sortedIndex=None
+
+    def isValid(self,opticsDF):
+        """
+        It returns True if the NAME column and the index of opticsDF are still the ones of the element index, i.e. if 
+        the DataFrame has not been sorted, reindexed or renamed since the index was built.
+        """
+        return (len(opticsDF)==self.length and np.array_equal(np.asarray(opticsDF.index),self._index) and
+                np.array_equal(np.asarray(opticsDF['NAME'].values,dtype=object),self._names))
+
+    def mask(self,pattern):
+        """
+        It returns the boolean mask of the elements whose NAME matches the regular expression pattern.
+        """
+        if pattern not in self._masks:
+            categoryMask=pd.Series(self.NAME.categories).str.contains(pattern).values.astype(bool)
+            # The last entry is used for the missing names (code -1)
+            self._masks[pattern]=np.append(categoryMask,False)[self.codes]
+        return self._masks[pattern]
+
+    @property
+    def families(self):
+        return dotdict({family: self.mask(pattern) for family,pattern in elementFamilies.items()})
+
+    def BBFilter(self,beam):
+        """
+        It returns the mask of the elements kept to compute the BB related values of the beam ('B1' or 'B2'), i.e. 
+        the main dipoles of the beam and the E., S. and BBLR elements.
+        """
+        return (self.mask(elementFamilies['MB.'+beam]) | self.mask(elementFamilies['E.']) | 
+                self.mask(elementFamilies['BBLR']) | self.mask(elementFamilies['S.']))
+
+    def rowsAtS(self,S):
+        """
+        It returns the integer rows of the elements at the positions S (index of the DataFrame), -1 if not found.
+        """
+        if self._sortedIndex is None:
+            self._order=np.argsort(self._index,kind='stable')
+            self._sortedIndex=self._index[self._order]
+        S=np.asarray(S,dtype=float)
+        if len(self._sortedIndex)==0:
+            return np.full(len(S),-1)
+        k=np.minimum(np.searchsorted(self._sortedIndex,S),len(self._sortedIndex)-1)
+        return np.where(self._sortedIndex[k]==S,self._order[k],-1)
+
+    def isName(self,name):
+        """
+        It returns the boolean mask of the elements called name.
+        """
+        try:
+            return self.codes==self.NAME.categories.get_loc(name)
+        except KeyError:
+            return np.zeros(self.length,dtype=bool)
+
+
+_elementIndexCache={}
+
+def getElementIndex(opticsDF,cache=True):
+    """
+    It returns the element index of an optics DataFrame (see elementIndex?), building it only at the first call.
+    The index is kept as long as the DataFrame exists and is rebuilt if the DataFrame has been modified in place 
+    (e.g. sort_values(inplace=True), a new NAME column or loc edits, see elementIndex.isValid?).
+    - cache [boolean]: keep the index. Set it to False for a DataFrame used once (e.g. the MAD-X optics in 
+      preparingOpticsFromMADX?), whose index can be larger than the DataFrame itself.
+    """
+    key=id(opticsDF)
+    if cache and key in _elementIndexCache:
+        myReference,myIndex=_elementIndexCache[key]
+        if myReference() is opticsDF and myIndex.isValid(opticsDF):
+            return myIndex
+    with timer('element index'):
+        myIndex=elementIndex(opticsDF)
+        count('rows scanned',len(opticsDF))
+    if not cache:
+        return myIndex
+    _elementIndexCache[key]=(weakref.ref(opticsDF,lambda reference,key=key: _elementIndexCache.pop(key,None)),myIndex)
+    return myIndex
+
 
 def dictOpticsFromMADX(B1_twiss,B2_twiss,B1_survey,B2_survey):
     """
@@ -11,42 +128,61 @@ def dictOpticsFromMADX(B1_twiss,B2_twiss,B1_survey,B2_survey):
     B2opticsDic = dotdict({'Twiss':B2_twiss,'Survey':B2_survey})
     return dotdict({'B1':B1opticsDic,'B2':B2opticsDic})
     
-def preparingOpticsFromMADX(MADX_DICT):
+def _assignPhaseAdvance(twiss_filter,muX_IP1L,muY_IP1L,muX_IP5,muY_IP5):
     """
-    This function makes all the required optics post process needed to compute BB related values. 
-    The input is a dotdict containing the survey and the twiss from MAD-X for each beam. 
-    The output has the same structure, but contains post-processed data. 
-    
-    NB: as the input is a dotdict, please prepare the optics data in such a structure using _dictOpticsFromMADX
-    
-    ===== EXAMPLE =====
-    MADX_DICT = preparingOpticsFromMADX(dictOpticsFromMADX(B1_twiss,B2_twiss,B1_survey,B2_survey))
+    It adds to the filtered twiss the phase advance of the elements on the left/right side of IP1 and IP5 wrt the IP 
+    ('Delta MUX/MUY') and its ideal value ('Ideal MUX/MUY'). The other elements are set to 0 (see _phaseAdvance?).
     """
-    # Mirroring
-    B1_mirrored=MADX_DICT.B1.Twiss.copy()
-    B1_mirrored.index=B1_mirrored.index-MADX_DICT.B1.Twiss.index[-1]
-    B1_mirrored['S']=B1_mirrored['S']-MADX_DICT.B1.Twiss.index[-1]
-
-    B2_mirrored=MADX_DICT.B2.Twiss.copy()
-    B2_mirrored.index=B2_mirrored.index-MADX_DICT.B2.Twiss.index[-1]
-    B2_mirrored['S']=B2_mirrored['S']-MADX_DICT.B2.Twiss.index[-1]
-
-    B1=pd.concat([B1_mirrored,MADX_DICT.B1.Twiss])
-    B2=pd.concat([B2_mirrored,MADX_DICT.B2.Twiss])
+    DeltaMUX,DeltaMUY,ideal=_phaseAdvance(twiss_filter['NAME'],twiss_filter['MUX'].values,twiss_filter['MUY'].values,
+                                          muX_IP1L,muY_IP1L,muX_IP5,muY_IP5)
+    twiss_filter['Delta MUX']=DeltaMUX
+    twiss_filter['Delta MUY']=DeltaMUY
+    twiss_filter['Ideal MUX']=ideal
+    twiss_filter['Ideal MUY']=ideal
 
 
-    B1SurveyMirrored=MADX_DICT.B1.Survey.copy()
-    B1SurveyMirrored.index=B1SurveyMirrored.index-MADX_DICT.B1.Survey.index[-1]
-    B1SurveyMirrored['S']=B1SurveyMirrored['S']-MADX_DICT.B1.Survey.index[-1]
-
-    B2SurveyMirrored=MADX_DICT.B2.Survey.copy()
-    B2SurveyMirrored.index=B2SurveyMirrored.index-MADX_DICT.B2.Survey.index[-1]
-    B2SurveyMirrored['S']=B2SurveyMirrored['S']-MADX_DICT.B2.Survey.index[-1]
+def _phaseAdvance(NAME,MUX,MUY,muX_IP1L,muY_IP1L,muX_IP5,muY_IP5):
+    """
+    It returns the phase advance (X,Y) of the elements on the left/right side of IP1 and IP5 wrt the IP and its ideal 
+    value, 0 for the other elements. The elements are classified by IP side from their NAME in a single pass.
+    MUX and MUY can be stacked by scenario (N x elements), the reference phases being then arrays of N elements.
+    """
+    side=pd.Series(NAME).str.extract('(IP1_L|IP1_R|IP5_L|IP5_R)',expand=False).values
+    sides=['IP1_L','IP1_R','IP5_L','IP5_R']
+    # Reference phase advance (X,Y) and ideal phase advance of each side, the last one for the other elements
+    muX_references=np.stack(np.broadcast_arrays(muX_IP1L,0.,muX_IP5,muX_IP5,0.),axis=-1)
+    muY_references=np.stack(np.broadcast_arrays(muY_IP1L,0.,muY_IP5,muY_IP5,0.),axis=-1)
+    idealReferences=np.array([-0.25,0.25,-0.25,0.25,0.])
+    sideCode=np.full(len(side),len(sides))
+    for k,key in enumerate(sides):
+        sideCode[side==key]=k
+    isOnSide=sideCode<len(sides)
+    DeltaMUX=np.where(isOnSide,MUX-muX_references[...,sideCode],0.)
+    DeltaMUY=np.where(isOnSide,MUY-muY_references[...,sideCode],0.)
+    return DeltaMUX,DeltaMUY,idealReferences[sideCode]
+
+
+def _mirroredRows(opticsDF,myFilter):
+    """
+    It returns the rows myFilter of the optics preceded by the same rows mirrored, i.e. shifted by the last S of the 
+    optics: the same as pd.concat([mirrored optics,opticsDF])[np.tile(myFilter,2)], but only the selected rows are
+    copied (once, in the returned DataFrame).
+    """
+    rows=np.flatnonzero(myFilter)
+    # take returns a new DataFrame (not flagged as a copy of opticsDF as iloc): it is modified in place
+    results=opticsDF.take(np.concatenate([rows,rows]))
+    myIndex=opticsDF.index[rows]
+    results.index=(myIndex-opticsDF.index[-1]).append(myIndex)
+    S=opticsDF['S'].values[rows]
+    results['S']=np.concatenate([S-opticsDF.index[-1],S])
+    return results
 
-    # B1/2 survey
-    B1_survey=pd.concat([B1SurveyMirrored,MADX_DICT.B1.Survey])
-    B2_survey=pd.concat([B2SurveyMirrored,MADX_DICT.B2.Survey])
 
+def _preparingSurveys(B1_survey,B2_survey):
+    """
+    It returns the filtered and mirrored surveys of B1 and B2 with the distance between the two beams ('myDeltaX', 
+    'myDeltaZ') in the reference frame of each beam (see preparingOpticsFromMADX?).
+    """
     #######========== SURVEY ==========#######
 
     # Filtering B1 and B2 DFs, in order to fullfill two conditions:
@@ -54,69 +190,101 @@ def preparingOpticsFromMADX(MADX_DICT):
     # same length but not the same s)
     # - in the arcs the mechanical distance of the two reference orbits in s^{B1}_i and s^{B2}_i is 19.4 mm.
 
-    myFilter=((B1_survey['NAME'].str.contains('^MB\..*B1$')) | 
-              (B1_survey['NAME'].str.contains('^E\.')) |
-              (B1_survey['NAME'].str.contains('BBLR')) |
-              (B1_survey['NAME'].str.contains('^S\.')))
+    # The rows are filtered before mirroring (see _mirroredRows?)
+    with timer('mirroring'):
+        B1_survey_filter=_mirroredRows(B1_survey,getElementIndex(B1_survey,cache=False).BBFilter('B1'))
 
-    B1_survey_filter=B1_survey[myFilter].copy()
+        B2_survey_filter=_mirroredRows(B2_survey,getElementIndex(B2_survey,cache=False).BBFilter('B2'))
+        count('rows scanned',len(B1_survey)+len(B2_survey))
 
-    myFilter=((B2_survey['NAME'].str.contains('^MB\..*B2$')) | 
-              (B2_survey['NAME'].str.contains('^E\.')) |
-              (B2_survey['NAME'].str.contains('BBLR')) |
-              (B2_survey['NAME'].str.contains('^S\.')))
+    # DeltaX and Delta Z computation from survey, taking into account the angle Theta
+    with timer('survey rotation'):
+        DeltaX=B2_survey_filter['X'].values-B1_survey_filter['X'].values
+        DeltaY=B2_survey_filter['Z'].values-B1_survey_filter['Z'].values
 
-    B2_survey_filter=B2_survey[myFilter].copy()
+        meanTheta=(B1_survey_filter['THETA'].values+B2_survey_filter['THETA'].values)/2.
 
-    # DeltaX and Delta Z computation from survey, taking into account the angle Theta
+        myDeltaX=np.cos(meanTheta)*DeltaX-np.sin(meanTheta)*DeltaY
+        myDeltaZ=np.sin(meanTheta)*DeltaX+np.cos(meanTheta)*DeltaY
 
-    DeltaX=B2_survey_filter['X'].values-B1_survey_filter['X'].values
-    DeltaY=B2_survey_filter['Z'].values-B1_survey_filter['Z'].values
+        B1_survey_filter['myDeltaZ']=myDeltaZ
+        B1_survey_filter['myDeltaX']=myDeltaX
 
-    meanTheta=(B1_survey_filter['THETA'].values+B2_survey_filter['THETA'].values)/2.
+        DeltaX=-B2_survey_filter['X'].values+B1_survey_filter['X'].values
+        DeltaY=-B2_survey_filter['Z'].values+B1_survey_filter['Z'].values
 
-    myDeltaX=np.cos(meanTheta)*DeltaX-np.sin(meanTheta)*DeltaY
-    myDeltaZ=np.sin(meanTheta)*DeltaX+np.cos(meanTheta)*DeltaY
+        meanTheta=(B1_survey_filter['THETA'].values+B2_survey_filter['THETA'].values)/2.
 
-    B1_survey_filter['myDeltaZ']=myDeltaZ
-    B1_survey_filter['myDeltaX']=myDeltaX
+        myDeltaX=np.cos(meanTheta)*DeltaX-np.sin(meanTheta)*DeltaY
+        myDeltaZ=np.sin(meanTheta)*DeltaX+np.cos(meanTheta)*DeltaY
 
-    DeltaX=-B2_survey_filter['X'].values+B1_survey_filter['X'].values
-    DeltaY=-B2_survey_filter['Z'].values+B1_survey_filter['Z'].values
+        B2_survey_filter['myDeltaZ']=myDeltaZ
+        B2_survey_filter['myDeltaX']=myDeltaX
 
-    meanTheta=(B1_survey_filter['THETA'].values+B2_survey_filter['THETA'].values)/2.
+    return B1_survey_filter,B2_survey_filter
 
-    myDeltaX=np.cos(meanTheta)*DeltaX-np.sin(meanTheta)*DeltaY
-    myDeltaZ=np.sin(meanTheta)*DeltaX+np.cos(meanTheta)*DeltaY
 
-    B2_survey_filter['myDeltaZ']=myDeltaZ
-    B2_survey_filter['myDeltaX']=myDeltaX
+@timed()
+def preparingOpticsFromMADX(MADX_DICT,cache=None,key=None):
+    """
+    This function makes all the required optics post process needed to compute BB related values. 
+    The input is a dotdict containing the survey and the twiss from MAD-X for each beam. 
+    The output has the same structure, but contains post-processed data. 
+    
+    NB: as the input is a dotdict, please prepare the optics data in such a structure using _dictOpticsFromMADX
+
+    Optionally, the prepared optics can be kept in an on-disk cache (see opticsCache?), keyed by the content of the 
+    input DataFrames: "cache" can be an opticsCache or the folder of the cache. The key of the entry can be given 
+    instead (e.g. opticsCache.keyFromFiles? of the source files), to skip the hashing of the DataFrames.
+    
+    ===== EXAMPLE =====
+    MADX_DICT = preparingOpticsFromMADX(dictOpticsFromMADX(B1_twiss,B2_twiss,B1_survey,B2_survey))
+    """
+    if cache is not None:
+        if not isinstance(cache,opticsCache):
+            cache=opticsCache(cache)
+        if key is None:
+            key=cache.key(MADX_DICT)
+        results=cache.load(key)
+        if results is None:
+            results=preparingOpticsFromMADX(MADX_DICT)
+            cache.store(key,results)
+        return results
+
+    B1_survey_filter,B2_survey_filter=_preparingSurveys(MADX_DICT.B1.Survey,MADX_DICT.B2.Survey)
+    # The element indices of the MAD-X optics are used only here: they are not kept (see getElementIndex?)
+    B1_index=getElementIndex(MADX_DICT.B1.Twiss,cache=False)
+    B2_index=getElementIndex(MADX_DICT.B2.Twiss,cache=False)
 
     # Phase advance at the IPS B1
 
-    muX_IP1L = B1[B1['NAME']=='IP1.L1']['MUX'].values[0]
-    muY_IP1L = B1[B1['NAME']=='IP1.L1']['MUY'].values[0]
+    myRows=B1_index.rows
+    MUX=MADX_DICT.B1.Twiss['MUX'].values
+    MUY=MADX_DICT.B1.Twiss['MUY'].values
 
-    muX_IP2 = B1[B1['NAME']=='IP2']['MUX'].values[0]
-    muY_IP2 = B1[B1['NAME']=='IP2']['MUY'].values[0]
+    muX_IP1L = MUX[myRows['IP1.L1']]
+    muY_IP1L = MUY[myRows['IP1.L1']]
 
-    muX_IP3 = B1[B1['NAME']=='IP3']['MUX'].values[0]
-    muY_IP3 = B1[B1['NAME']=='IP3']['MUY'].values[0]
+    muX_IP2 = MUX[myRows['IP2']]
+    muY_IP2 = MUY[myRows['IP2']]
 
-    muX_IP4 = B1[B1['NAME']=='IP4']['MUX'].values[0]
-    muY_IP4 = B1[B1['NAME']=='IP4']['MUY'].values[0]
+    muX_IP3 = MUX[myRows['IP3']]
+    muY_IP3 = MUY[myRows['IP3']]
 
-    muX_IP5 = B1[B1['NAME']=='IP5']['MUX'].values[0]
-    muY_IP5 = B1[B1['NAME']=='IP5']['MUY'].values[0]
+    muX_IP4 = MUX[myRows['IP4']]
+    muY_IP4 = MUY[myRows['IP4']]
 
-    muX_IP6 = B1[B1['NAME']=='IP6']['MUX'].values[0]
-    muY_IP6 = B1[B1['NAME']=='IP6']['MUY'].values[0]
+    muX_IP5 = MUX[myRows['IP5']]
+    muY_IP5 = MUY[myRows['IP5']]
 
-    muX_IP7 = B1[B1['NAME']=='IP7']['MUX'].values[0]
-    muY_IP7 = B1[B1['NAME']=='IP7']['MUY'].values[0]
+    muX_IP6 = MUX[myRows['IP6']]
+    muY_IP6 = MUY[myRows['IP6']]
 
-    muX_IP8 = B1[B1['NAME']=='IP8']['MUX'].values[0]
-    muY_IP8 = B1[B1['NAME']=='IP8']['MUY'].values[0]
+    muX_IP7 = MUX[myRows['IP7']]
+    muY_IP7 = MUY[myRows['IP7']]
+
+    muX_IP8 = MUX[myRows['IP8']]
+    muY_IP8 = MUY[myRows['IP8']]
 
 
 
@@ -127,101 +295,47 @@ def preparingOpticsFromMADX(MADX_DICT):
     # same length but not the same s)
     # - in the arcs the mechanical distance of the two reference orbits in s^{B1}_i and s^{B2}_i is 19.4 mm.
 
-    myFilter=((B1['NAME'].str.contains('^MB\..*B1$')) | 
-              (B1['NAME'].str.contains('^E\.')) |
-              (B1['NAME'].str.contains('BBLR')) |
-              (B1['NAME'].str.contains('^S\.')))
-
-    B1_twiss_filter=B1[myFilter].copy()
-
-    B1_twiss_filter['Delta MUX'] = 0
-    B1_twiss_filter['Delta MUY'] = 0
-
-    B1_twiss_filter['Ideal MUX'] = 0
-    B1_twiss_filter['Ideal MUY'] = 0
-
-    for i in B1_twiss_filter.index:
-        if 'IP1_L' in B1_twiss_filter.loc[i,'NAME']:
-            B1_twiss_filter.loc[i,'Delta MUX'] = -(muX_IP1L-B1_twiss_filter.loc[i,'MUX'])
-            B1_twiss_filter.loc[i,'Ideal MUX'] = -0.25
-            B1_twiss_filter.loc[i,'Delta MUY'] = -(muY_IP1L-B1_twiss_filter.loc[i,'MUY'])
-            B1_twiss_filter.loc[i,'Ideal MUY'] = -0.25
-        if 'IP1_R' in B1_twiss_filter.loc[i,'NAME']:
-            B1_twiss_filter.loc[i,'Delta MUX'] = B1_twiss_filter.loc[i,'MUX']
-            B1_twiss_filter.loc[i,'Ideal MUX'] = 0.25
-            B1_twiss_filter.loc[i,'Delta MUY'] = B1_twiss_filter.loc[i,'MUX']
-            B1_twiss_filter.loc[i,'Ideal MUY'] = 0.25
-        if 'IP5_L' in B1_twiss_filter.loc[i,'NAME']:
-            B1_twiss_filter.loc[i,'Delta MUX'] = B1_twiss_filter.loc[i,'MUX'] - muX_IP5
-            B1_twiss_filter.loc[i,'Ideal MUX'] = -0.25
-            B1_twiss_filter.loc[i,'Delta MUY'] = B1_twiss_filter.loc[i,'MUY'] - muY_IP5
-            B1_twiss_filter.loc[i,'Ideal MUY'] = -0.25
-        if 'IP5_R' in B1_twiss_filter.loc[i,'NAME']:
-            B1_twiss_filter.loc[i,'Delta MUX'] = B1_twiss_filter.loc[i,'MUX'] - muX_IP5
-            B1_twiss_filter.loc[i,'Ideal MUX'] = 0.25
-            B1_twiss_filter.loc[i,'Delta MUY'] = B1_twiss_filter.loc[i,'MUY'] - muY_IP5
-            B1_twiss_filter.loc[i,'Ideal MUY'] = 0.25
-
-    myFilter=((B2['NAME'].str.contains('^MB\..*B2$')) | 
-              (B2['NAME'].str.contains('^E\.')) |
-              (B2['NAME'].str.contains('BBLR')) |
-              (B2['NAME'].str.contains('^S\.')))
-
-    B2_twiss_filter=B2[myFilter].copy()
-
-    B2_twiss_filter['Delta MUX'] = 0
-    B2_twiss_filter['Delta MUY'] = 0
-
-    B2_twiss_filter['Ideal MUX'] = 0
-    B2_twiss_filter['Ideal MUY'] = 0
+    with timer('mirroring'):
+        B1_twiss_filter=_mirroredRows(MADX_DICT.B1.Twiss,B1_index.BBFilter('B1'))
+        count('rows scanned',len(MADX_DICT.B1.Twiss))
+
+    _assignPhaseAdvance(B1_twiss_filter,muX_IP1L,muY_IP1L,muX_IP5,muY_IP5)
+
+    with timer('mirroring'):
+        B2_twiss_filter=_mirroredRows(MADX_DICT.B2.Twiss,B2_index.BBFilter('B2'))
+        count('rows scanned',len(MADX_DICT.B2.Twiss))
 
     # Phase advance at the IPS B2
 
-    muX_IP1L = B2[B2['NAME']=='IP1.L1']['MUX'].values[0]
-    muY_IP1L = B2[B2['NAME']=='IP1.L1']['MUY'].values[0]
-
-    muX_IP2 = B2[B2['NAME']=='IP2']['MUX'].values[0]
-    muY_IP2 = B2[B2['NAME']=='IP2']['MUY'].values[0]
-
-    muX_IP3 = B2[B2['NAME']=='IP3']['MUX'].values[0]
-    muY_IP3 = B2[B2['NAME']=='IP3']['MUY'].values[0]
-
-    muX_IP4 = B2[B2['NAME']=='IP4']['MUX'].values[0]
-    muY_IP4 = B2[B2['NAME']=='IP4']['MUY'].values[0]
-
-    muX_IP5 = B2[B2['NAME']=='IP5']['MUX'].values[0]
-    muY_IP5 = B2[B2['NAME']=='IP5']['MUY'].values[0]
-
-    muX_IP6 = B2[B2['NAME']=='IP6']['MUX'].values[0]
-    muY_IP6 = B2[B2['NAME']=='IP6']['MUY'].values[0]
-
-    muX_IP7 = B2[B2['NAME']=='IP7']['MUX'].values[0]
-    muY_IP7 = B2[B2['NAME']=='IP7']['MUY'].values[0]
-
-    muX_IP8 = B2[B2['NAME']=='IP8']['MUX'].values[0]
-    muY_IP8 = B2[B2['NAME']=='IP8']['MUY'].values[0]
-
-    for i in B2_twiss_filter.index:
-        if 'IP1_L' in B2_twiss_filter.loc[i,'NAME']:
-            B2_twiss_filter.loc[i,'Delta MUX'] = -(muX_IP1L-B1_twiss_filter.loc[i,'MUX'])
-            B2_twiss_filter.loc[i,'Ideal MUX'] = -0.25
-            B2_twiss_filter.loc[i,'Delta MUY'] = -(muY_IP1L-B1_twiss_filter.loc[i,'MUY'])
-            B2_twiss_filter.loc[i,'Ideal MUY'] = -0.25
-        if 'IP1_R' in B2_twiss_filter.loc[i,'NAME']:
-            B2_twiss_filter.loc[i,'Delta MUX'] = B1_twiss_filter.loc[i,'MUX']
-            B2_twiss_filter.loc[i,'Ideal MUX'] = 0.25
-            B2_twiss_filter.loc[i,'Delta MUY'] = B1_twiss_filter.loc[i,'MUX']
-            B2_twiss_filter.loc[i,'Ideal MUY'] = 0.25
-        if 'IP5_L' in B2_twiss_filter.loc[i,'NAME']:
-            B2_twiss_filter.loc[i,'Delta MUX'] = B2_twiss_filter.loc[i,'MUX'] - muX_IP5
-            B2_twiss_filter.loc[i,'Ideal MUX'] = -0.25
-            B2_twiss_filter.loc[i,'Delta MUY'] = B2_twiss_filter.loc[i,'MUY'] - muY_IP5
-            B2_twiss_filter.loc[i,'Ideal MUY'] = -0.25
-        if 'IP5_R' in B2_twiss_filter.loc[i,'NAME']:
-            B2_twiss_filter.loc[i,'Delta MUX'] = B2_twiss_filter.loc[i,'MUX'] - muX_IP5
-            B2_twiss_filter.loc[i,'Ideal MUX'] = 0.25
-            B2_twiss_filter.loc[i,'Delta MUY'] = B2_twiss_filter.loc[i,'MUY'] - muY_IP5
-            B2_twiss_filter.loc[i,'Ideal MUY'] = 0.25
+    myRows=B2_index.rows
+    MUX=MADX_DICT.B2.Twiss['MUX'].values
+    MUY=MADX_DICT.B2.Twiss['MUY'].values
+
+    muX_IP1L = MUX[myRows['IP1.L1']]
+    muY_IP1L = MUY[myRows['IP1.L1']]
+
+    muX_IP2 = MUX[myRows['IP2']]
+    muY_IP2 = MUY[myRows['IP2']]
+
+    muX_IP3 = MUX[myRows['IP3']]
+    muY_IP3 = MUY[myRows['IP3']]
+
+    muX_IP4 = MUX[myRows['IP4']]
+    muY_IP4 = MUY[myRows['IP4']]
+
+    muX_IP5 = MUX[myRows['IP5']]
+    muY_IP5 = MUY[myRows['IP5']]
+
+    muX_IP6 = MUX[myRows['IP6']]
+    muY_IP6 = MUY[myRows['IP6']]
+
+    muX_IP7 = MUX[myRows['IP7']]
+    muY_IP7 = MUY[myRows['IP7']]
+
+    muX_IP8 = MUX[myRows['IP8']]
+    muY_IP8 = MUY[myRows['IP8']]
+
+    _assignPhaseAdvance(B2_twiss_filter,muX_IP1L,muY_IP1L,muX_IP5,muY_IP5)
 
 
     B1_twiss_filter['myDeltaX']=B2_twiss_filter['X'].values-B1_twiss_filter['X'].values
@@ -245,29 +359,166 @@ def preparingOpticsFromMADX(MADX_DICT):
     return dotdict({'B1':B1opticsDic,'B2':B2opticsDic})
 
 
+@timed()
+def preparingOpticsScan(B1_twiss,B2_twiss,B1_survey,B2_survey):
+    """
+    It prepares at once the optics of N scenarios sharing the same survey and element sequence, e.g. a crossing-angle 
+    or beta* levelling scan (see preparingOpticsFromMADX?).
+    - B1_twiss, B2_twiss [list or dict of pnd DF]: the twiss of the scenarios (as a dict: scenario name >> twiss).
+    - B1_survey, B2_survey [pnd DF]: the survey of each beam.
+    The filtered rows, the survey rotation and the element classification are computed only once, the IP reference 
+    phases, the phase advances and the distances between the beams for all the scenarios in one vectorized pass.
+    The output structure is:
+    - scenarios: the scenario names (or numbers)
+    - BEAM >> Survey: the prepared survey of the beam
+    - BEAM >> Twiss: the filtered (and mirrored) twiss columns that do not depend on the scenario (NAME, S, ...)
+    - BEAM >> Scan >> COLUMN: the (N x elements) array of each float column of the twiss (X, Y, MUX, MUY, BETX...) 
+      and of 'Delta MUX', 'Delta MUY', 'Ideal MUX', 'Ideal MUY', 'myDeltaX', 'myDeltaZ' and 'B2-B1 complex distance'
+      (B1) or 'B1-B2 complex distance' (B2).
+    The Twiss can be used as the optics of all the scenarios in BBES.optics_BB_pattern (same S and NAME). 
+    The prepared optics of a single scenario are obtained with opticsOfScenario?.
+
+    ===== EXAMPLE =====
+    myScan = preparingOpticsScan({angle: B1_twiss[angle] for angle in angles},
+                                 {angle: B2_twiss[angle] for angle in angles},B1_survey,B2_survey)
+    np.abs(myScan.B1.Scan['B2-B1 complex distance'])
+    """
+    if isinstance(B1_twiss,dict):
+        scenarios=list(B1_twiss.keys())
+        B1_twiss=[B1_twiss[e] for e in scenarios]
+        B2_twiss=[B2_twiss[e] for e in scenarios]
+    else:
+        scenarios=list(range(len(B1_twiss)))
+    B1_survey_filter,B2_survey_filter=_preparingSurveys(B1_survey,B2_survey)
+
+    results=dotdict({'scenarios':scenarios})
+    for beam,twissList,survey_filter in [('B1',B1_twiss,B1_survey_filter),('B2',B2_twiss,B2_survey_filter)]:
+        reference=twissList[0]
+        for opticsDF in twissList[1:]:
+            if len(opticsDF)!=len(reference) or not np.array_equal(opticsDF['NAME'].values,reference['NAME'].values):
+                raise ValueError('The '+beam+' twiss of the scenarios must have the same element sequence.')
+        myIndex=getElementIndex(reference)
+        myFilter=myIndex.BBFilter(beam)
+        with timer('mirroring'):
+            twiss_filter=_mirroredRows(reference,myFilter)
+            rows=np.flatnonzero(myFilter)
+            rows=np.concatenate([rows,rows])
+            scanColumns=[e for e in reference.columns if e!='S' and reference[e].dtype.kind in 'fc']
+            myScan=dotdict({column:np.stack([opticsDF[column].values[rows] for opticsDF in twissList])
+                            for column in scanColumns})
+            count('rows scanned',len(reference)*len(twissList))
+
+        # Phase advance at the IPs of each scenario
+        myRows=myIndex.rows
+        muX_IP1L,muY_IP1L,muX_IP5,muY_IP5=[np.array([opticsDF[column].values[myRows[IP]] for opticsDF in twissList]) 
+                                           for IP,column in [('IP1.L1','MUX'),('IP1.L1','MUY'),
+                                                             ('IP5','MUX'),('IP5','MUY')]]
+        DeltaMUX,DeltaMUY,ideal=_phaseAdvance(twiss_filter['NAME'],myScan['MUX'],myScan['MUY'],
+                                              muX_IP1L,muY_IP1L,muX_IP5,muY_IP5)
+        myScan.update({'Delta MUX':DeltaMUX,'Delta MUY':DeltaMUY,
+                       'Ideal MUX':np.broadcast_to(ideal,DeltaMUX.shape),'Ideal MUY':np.broadcast_to(ideal,DeltaMUY.shape)})
+        results.update({beam:dotdict({'Twiss':twiss_filter[[e for e in reference.columns if e not in scanColumns]],
+                                      'Survey':survey_filter,
+                                      'Scan':myScan,
+                                      'columns':list(reference.columns)})})
+
+    for beam,otherBeam,column in [('B1','B2','B2-B1 complex distance'),('B2','B1','B1-B2 complex distance')]:
+        myScan=results[beam].Scan
+        myScan['myDeltaX']=results[otherBeam].Scan['X']-myScan['X']
+        myScan['myDeltaZ']=results[otherBeam].Scan['Y']-myScan['Y']
+        survey_filter=results[beam].Survey
+        myScan[column]=(myScan['myDeltaX']+survey_filter['myDeltaX'].values) \
+                       + 1j*(myScan['myDeltaZ']+survey_filter['myDeltaZ'].values)
+    return results
+
+
+def opticsOfScenario(scan,scenario):
+    """
+    It returns the prepared optics of a scenario of a scan (see preparingOpticsScan?), with the same structure and 
+    columns as preparingOpticsFromMADX? (but with the B2 survey as BEAM >> Survey of B2).
+    """
+    k=scan.scenarios.index(scenario)
+    results=dotdict({})
+    for beam in ['B1','B2']:
+        myScan=scan[beam].Scan
+        twiss=scan[beam].Twiss.copy()
+        for column in scan[beam].columns:
+            if column in myScan:
+                twiss[column]=myScan[column][k]
+        twiss=twiss[scan[beam].columns]
+        for column in myScan:
+            if column not in scan[beam].columns:
+                twiss[column]=myScan[column][k]
+        results.update({beam:dotdict({'Twiss':twiss,'Survey':scan[beam].Survey})})
+    return results
+
+
+@timed()
 def filterOpticsDF(BBES,beam,exp,bunch, B1Optics_BB,B2Optics_BB,removeHO=True):
     '''
     This function aims to filter the optics wrt to the previsouly prepared BBES structure. 
     Please set "removeHO" to False in case you want to conserve the HO in the optics. 
+    The BBES can also be the equivalence classes of BBES.BB_pattern_classes?, with bunch the class of the experiment.
     '''
     # Copy
 
-    B1Optics=B1Optics_BB[np.in1d(B1Optics_BB.index,BBES[beam][bunch][exp]['B1_RDV_position'])].copy()
-    B2Optics=B2Optics_BB[np.in1d(B2Optics_BB.index,BBES[beam][bunch][exp]['B2_RDV_position'])].copy()
+    myPattern=BBES[beam][exp][bunch] if 'classOf' in BBES else BBES[beam][bunch][exp]
+    B1Filter=np.in1d(B1Optics_BB.index,myPattern['B1_RDV_position'])
+    B2Filter=np.in1d(B2Optics_BB.index,myPattern['B2_RDV_position'])
+    count('rows scanned',len(B1Optics_BB)+len(B2Optics_BB))
+    B1Optics=B1Optics_BB[B1Filter].copy()
+    B2Optics=B2Optics_BB[B2Filter].copy()
 
     # Partners
 
-    B1Optics['partners']=BBES[beam][bunch][exp]['partners']
-    B2Optics['partners']=BBES[beam][bunch][exp]['partners']
+    B1Optics['partners']=myPattern['partners']
+    B2Optics['partners']=myPattern['partners']
     
     if removeHO == True:
         # Removing the HO
 
         myIP = 'IP'+exp[2]
         myHO = 'BBLR_'+myIP+'_HO'+'.'+'B1'
-        B1Optics = B1Optics[B1Optics.NAME != myHO]
+        B1Optics = B1Optics[~getElementIndex(B1Optics_BB).isName(myHO)[B1Filter]]
         myHO = 'BBLR_'+myIP+'_HO'+'.'+'B2'
-        B2Optics = B2Optics[B2Optics.NAME != myHO]
+        B2Optics = B2Optics[~getElementIndex(B2Optics_BB).isName(myHO)[B2Filter]]
 
     return dotdict({'B1Optics':B1Optics,'B2Optics':B2Optics})
 
+
+@timed()
+def bulkFilterOpticsDF(BBESTable,B1Optics_BB,B2Optics_BB,removeHO=True,columns=None):
+    '''
+    Bulk version of filterOpticsDF: it returns the optics of the encountered elements of all the bunches and 
+    experiments at once, as long-format DataFrames with one row per encounter, indexed by (beam, bunch, IR).
+    - BBESTable [pnd DF]: the BB pattern table with the RDV positions (see BBES.optics_BB_pattern(...,output='table')?).
+    - B1Optics_BB, B2Optics_BB [pnd DF]: the optics used to compute the table.
+    - removeHO [boolean]: remove the HO elements (set it to False in case you want to conserve the HO in the optics).
+    - columns [list]: the optics columns to keep (default: all).
+    The rows are gathered by integer indexing from the S positions of the optics (see elementIndex.rowsAtS?).
+    Each row also contains its partner ('partners') and its 'RDV_index'.
+
+    ===== EXAMPLE =====
+    myTable = optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,B1Optics_BB,B2Optics_BB,output='table')
+    myOptics = bulkFilterOpticsDF(myTable,B1Optics_BB,B2Optics_BB)
+    myOptics.B1Optics.loc[('B1',400,'IR5')]
+    '''
+    IR=BBESTable.index.get_level_values('IR')
+    results=dotdict({})
+    for beam,Optics_BB in [('B1',B1Optics_BB),('B2',B2Optics_BB)]:
+        myIndex=getElementIndex(Optics_BB)
+        rows=myIndex.rowsAtS(BBESTable[beam+'_RDV_position'].values)
+        myFilter=rows>=0
+        count('rows scanned',len(rows))
+        countArrays(rows,myFilter)
+        if removeHO == True:
+            # Category code of the HO element of each experiment (-2 if not in the optics)
+            HO_codes=np.array([myIndex.NAME.categories.get_loc('BBLR_IP'+exp[2]+'_HO.'+beam)
+                               if ('BBLR_IP'+exp[2]+'_HO.'+beam) in myIndex.rows else -2 for exp in IR.categories])
+            myFilter&=myIndex.codes[rows]!=HO_codes[np.asarray(IR.codes)]
+        myOptics=Optics_BB.iloc[rows[myFilter]] if columns is None else Optics_BB[columns].iloc[rows[myFilter]]
+        myOptics.index=BBESTable.index[myFilter]
+        myOptics=myOptics.assign(partners=BBESTable['partner'].values[myFilter],
+                                 RDV_index=BBESTable['RDV_index'].values[myFilter])
+        results.update({beam+'Optics':myOptics})
+    return results
@@ -0,0 +1,186 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from dotdict import *
+from helpers import temporaryFolder
+
+# To be increased when the post-processing of preparingOpticsFromMADX changes, in order to invalidate the cache
+cacheVersion='1'
+
+
+class opticsCache:
+    """
+    An on-disk cache of the prepared optics (see optics.preparingOpticsFromMADX?).
+    Each entry is keyed by the hash of the MAD-X DataFrames (or of the source files) and stores the Twiss and the
+    Survey of each beam column by column as .npy files, that are memory-mapped (copy-on-write) on reload.
+    When the total size exceeds maxSize [bytes], the least recently used entries are removed.
+
+    ===== EXAMPLE =====
+    myCache = opticsCache('/tmp/BBToolsCache', maxSize=2e9)
+    MADX_DICT = preparingOpticsFromMADX(dictOpticsFromMADX(B1_twiss,B2_twiss,B1_survey,B2_survey), cache=myCache)
+    # Keyed by the source files: the TFS files are read only on a miss
+    myOptions = {'columns':TFSColumns, 'filterRows':True}
+    myKey = opticsCache.keyFromFiles(fileNames, myOptions)
+    MADX_DICT = myCache.load(myKey)
+    if MADX_DICT is None:
+        MADX_DICT = preparingOpticsFromMADX(dictOpticsFromTFS(*fileNames, **myOptions), cache=myCache, key=myKey)
+    """
+    def __init__(self,directory,maxSize=2e9):
+        self.directory=directory
+        self.maxSize=maxSize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(MADX_DICT):
+        """
+        It returns the hash of the content (values, index, columns and dtypes) of the Twiss and Survey DataFrames.
+        """
+        myHash=hashlib.sha1(cacheVersion.encode())
+        for beam in ['B1','B2']:
+            for table in ['Twiss','Survey']:
+                opticsDF=MADX_DICT[beam][table]
+                myHash.update((beam+table+str(list(opticsDF.columns))+str(list(opticsDF.dtypes))).encode())
+                myHash.update(pd.util.hash_pandas_object(opticsDF,index=True).values.tobytes())
+        return myHash.hexdigest()
+
+    @staticmethod
+    def keyFromFiles(fileNames,options={}):
+        """
+        It returns the hash of the content of the source files (e.g. the TFS files of the twiss and survey) and of
+        the options used to load them (e.g. the columns and filterRows of TFS.dictOpticsFromTFS?).
+        """
+        myHash=hashlib.sha1(cacheVersion.encode())
+        myHash.update(json.dumps(options,sort_keys=True,default=str).encode())
+        for fileName in fileNames:
+            with open(fileName,'rb') as myFile:
+                for chunk in iter(lambda: myFile.read(1<<20),b''):
+                    myHash.update(chunk)
+        return myHash.hexdigest()
+
+    def _path(self,key):
+        return os.path.join(self.directory,key)
+
+    def __contains__(self,key):
+        return os.path.isfile(os.path.join(self._path(key),'meta.json'))
+
+    def load(self,key):
+        """
+        It returns the prepared optics of the entry key (None if not in the cache).
+        """
+        if key not in self:
+            return None
+        path=self._path(key)
+        results=dotdict({})
+        try:
+            with open(os.path.join(path,'meta.json')) as myFile:
+                meta=json.load(myFile)
+            # Access time for the LRU eviction
+            os.utime(os.path.join(path,'meta.json'),None)
+            for beam in ['B1','B2']:
+                beamDic=dotdict({})
+                for table in ['Twiss','Survey']:
+                    beamDic.update({table:_readDF(os.path.join(path,beam+'_'+table),meta[beam][table])})
+                results.update({beam:beamDic})
+        except (OSError,ValueError):
+            # Entry evicted (or being evicted) by another process while reading: it is a miss
+            return None
+        return results
+
+    def store(self,key,MADX_DICT):
+        """
+        It stores the prepared optics as the entry key and evicts the least recently used entries if needed.
+        """
+        temporaryPath=temporaryFolder(self.directory)
+        try:
+            meta={}
+            for beam in ['B1','B2']:
+                meta[beam]={}
+                for table in ['Twiss','Survey']:
+                    meta[beam][table]=_writeDF(MADX_DICT[beam][table],os.path.join(temporaryPath,beam+'_'+table))
+            with open(os.path.join(temporaryPath,'meta.json'),'w') as myFile:
+                json.dump(meta,myFile)
+            if key not in self:
+                os.rename(temporaryPath,self._path(key))
+        except OSError:
+            # The entry stored concurrently by another process is kept (the entries are renamed complete)
+            if not os.path.isdir(self._path(key)):
+                raise
+        finally:
+            shutil.rmtree(temporaryPath,ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """
+        It returns a DataFrame with the size [bytes] and the last access time of each entry.
+        """
+        results=[]
+        for key in os.listdir(self.directory):
+            if key in self:
+                path=self._path(key)
+                try:
+                    size=sum(os.path.getsize(os.path.join(root,e)) for root,_,files in os.walk(path) for e in files)
+                    lastAccess=os.path.getmtime(os.path.join(path,'meta.json'))
+                except OSError:
+                    # Entry evicted by another process meanwhile
+                    continue
+                results.append({'key':key,'size':size,'lastAccess':lastAccess})
+        return pd.DataFrame(results,columns=['key','size','lastAccess']).set_index('key')
+
+    def size(self):
+        return self.entries()['size'].sum()
+
+    def evict(self):
+        """
+        It removes the least recently used entries until the size of the cache is below maxSize.
+        """
+        myEntries=self.entries().sort_values('lastAccess')
+        totalSize=myEntries['size'].sum()
+        for key,size in zip(myEntries.index,myEntries['size']):
+            if totalSize<=self.maxSize:
+                break
+            shutil.rmtree(self._path(key),ignore_errors=True)
+            totalSize-=size
+
+    def clear(self):
+        for key in self.entries().index:
+            shutil.rmtree(self._path(key),ignore_errors=True)
+
+
+def _writeDF(opticsDF,path):
+    """
+    It writes the index and the columns of a DataFrame as .npy files in the folder path and returns their metadata.
+    """
+    os.makedirs(path)
+    np.save(os.path.join(path,'index.npy'),_toNumpy(opticsDF.index))
+    for i,column in enumerate(opticsDF.columns):
+        np.save(os.path.join(path,'column_'+str(i)+'.npy'),_toNumpy(opticsDF[column]))
+    return {'columns':[str(e) for e in opticsDF.columns],'index':opticsDF.index.name}
+
+
+def _readDF(path,meta):
+    """
+    It reads a DataFrame written by _writeDF, the numeric columns being memory-mapped.
+    """
+    data={}
+    for i,column in enumerate(meta['columns']):
+        data[column]=_fromNumpy(np.load(os.path.join(path,'column_'+str(i)+'.npy'),mmap_mode='c'))
+    index=pd.Index(_fromNumpy(np.load(os.path.join(path,'index.npy'),mmap_mode='c')),name=meta['index'])
+    return pd.DataFrame(data,index=index,columns=meta['columns'],copy=False)
+
+
+def _toNumpy(values):
+    values=np.asarray(values)
+    if values.dtype==object:
+        # Strings are stored with a fixed width in order to be memory-mapped
+        return values.astype(str)
+    return values
+
+
+def _fromNumpy(values):
+    if values.dtype.kind=='U':
+        return values.astype(object)
+    return values
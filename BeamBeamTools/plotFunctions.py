@@ -59,9 +59,17 @@ def plotBunchBBPattern(beam_BB_pattern,beam='B1',exp='IR1',bunch='b400'):
     return ax1
 
 
-def plot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches,alpha=.2, width=1, textSize=10):
+def plot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches,alpha=.2, width=1, textSize=10, fast=False, xLimit=None, 
+                  yLimit=None, maxPixels=1000, fileName=None, dpi=100):
         """
         It plots a beam-beam matrix.
+        - fast [boolean]: draw the matrix and the filled bunches as two images (see _fastBBMatrixImages?) instead 
+          of one shaded region per bunch, e.g. for the full-machine filling schemes.
+        - xLimit, yLimit [two integers]: in fast mode, the range of slots to plot along x and y (default: all).
+        - maxPixels [integer]: in fast mode, the maximum number of pixels along x and y (the matrix is downsampled,
+          keeping in each pixel the largest code).
+        - fileName [string]: if given, the figure is saved in the file. In fast mode, the figure is then rendered 
+          with Agg outside of pyplot (headless, e.g. in batch jobs) and closed.
 
         Example:
         myMatrix=computeBBMatrix(numberOfLRToConsider=20)
@@ -72,7 +80,11 @@ def plot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches,alpha=.2, width=1, textSiz
         B2_bunches=np.where(fillingSchemeDF.iloc[0]['LHC.BCTFR.A6R4.B2:BUNCH_FILL_PATTERN'])[0]
 
         myToolbox.plot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches)
+        myToolbox.plot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches, fast=True, fileName='BBMatrix.png')
         """ 
+        if fast:
+            return _fastPlot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches, alpha, width, textSize, xLimit, yLimit,
+                                      maxPixels, fileName, dpi)
         plt.figure(figsize=(10,10))
         plt.jet()
         plt.imshow(BBMatrixLHC,interpolation='none')
@@ -93,4 +105,90 @@ def plot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches,alpha=.2, width=1, textSiz
         _setArrowLabel(ax=plt.gca(),label='IP8',labelPosition=(2000,2900), arrowPosition=(2000,2900), myColor='k',textSize=textSize)
         _setArrowLabel(ax=plt.gca(),label='IP8',labelPosition=(3130,3564-3130), arrowPosition=(3130,3564-3130), myColor='k',textSize=textSize)
         _setArrowLabel(ax=plt.gca(),label='IP2',labelPosition=(3564-3130,3130), arrowPosition=(3564-3130,3130), myColor='k',textSize=textSize)
+        if fileName is not None:
+            plt.savefig(fileName)
         return plt.gca()
+
+
+# Positions of the labels of plot_BBMatrix
+_BBMatrixLabels=[('IP1/5',(2000,2000)),('IP2',(2000,1100)),('IP8',(2000,2900)),('IP8',(3130,3564-3130)),
+                 ('IP2',(3564-3130,3130))]
+
+
+def _blockMax(matrix,step):
+    """
+    It returns the matrix downsampled by step along both axes, each pixel being the maximum of its step x step block.
+    """
+    ny,nx=matrix.shape
+    padded=np.zeros((-(-ny//step)*step,-(-nx//step)*step),dtype=matrix.dtype)
+    padded[:ny,:nx]=matrix
+    return padded.reshape(padded.shape[0]//step,step,padded.shape[1]//step,step).max(axis=(1,3))
+
+
+def _blockMean(vector,step):
+    """
+    It returns the vector downsampled by step, each element being the mean of its block.
+    """
+    padded=np.zeros(-(-len(vector)//step)*step)
+    padded[:len(vector)]=vector
+    return padded.reshape(-1,step).mean(axis=1)
+
+
+def _fastBBMatrixImages(BBMatrixLHC, B1_bunches, B2_bunches, alpha=.2, width=1, xLimit=None, yLimit=None,
+                        maxPixels=1000):
+    """
+    It returns the images used by plot_BBMatrix in fast mode: the BB matrix cropped to xLimit/yLimit and downsampled 
+    to at most maxPixels per axis, the RGBA overlay of the filled bunches (the B1 bunches along x and the B2 bunches 
+    along y, as in plot_BBMatrix) and the extent of the images.
+    The overlay has the same transparency as the superposition of the shaded regions of plot_BBMatrix.
+    """
+    availableBunchSlot=BBMatrixLHC.shape[0]
+    xLimit=[0,availableBunchSlot] if xLimit is None else [int(xLimit[0]),int(xLimit[1])]
+    yLimit=[0,availableBunchSlot] if yLimit is None else [int(yLimit[0]),int(yLimit[1])]
+    step=max(1,int(np.ceil(max(xLimit[1]-xLimit[0],yLimit[1]-yLimit[0])/float(maxPixels))))
+    myMatrix=_blockMax(np.asarray(BBMatrixLHC[yLimit[0]:yLimit[1],xLimit[0]:xLimit[1]]),step)
+
+    # Number of shaded regions covering each slot
+    window=np.ones(2*width-1)
+    shaded=[]
+    for bunches,limit in [(B1_bunches,xLimit),(B2_bunches,yLimit)]:
+        isFilled=np.zeros(availableBunchSlot)
+        isFilled[np.asarray(bunches,dtype=int)]=1
+        shaded.append(_blockMean(np.convolve(isFilled,window,mode='same')[limit[0]:limit[1]],step))
+    overlay=np.ones(myMatrix.shape+(4,))
+    overlay[:,:,3]=1-(1-alpha)**np.add.outer(shaded[1],shaded[0])
+
+    extent=(xLimit[0]-.5,xLimit[0]+myMatrix.shape[1]*step-.5,yLimit[0]+myMatrix.shape[0]*step-.5,yLimit[0]-.5)
+    return myMatrix,overlay,extent
+
+
+def _fastPlot_BBMatrix(BBMatrixLHC, B1_bunches, B2_bunches, alpha, width, textSize, xLimit, yLimit, maxPixels,
+                       fileName, dpi):
+    """
+    It plots the beam-beam matrix in fast mode (see plot_BBMatrix?).
+    """
+    myMatrix,overlay,extent=_fastBBMatrixImages(BBMatrixLHC, B1_bunches, B2_bunches, alpha, width, xLimit, yLimit,
+                                                maxPixels)
+    if fileName is None:
+        plt.figure(figsize=(10,10))
+        ax=plt.gca()
+    else:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        myFigure=Figure(figsize=(10,10))
+        FigureCanvasAgg(myFigure)
+        ax=myFigure.add_subplot(111)
+    ax.imshow(myMatrix,interpolation='none',cmap='jet',extent=extent)
+    ax.imshow(overlay,interpolation='none',extent=extent)
+    ax.set_xlim(extent[0],extent[1])
+    ax.set_ylim(extent[2],extent[3])
+    ax.set_xlabel('BEAM 2')
+    ax.set_ylabel('BEAM 1')
+    ax.tick_params(direction='inout')
+    for label,position in _BBMatrixLabels:
+        if extent[0]<=position[0]<=extent[1] and extent[3]<=position[1]<=extent[2]:
+            _setArrowLabel(ax=ax,label=label,labelPosition=position,arrowPosition=position,myColor='k',
+                           textSize=textSize)
+    if fileName is not None:
+        ax.figure.savefig(fileName,dpi=dpi)
+    return ax
@@ -0,0 +1,128 @@
+import gc
+import numpy as np
+from dotdict import *
+from BBES import beam_BB_encounters, _beam_BB_pattern, optics_BB_pattern, update_BB_pattern, BB_pattern_table
+
+
+def fillingSchemeBunches(pattern,availableBunchSlot=3564):
+    """
+    It returns the filled bunches of a filling pattern: either a boolean (or 0/1) array of availableBunchSlot
+    elements, as the BUNCH_FILL_PATTERN variables, or already an array of bunch numbers.
+    """
+    pattern=np.asarray(pattern)
+    if pattern.dtype==bool or (len(pattern)==availableBunchSlot and np.isin(pattern,[0,1]).all()):
+        return np.flatnonzero(pattern)
+    return np.unique(pattern.astype(int))
+
+
+def fillingSchemeSnapshots(fillingPatternDF,B1_variable='LHC.BCTFR.A6R4.B1:BUNCH_FILL_PATTERN',
+                           B2_variable='LHC.BCTFR.A6R4.B2:BUNCH_FILL_PATTERN'):
+    """
+    It yields the (timestamp, B1 bunches, B2 bunches) of a DataFrame of BUNCH_FILL_PATTERN (e.g. from cl2pd),
+    row by row. The rows where one of the two patterns is missing are skipped.
+
+    ===== EXAMPLE =====
+    fillingPatternDF=cals2pnd(['LHC.BCTFR.A6R4.B1:BUNCH_FILL_PATTERN','LHC.BCTFR.A6R4.B2:BUNCH_FILL_PATTERN'],t1,t2)
+    for timestamp,B1_bunches,B2_bunches in fillingSchemeSnapshots(fillingPatternDF):
+        ...
+    """
+    for timestamp,B1_pattern,B2_pattern in zip(fillingPatternDF.index,fillingPatternDF[B1_variable].values,
+                                               fillingPatternDF[B2_variable].values):
+        if np.ndim(B1_pattern)==0 or np.ndim(B2_pattern)==0:
+            continue
+        yield timestamp,fillingSchemeBunches(B1_pattern),fillingSchemeBunches(B2_pattern)
+
+
+def uniqueFillingSchemes(snapshots):
+    """
+    It yields the (timestamp, B1 bunches, B2 bunches) of the snapshots, skipping the consecutive snapshots with the
+    same filling schemes as the previous one. The patterns can be boolean BUNCH_FILL_PATTERN or bunch numbers.
+    """
+    previous=None
+    for timestamp,B1_pattern,B2_pattern in snapshots:
+        current=(fillingSchemeBunches(B1_pattern),fillingSchemeBunches(B2_pattern))
+        if previous is not None and np.array_equal(previous[0],current[0]) and np.array_equal(previous[1],current[1]):
+            continue
+        previous=current
+        yield timestamp,current[0],current[1]
+
+
+def _summary(BBMatrixLHC,B1_bunches,B2_bunches):
+    """
+    It returns the summary of the BB encounters of a filling scheme: for each beam the number of bunches and,
+    for each experiment, the number of bunches with a HO and the total and maximum number of LR per bunch.
+    """
+    encounters=beam_BB_encounters(BBMatrixLHC,B1_bunches,B2_bunches)
+    results={'B1 bunches':len(B1_bunches),'B2 bunches':len(B2_bunches)}
+    for beam in ['B1','B2']:
+        for exp in ['IR1','IR2','IR5','IR8']:
+            aux=encounters[beam][exp]
+            bunchIndex=np.repeat(np.arange(len(aux['counts'])),aux['counts'])
+            isHO=aux['RDV_index']==0
+            LR=np.bincount(bunchIndex[~isHO],minlength=len(aux['counts']))
+            results[beam+' '+exp+' HO']=int(np.sum(isHO))
+            results[beam+' '+exp+' LR']=int(np.sum(LR))
+            results[beam+' '+exp+' max LR']=int(np.max(LR)) if len(LR) else 0
+    return results
+
+
+def streamBBES(snapshots,BBMatrixLHC,B1Optics_BB=None,B2Optics_BB=None,output='nested',incremental=True):
+    """
+    It yields lazily the (timestamp, result) of each distinct filling scheme of a time series of snapshots,
+    keeping in memory only the previous result (the results already consumed are garbage collected).
+    - snapshots [iterable]: the (timestamp, B1 pattern, B2 pattern), e.g. from fillingSchemeSnapshots?
+    - BBMatrixLHC [adimensional integer array]: the LHC BB matrix
+    - B1Optics_BB, B2Optics_BB [pnd DF]: the optics (optional), to add the RDV positions.
+    - output [string]:
+        'nested' for the BBES dotdict (see optics_BB_pattern?),
+        'table' for the columnar table (see BB_pattern_table?),
+        'summary' for a dict of the number of bunches, HO and LR of each beam and experiment.
+    - incremental [boolean]: in 'nested' mode, update the previous BBES structure when only a few bunches change
+      (see update_BB_pattern?).
+    The consecutive identical filling schemes are skipped (see uniqueFillingSchemes?).
+
+    ===== EXAMPLE =====
+    mySummary=pd.DataFrame.from_dict(dict(streamBBES(fillingSchemeSnapshots(fillingPatternDF),BBMatrixLHC,
+                                                     output='summary')),orient='index')
+    """
+    if output not in ['nested','table','summary']:
+        raise ValueError("output must be 'nested', 'table' or 'summary'.")
+    previous=None
+    for timestamp,B1_bunches,B2_bunches in uniqueFillingSchemes(snapshots):
+        if output=='summary':
+            yield timestamp,_summary(BBMatrixLHC,B1_bunches,B2_bunches)
+        elif output=='table':
+            yield timestamp,BB_pattern_table(BBMatrixLHC,B1_bunches,B2_bunches,B1Optics_BB,B2Optics_BB)
+        else:
+            changes=None
+            if previous is not None and incremental:
+                changes=dotdict({})
+                for beam,bunches in [('B1',B1_bunches),('B2',B2_bunches)]:
+                    changes[beam+'_added']=np.setdiff1d(bunches,previous[1][beam])
+                    changes[beam+'_removed']=np.setdiff1d(previous[1][beam],bunches)
+                numberOfChanges=sum(len(e) for e in changes.values())
+                # Above half of the bunches it is cheaper to recompute everything
+                if numberOfChanges>(len(B1_bunches)+len(B2_bunches))/2:
+                    changes=None
+            # The BBES structures are dotdicts, i.e. reference cycles: the results already consumed (and the
+            # previous one if not updated) are freed before computing the next one
+            results=None
+            if changes is None:
+                previous=None
+            gc.collect()
+            if changes is None:
+                results=_nested_from_scratch(BBMatrixLHC,B1_bunches,B2_bunches,B1Optics_BB,B2Optics_BB)
+            else:
+                results=update_BB_pattern(previous[0],BBMatrixLHC,B1Optics_BB=B1Optics_BB,B2Optics_BB=B2Optics_BB,
+                                          **changes)
+            previous=(results,{'B1':B1_bunches,'B2':B2_bunches})
+            yield timestamp,results
+
+
+def _nested_from_scratch(BBMatrixLHC,B1_bunches,B2_bunches,B1Optics_BB,B2Optics_BB):
+    """
+    It returns the BBES structure of the filling schemes, with the RDV positions if the optics are given.
+    """
+    if (B1Optics_BB is not None) and (B2Optics_BB is not None):
+        return optics_BB_pattern(BBMatrixLHC,B1_bunches,B2_bunches,B1Optics_BB,B2Optics_BB)
+    return _beam_BB_pattern(BBMatrixLHC,B1_bunches,B2_bunches)
@@ -0,0 +1,131 @@
+"""
+Offline benchmarks of the BeamBeamTools pipeline on synthetic inputs (see syntheticInputs.py): it records the wall time
+and the peak memory of each stage for several filling schemes and optics sizes, to track the scaling regressions.
+
+===== EXAMPLE =====
+python benchmarks/runBenchmarks.py --bunches 12 600 2748 --elements 10000 100000 --output benchmarks.csv
+python benchmarks/runBenchmarks.py --compare benchmarks.csv
+"""
+import os
+import sys
+import gc
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','BeamBeamTools'))
+
+import syntheticInputs
+from BBES import computeBBMatrix, _beam_BB_pattern, optics_BB_pattern
+from optics import dictOpticsFromMADX, preparingOpticsFromMADX, filterOpticsDF, bulkFilterOpticsDF
+from longRange import longRangeEffects
+
+columns=['stage','bunches','elements','numberOfLR','time [s]','peak memory [MB]']
+
+
+def measure(function,repeat=3):
+    """
+    It returns the output of function(), the best wall time [s] over repeat calls and the peak of the memory
+    allocated during a call [MB] (traced by tracemalloc in an additional call, not timed).
+    """
+    gc.collect()
+    tracemalloc.start()
+    output=function()
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times=[]
+    for i in range(repeat):
+        gc.collect()
+        start=time.perf_counter()
+        function()
+        times.append(time.perf_counter()-start)
+    return output,min(times),peak/1e6
+
+
+def run(bunches=[12,144,600,1200,2748],elements=[10000],numberOfLR=20,scheme='standard',repeat=3,verbose=True):
+    """
+    It returns a DataFrame with the wall time and the peak memory of each stage:
+    - computeBBMatrix (compact and dense), for each numberOfLR,
+    - preparingOpticsFromMADX, for each optics size,
+    - _beam_BB_pattern, optics_BB_pattern (nested and table), filterOpticsDF (all the B1 bunches in IR5) and
+      bulkFilterOpticsDF and longRangeEffects, for each filling scheme and optics size.
+    """
+    results=[]
+
+    def record(stage,function,numberOfBunches=np.nan,numberOfElements=np.nan):
+        output,wallTime,peak=measure(function,repeat)
+        results.append([stage,numberOfBunches,numberOfElements,numberOfLR,wallTime,peak])
+        if verbose:
+            print('%-40s %6s bunches %8s elements %10.4f s %10.2f MB'%(stage,numberOfBunches,numberOfElements,
+                                                                        wallTime,peak))
+        return output
+
+    BBMatrixLHC=record('computeBBMatrix (compact)',lambda: computeBBMatrix(numberOfLR,compact=True))
+    record('computeBBMatrix (dense)',lambda: computeBBMatrix(numberOfLR,compact=False))
+    for numberOfElements in elements:
+        MADX_DICT=dictOpticsFromMADX(*syntheticInputs.MADX(numberOfLR,numberOfElements))
+        myOptics=record('preparingOpticsFromMADX',lambda: preparingOpticsFromMADX(MADX_DICT),
+                        numberOfElements=numberOfElements)
+        B1Optics_BB=myOptics.B1.Twiss
+        B2Optics_BB=myOptics.B2.Twiss
+        for numberOfBunches in bunches:
+            B1_fillingScheme=syntheticInputs.fillingScheme(numberOfBunches,scheme)
+            B2_fillingScheme=B1_fillingScheme
+            record('_beam_BB_pattern',lambda: _beam_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme),
+                   numberOfBunches,numberOfElements)
+            BBES=record('optics_BB_pattern (nested)',
+                        lambda: optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,
+                                                  B1Optics_BB,B2Optics_BB),
+                        numberOfBunches,numberOfElements)
+            myTable=record('optics_BB_pattern (table)',
+                           lambda: optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,
+                                                     B1Optics_BB,B2Optics_BB,output='table'),
+                           numberOfBunches,numberOfElements)
+            record('filterOpticsDF (B1, IR5)',
+                   lambda: [filterOpticsDF(BBES,'B1','IR5',bunch,B1Optics_BB,B2Optics_BB) for bunch in BBES.B1],
+                   numberOfBunches,numberOfElements)
+            record('bulkFilterOpticsDF',lambda: bulkFilterOpticsDF(myTable,B1Optics_BB,B2Optics_BB),
+                   numberOfBunches,numberOfElements)
+            record('longRangeEffects',lambda: longRangeEffects(myTable,B1Optics_BB,B2Optics_BB,1.15e11,1.15e11),
+                   numberOfBunches,numberOfElements)
+    return pd.DataFrame(results,columns=columns)
+
+
+def compare(current,reference,tolerance=1.5):
+    """
+    It returns the ratio current/reference of the wall time and of the peak memory of the stages in both DataFrames,
+    with a 'regression' column flagging the ratios above tolerance.
+    """
+    keys=['stage','bunches','elements','numberOfLR']
+    myDF=pd.merge(current,reference,on=keys,suffixes=('',' (reference)'))
+    myDF['time ratio']=myDF['time [s]']/myDF['time [s] (reference)']
+    myDF['memory ratio']=myDF['peak memory [MB]']/myDF['peak memory [MB] (reference)']
+    myDF['regression']=(myDF['time ratio']>tolerance) | (myDF['memory ratio']>tolerance)
+    return myDF[keys+['time ratio','memory ratio','regression']]
+
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Benchmarks of BeamBeamTools on synthetic LHC inputs.')
+    parser.add_argument('--bunches',type=int,nargs='+',default=[12,144,600,1200,2748],
+                        help='number of bunches of the filling schemes')
+    parser.add_argument('--elements',type=int,nargs='+',default=[10000],
+                        help='number of elements of the twiss and survey')
+    parser.add_argument('--numberOfLR',type=int,default=20,help='number of LR per side of each IP')
+    parser.add_argument('--scheme',default='standard',choices=sorted(syntheticInputs.schemes.keys()),
+                        help='the train structure of the filling schemes')
+    parser.add_argument('--repeat',type=int,default=3,help='number of timed calls of each stage (best is kept)')
+    parser.add_argument('--output',help='CSV file where to save the results')
+    parser.add_argument('--compare',help='CSV file of reference results (e.g. from a previous --output)')
+    parser.add_argument('--tolerance',type=float,default=1.5,help='ratio to the reference flagged as a regression')
+    args=parser.parse_args()
+
+    myResults=run(args.bunches,args.elements,args.numberOfLR,args.scheme,args.repeat)
+    if args.output:
+        myResults.to_csv(args.output,index=False)
+    if args.compare:
+        myComparison=compare(myResults,pd.read_csv(args.compare),args.tolerance)
+        print(myComparison.to_string(index=False))
+        if myComparison['regression'].any():
+            sys.exit(1)
@@ -0,0 +1,147 @@
+"""
+Synthetic, but realistic, inputs for the benchmarks: LHC filling schemes and MAD-X twiss/survey DataFrames.
+"""
+import numpy as np
+import pandas as pd
+
+circumference=26658.8832
+availableBunchSlot=3564
+# S of the IPs wrt IP1
+IPpositions={'IP1':0.,'IP2':3332.436,'IP3':6664.72,'IP4':9997.005,
+             'IP5':13329.289,'IP6':16661.725,'IP7':19994.162,'IP8':23315.379}
+BBIPs=['IP1','IP2','IP5','IP8']
+# Half of the bunch spacing: distance between two consecutive BBLR encounters
+BBLRSpacing=25e-9*299792458/2.
+
+# Filling scheme families: bunches per train, trains per SPS injection
+schemes={'BCMS':{'train':48,'trainsPerInjection':6},
+         'standard':{'train':72,'trainsPerInjection':4}}
+
+
+def fillingScheme(numberOfBunches,scheme='standard',trainGap=8,injectionGap=36,firstSlot=0,abortGap=3443):
+    """
+    It returns the filled slots of a 25 ns filling scheme with numberOfBunches bunches.
+    - scheme [string]: 'standard' (trains of 72 bunches) or 'BCMS' (trains of 48 bunches). With the default gaps, at
+      most 2879 bunches fit in a 'standard' scheme (e.g. the full machine, 2748 bunches) and 2736 in a 'BCMS' one.
+    - trainGap [integer]: empty slots between two trains of the same SPS injection.
+    - injectionGap [integer]: empty slots between two SPS injections.
+    - abortGap [integer]: first slot of the abort gap.
+    With less bunches than a train, a single train is used (e.g. 12 bunches).
+    """
+    train=schemes[scheme]['train']
+    trainsPerInjection=schemes[scheme]['trainsPerInjection']
+    slots=[]
+    slot=firstSlot
+    trains=0
+    while len(slots)<numberOfBunches:
+        length=min(train,numberOfBunches-len(slots))
+        if slot+length>abortGap:
+            raise ValueError(str(numberOfBunches)+' bunches do not fit in a '+scheme+' filling scheme.')
+        slots.extend(range(slot,slot+length))
+        trains+=1
+        slot+=length+(injectionGap if trains%trainsPerInjection==0 else trainGap)
+    return np.array(slots)
+
+
+def _elements(beam,numberOfLR=20,numberOfElements=10000,seed=0):
+    """
+    It returns the NAME and S of a synthetic LHC sequence starting at IP1: IP markers, BBLR elements around the 4
+    experiments, S./E. markers of the dispersion suppressors, main dipoles in the arcs and other elements.
+    """
+    names=[]
+    S=[]
+    for IP,position in IPpositions.items():
+        names.append(IP)
+        S.append(position)
+        if IP in BBIPs:
+            names.append('BBLR_'+IP+'_HO.'+beam)
+            S.append(position)
+            for i in range(1,numberOfLR+1):
+                names.append('BBLR_'+IP+'_L_'+str(i)+'.'+beam)
+                S.append((position-i*BBLRSpacing)%circumference)
+                names.append('BBLR_'+IP+'_R_'+str(i)+'.'+beam)
+                S.append(position+i*BBLRSpacing)
+        names.append('S.DS.R'+IP[2]+'.'+beam)
+        S.append(position+270.)
+        names.append('E.DS.L'+IP[2]+'.'+beam)
+        S.append((position-270.)%circumference)
+    edges=sorted(IPpositions.values())+[circumference]
+    for arc,(start,end) in enumerate(zip(edges[:-1],edges[1:])):
+        for i,position in enumerate(np.arange(start+300.,end-300.,15.66)):
+            names.append('MB.'+str(i)+'.A'+str(arc)+'.'+beam)
+            S.append(position)
+    numberOfOthers=max(numberOfElements-len(names)-1,0)
+    rng=np.random.RandomState(seed)
+    names.extend(['MQ.'+str(i)+'.'+beam for i in range(numberOfOthers)])
+    S.extend(np.sort(rng.uniform(1.,circumference-1.,numberOfOthers)))
+    # End of the sequence
+    names.append('IP1.L1')
+    S.append(circumference)
+    myDF=pd.DataFrame({'NAME':names,'S':np.array(S)})
+    return myDF.sort_values('S',kind='mergesort').reset_index(drop=True)
+
+
+def twiss(beam,numberOfLR=20,numberOfElements=10000,crossingAngle=160e-6,betaStar=0.3,seed=0):
+    """
+    It returns a synthetic MAD-X twiss DataFrame (NAME, S, X, Y, MUX, MUY, BETX, BETY) indexed by S, with
+    crossing bumps (vertical in IP1/2, horizontal in IP5/8) and low-beta insertions at the 4 experiments.
+    """
+    myDF=_elements(beam,numberOfLR,numberOfElements,seed)
+    S=myDF['S'].values
+    sign=1. if beam=='B1' else -1.
+    X=np.zeros(len(S))
+    Y=np.zeros(len(S))
+    BETX=np.full(len(S),100.)
+    BETY=np.full(len(S),100.)
+    for IP in BBIPs:
+        for position in [IPpositions[IP],IPpositions[IP]+circumference]:
+            distance=S-position
+            myFilter=np.abs(distance)<300.
+            if IP in ['IP1','IP2']:
+                Y[myFilter]+=sign*crossingAngle/2.*distance[myFilter]
+            else:
+                X[myFilter]+=sign*crossingAngle/2.*distance[myFilter]
+            BETX[myFilter]=betaStar+distance[myFilter]**2/betaStar
+            BETY[myFilter]=betaStar+distance[myFilter]**2/betaStar
+    myDF['X']=X
+    myDF['Y']=Y
+    myDF['MUX']=62.31*S/circumference+0.01*np.sin(S/100.)
+    myDF['MUY']=60.32*S/circumference+0.01*np.cos(S/100.)
+    myDF['BETX']=BETX
+    myDF['BETY']=BETY
+    myDF.index=S
+    return myDF
+
+
+def survey(beam,numberOfLR=20,numberOfElements=10000,seed=0):
+    """
+    It returns a synthetic MAD-X survey DataFrame (NAME, S, X, Y, Z, THETA) indexed by S: the two beams are
+    separated by 194 mm in the arcs and share the same orbit around the 4 experiments.
+    """
+    myDF=_elements(beam,numberOfLR,numberOfElements,seed)
+    S=myDF['S'].values
+    radius=circumference/2./np.pi
+    theta=S/radius
+    separation=np.full(len(S),0.097 if beam=='B1' else -0.097)
+    for IP in BBIPs:
+        for position in [IPpositions[IP],IPpositions[IP]+circumference]:
+            distance=np.abs(S-position)
+            transition=(distance>=140.) & (distance<300.)
+            separation[transition]*=(distance[transition]-140.)/160.
+            separation[distance<140.]=0.
+    myDF['X']=(radius+separation)*np.cos(theta)
+    myDF['Y']=0.
+    myDF['Z']=(radius+separation)*np.sin(theta)
+    myDF['THETA']=theta
+    myDF.index=S
+    return myDF
+
+
+def MADX(numberOfLR=20,numberOfElements=10000,crossingAngle=160e-6,seed=0):
+    """
+    It returns the (B1_twiss, B2_twiss, B1_survey, B2_survey) of a synthetic optics (see dictOpticsFromMADX?).
+    """
+    return (twiss('B1',numberOfLR,numberOfElements,crossingAngle,seed=seed),
+            twiss('B2',numberOfLR,numberOfElements,crossingAngle,seed=seed),
+            survey('B1',numberOfLR,numberOfElements,seed=seed),
+            survey('B2',numberOfLR,numberOfElements,seed=seed))
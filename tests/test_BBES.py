@@ -0,0 +1,115 @@
+"""
+Test of the BB patterns (see BBES.py): the vectorized encounters against the bunch-by-bunch loops of the first
+implementation of _beam_BB_pattern, the incremental update against the structure computed from scratch and the
+beam-beam matrices with non-default IP slots.
+
+===== EXAMPLE =====
+python -m pytest tests
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+myPath=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(myPath,'..','BeamBeamTools'))
+sys.path.insert(0,os.path.join(myPath,'..','benchmarks'))
+
+import syntheticInputs
+from optics import dictOpticsFromMADX, preparingOpticsFromMADX
+from BBES import computeBBMatrix, _bunch_BB_pattern, _beam_BB_pattern, optics_BB_pattern, update_BB_pattern
+
+
+def _loopBeamPattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme):
+    """
+    It returns the BBES structure as computed by the loops of the first implementation of _beam_BB_pattern.
+    """
+    results={}
+    for beam,fillingScheme,otherFillingScheme,sign in [('B1',B1_fillingScheme,B2_fillingScheme,-1),
+                                                       ('B2',B2_fillingScheme,B1_fillingScheme,1)]:
+        results[beam]={}
+        for i in fillingScheme:
+            myPattern=_bunch_BB_pattern(Bunch=i,BBMatrixLHC=BBMatrixLHC)
+            results[beam]['b'+str(i)]={}
+            for exp in ['IR1','IR2','IR5','IR8']:
+                slots=myPattern['B2'][exp]
+                aux=np.intersect1d(slots,otherFillingScheme)
+                myPosition=sign*((np.where(np.in1d(slots,aux))[0])-(len(slots)-1)/2)
+                results[beam]['b'+str(i)][exp]={'partners':aux,'RDV_index':myPosition[-1::-1]}
+    return results
+
+
+def _assertSameNested(myBBES,reference):
+    assert list(myBBES)==list(reference)
+    for beam in reference:
+        assert list(myBBES[beam])==list(reference[beam])
+        for bunch in reference[beam]:
+            assert list(myBBES[beam][bunch])==list(reference[beam][bunch])
+            for exp in reference[beam][bunch]:
+                assert list(myBBES[beam][bunch][exp])==list(reference[beam][bunch][exp])
+                for key,values in reference[beam][bunch][exp].items():
+                    myValues=myBBES[beam][bunch][exp][key]
+                    assert myValues.dtype==values.dtype
+                    np.testing.assert_array_equal(myValues,values)
+
+
+@pytest.mark.parametrize('compact',[True,False])
+@pytest.mark.parametrize('numberOfLR',[20,{'IR1':25,'IR2':20,'IR5':25,'IR8':15}])
+def test_beam_pattern(compact,numberOfLR):
+    BBMatrixLHC=computeBBMatrix(numberOfLRToConsider=numberOfLR,compact=compact)
+    B1_fillingScheme=syntheticInputs.fillingScheme(600,'standard')
+    # Another train structure, shifted and wrapping around the abort gap
+    B2_fillingScheme=(syntheticInputs.fillingScheme(400,'BCMS')+3300)%3564
+    _assertSameNested(_beam_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme),
+                      _loopBeamPattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme))
+
+
+@pytest.fixture(scope='module')
+def prepared():
+    return preparingOpticsFromMADX(dictOpticsFromMADX(*syntheticInputs.MADX(numberOfLR=20,numberOfElements=2000)))
+
+
+@pytest.mark.parametrize('withOptics',[False,True])
+def test_update_pattern(prepared,withOptics):
+    BBMatrixLHC=computeBBMatrix(20)
+    myOptics={'B1Optics_BB':prepared.B1.Twiss,'B2Optics_BB':prepared.B2.Twiss} if withOptics else {}
+
+    def fromScratch(B1_fillingScheme,B2_fillingScheme):
+        if withOptics:
+            return optics_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,**myOptics)
+        return _beam_BB_pattern(BBMatrixLHC,B1_fillingScheme,B2_fillingScheme)
+
+    B1_fillingScheme=syntheticInputs.fillingScheme(144,'standard')
+    B2_fillingScheme=syntheticInputs.fillingScheme(144,'standard',firstSlot=3)
+    BBES=fromScratch(B1_fillingScheme,B2_fillingScheme)
+    # Injections of trains (one across the first slot), a B2 train dumped and single bunches removed
+    steps=[{'B1_added':np.arange(500,548),'B2_added':np.arange(510,558)},
+           {'B1_added':np.arange(3540,3564),'B2_added':np.arange(0,2)},
+           {'B2_removed':np.arange(510,558)},
+           {'B1_removed':[3,500,3563],'B2_removed':[3,4]},
+           {'B1_added':[3],'B2_added':np.arange(3550,3564),'B2_removed':[0]}]
+    for changes in steps:
+        myChanges={key:np.asarray(changes.get(key,[]),dtype=int)
+                   for key in ['B1_added','B1_removed','B2_added','B2_removed']}
+        B1_fillingScheme=np.union1d(np.setdiff1d(B1_fillingScheme,myChanges['B1_removed']),myChanges['B1_added'])
+        B2_fillingScheme=np.union1d(np.setdiff1d(B2_fillingScheme,myChanges['B2_removed']),myChanges['B2_added'])
+        BBES=update_BB_pattern(BBES,BBMatrixLHC,**dict(changes,**myOptics))
+        _assertSameNested(BBES,fromScratch(B1_fillingScheme,B2_fillingScheme))
+
+
+@pytest.mark.parametrize('compact',[True,False])
+def test_bunch_pattern_IP5_offset(compact):
+    numberOfLR={'IR1':20,'IR2':20,'IR5':25,'IR8':20}
+    BBMatrixLHC=computeBBMatrix(numberOfLRToConsider=numberOfLR,compact=compact,IPslots={'IR5':1782})
+    codes={'IR1':(1,10),'IR2':(2,20),'IR5':(5,50),'IR8':(8,80)}
+    for bunch in [0,100,3563]:
+        myPattern=_bunch_BB_pattern(bunch,BBMatrixLHC)
+        myRow=np.asarray(BBMatrixLHC[bunch,:])
+        for exp,(HO,LR) in codes.items():
+            B1=myPattern['B1'][exp]
+            assert len(B1)==2*numberOfLR[exp]+1
+            expected=np.full(len(B1),LR)
+            expected[numberOfLR[exp]]=HO
+            np.testing.assert_array_equal(myRow[B1],expected)
+            np.testing.assert_array_equal(myPattern['B2'][exp],B1[::-1])
+        assert myPattern['B1']['IR5'][numberOfLR['IR5']]==(bunch+1782)%3564
@@ -0,0 +1,100 @@
+"""
+Test of the BBES store: the round trip of the nested BBES structure (see BBESStore.writeBBES), the chunked store
+(see BBESStore.writeBBESChunked) against it and its peak memory against maxMemory, on the synthetic inputs of the
+benchmarks.
+
+===== EXAMPLE =====
+python -m pytest tests
+"""
+import os
+import sys
+import gc
+import tracemalloc
+import numpy as np
+import pytest
+
+myPath=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(myPath,'..','BeamBeamTools'))
+sys.path.insert(0,os.path.join(myPath,'..','benchmarks'))
+
+import syntheticInputs
+from optics import dictOpticsFromMADX, preparingOpticsFromMADX
+from BBES import computeBBMatrix, optics_BB_pattern
+from BBESStore import writeBBES, writeBBESChunked, readBBES
+
+
+@pytest.fixture(scope='module')
+def inputs():
+    myOptics=preparingOpticsFromMADX(dictOpticsFromMADX(*syntheticInputs.MADX(numberOfLR=20,numberOfElements=2000)))
+    return (computeBBMatrix(20),syntheticInputs.fillingScheme(1200,'standard'),
+            syntheticInputs.fillingScheme(600,'BCMS',firstSlot=5),myOptics.B1.Twiss,myOptics.B2.Twiss)
+
+
+def _assertSameBBES(myBBES,reference):
+    assert list(myBBES)==list(reference)
+    for beam in reference:
+        assert list(myBBES[beam])==list(reference[beam])
+        for bunch in reference[beam]:
+            assert list(myBBES[beam][bunch])==list(reference[beam][bunch])
+            for exp in reference[beam][bunch]:
+                myExp=myBBES[beam][bunch][exp]
+                referenceExp=reference[beam][bunch][exp]
+                assert list(myExp)==list(referenceExp)
+                for key in referenceExp:
+                    np.testing.assert_array_equal(myExp[key],referenceExp[key])
+                    assert myExp[key].dtype==referenceExp[key].dtype
+
+
+@pytest.fixture(scope='module')
+def BBES(inputs):
+    return optics_BB_pattern(*inputs)
+
+
+@pytest.fixture(scope='module')
+def reference(BBES,tmp_path_factory):
+    path=str(tmp_path_factory.mktemp('store')/'reference')
+    writeBBES(BBES,path)
+    return readBBES(path)
+
+
+def test_store(BBES,reference):
+    _assertSameBBES(reference,BBES)
+    # Attribute access and single experiments, as for the nested structure
+    bunch=list(BBES.B1)[100]
+    np.testing.assert_array_equal(reference.B1[bunch].IR5.partners,BBES.B1[bunch].IR5.partners)
+    myExperiment=reference.B2.experiment('IR8')
+    assert list(myExperiment)==list(BBES.B2)
+    for bunch in BBES.B2:
+        for key in BBES.B2[bunch].IR8:
+            np.testing.assert_array_equal(myExperiment[bunch][key],BBES.B2[bunch].IR8[key])
+
+
+def test_store_overwrite(BBES,tmp_path):
+    path=str(tmp_path/'store')
+    writeBBES(BBES,path)
+    with pytest.raises(ValueError):
+        writeBBES(BBES,path)
+    writeBBES({'B1':BBES.B1,'B2':{}},path,overwrite=True)
+    myBBES=readBBES(path)
+    assert len(myBBES.B1)==len(BBES.B1) and len(myBBES.B2)==0
+    assert [e for e in os.listdir(str(tmp_path)) if e.startswith('.tmp_')]==[]
+
+
+@pytest.mark.parametrize('chunkSize',[None,1,7,10000])
+def test_chunked_store(inputs,reference,tmp_path,chunkSize):
+    path=str(tmp_path/'chunked')
+    writeBBESChunked(*inputs,path=path,chunkSize=chunkSize,maxMemory=2e6)
+    _assertSameBBES(readBBES(path),reference)
+
+
+@pytest.mark.parametrize('maxMemory',[1e6,3e6,10e6])
+def test_chunked_store_memory(inputs,tmp_path,maxMemory):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start=tracemalloc.get_traced_memory()[0]
+        writeBBESChunked(*inputs,path=str(tmp_path/'chunked'),maxMemory=maxMemory)
+        peak=tracemalloc.get_traced_memory()[1]-start
+    finally:
+        tracemalloc.stop()
+    assert peak<maxMemory
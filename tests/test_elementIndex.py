@@ -0,0 +1,43 @@
+"""
+Test of the cached element index (see optics.getElementIndex) when the optics DataFrame is modified in place.
+
+===== EXAMPLE =====
+python -m pytest tests
+"""
+import os
+import sys
+import numpy as np
+
+myPath=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(myPath,'..','BeamBeamTools'))
+sys.path.insert(0,os.path.join(myPath,'..','benchmarks'))
+
+import syntheticInputs
+from optics import getElementIndex
+
+
+def _assertIndex(myIndex,opticsDF):
+    names=opticsDF['NAME'].values
+    for name in ['IP1','IP5','BBLR_IP5_L_1.B1']:
+        rows=np.flatnonzero(names==name)
+        if len(rows):
+            assert myIndex.rows[name]==rows[0]
+        else:
+            assert name not in myIndex.rows
+    np.testing.assert_array_equal(myIndex.mask('BBLR'),opticsDF['NAME'].str.contains('BBLR').values)
+
+
+def test_cached():
+    myTwiss=syntheticInputs.twiss('B1',numberOfElements=2000)
+    assert getElementIndex(myTwiss) is getElementIndex(myTwiss)
+
+
+def test_modified_in_place():
+    myTwiss=syntheticInputs.twiss('B1',numberOfElements=2000)
+    _assertIndex(getElementIndex(myTwiss),myTwiss)
+    myTwiss.sort_values('S',ascending=False,inplace=True)
+    _assertIndex(getElementIndex(myTwiss),myTwiss)
+    myTwiss.loc[myTwiss.index[0],'NAME']='IP5'
+    _assertIndex(getElementIndex(myTwiss),myTwiss)
+    myTwiss['NAME']=myTwiss['NAME'].str.replace('IP5','IPX')
+    _assertIndex(getElementIndex(myTwiss),myTwiss)
@@ -0,0 +1,76 @@
+"""
+Test of the optics cache (see opticsCache.py) with entries stored or evicted concurrently by another process.
+
+===== EXAMPLE =====
+python -m pytest tests
+"""
+import os
+import sys
+import shutil
+import numpy as np
+import pytest
+
+myPath=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(myPath,'..','BeamBeamTools'))
+sys.path.insert(0,os.path.join(myPath,'..','benchmarks'))
+
+import syntheticInputs
+from optics import dictOpticsFromMADX, preparingOpticsFromMADX
+from opticsCache import opticsCache
+
+
+@pytest.fixture(scope='module')
+def prepared():
+    return preparingOpticsFromMADX(dictOpticsFromMADX(*syntheticInputs.MADX(numberOfLR=5,numberOfElements=500)))
+
+
+def _temporaryFolders(myCache):
+    return [e for e in os.listdir(myCache.directory) if e.startswith('.tmp_')]
+
+
+def test_round_trip(prepared,tmp_path):
+    myCache=opticsCache(str(tmp_path))
+    myCache.store('key',prepared)
+    myOptics=myCache.load('key')
+    for beam in ['B1','B2']:
+        for table in ['Twiss','Survey']:
+            myDF=myOptics[beam][table]
+            referenceDF=prepared[beam][table]
+            assert list(myDF.columns)==list(referenceDF.columns)
+            np.testing.assert_array_equal(myDF.index,referenceDF.index)
+            for column in referenceDF.columns:
+                np.testing.assert_array_equal(myDF[column].values,referenceDF[column].values)
+
+
+def test_concurrent_store(prepared,tmp_path,monkeypatch):
+    myCache=opticsCache(str(tmp_path))
+    myCache.store('key',prepared)
+    # The other process stored the entry after the check of this one
+    monkeypatch.setattr(opticsCache,'__contains__',lambda self,key: False)
+    myCache.store('key',prepared)
+    monkeypatch.undo()
+    assert _temporaryFolders(myCache)==[]
+    assert myCache.load('key') is not None
+
+
+def test_vanished_entry(prepared,tmp_path):
+    myCache=opticsCache(str(tmp_path))
+    myCache.store('key',prepared)
+    # Evicted by another process while reading
+    shutil.rmtree(os.path.join(myCache._path('key'),'B2_Survey'))
+    assert myCache.load('key') is None
+    myCache.evict()
+    shutil.rmtree(myCache._path('key'))
+    assert myCache.load('key') is None
+    assert len(myCache.entries())==0
+
+
+def test_key_options(tmp_path):
+    fileName=str(tmp_path/'twiss.tfs')
+    with open(fileName,'w') as myFile:
+        myFile.write('* NAME S\n')
+    assert opticsCache.keyFromFiles([fileName])==opticsCache.keyFromFiles([fileName],{})
+    assert (opticsCache.keyFromFiles([fileName],{'filterRows':True})!=
+            opticsCache.keyFromFiles([fileName],{'filterRows':False}))
+    assert (opticsCache.keyFromFiles([fileName],{'columns':{'Twiss':['NAME','S']}})!=
+            opticsCache.keyFromFiles([fileName],{'columns':None}))
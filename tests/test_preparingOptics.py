@@ -0,0 +1,168 @@
+"""
+Regression test of preparingOpticsFromMADX against the row-by-row loops of its first implementation, on the
+synthetic optics of the benchmarks (see benchmarks/syntheticInputs.py).
+
+===== EXAMPLE =====
+python -m pytest tests
+"""
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+myPath=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(myPath,'..','BeamBeamTools'))
+sys.path.insert(0,os.path.join(myPath,'..','benchmarks'))
+
+import syntheticInputs
+from optics import dictOpticsFromMADX, preparingOpticsFromMADX
+
+
+def _loopFilter(opticsDF,beam):
+    return ((opticsDF['NAME'].str.contains(r'^MB\..*'+beam+'$')) |
+            (opticsDF['NAME'].str.contains(r'^E\.')) |
+            (opticsDF['NAME'].str.contains('BBLR')) |
+            (opticsDF['NAME'].str.contains(r'^S\.')))
+
+
+def _loopMirrored(opticsDF):
+    mirrored=opticsDF.copy()
+    mirrored.index=mirrored.index-opticsDF.index[-1]
+    mirrored['S']=mirrored['S']-opticsDF.index[-1]
+    return pd.concat([mirrored,opticsDF])
+
+
+def _loopSurvey(B1_survey,B2_survey):
+    B1_survey_filter=B1_survey[_loopFilter(B1_survey,'B1')].copy()
+    B2_survey_filter=B2_survey[_loopFilter(B2_survey,'B2')].copy()
+    meanTheta=(B1_survey_filter['THETA'].values+B2_survey_filter['THETA'].values)/2.
+    for mySurvey,sign in [(B1_survey_filter,1.),(B2_survey_filter,-1.)]:
+        DeltaX=sign*(B2_survey_filter['X'].values-B1_survey_filter['X'].values)
+        DeltaY=sign*(B2_survey_filter['Z'].values-B1_survey_filter['Z'].values)
+        mySurvey['myDeltaZ']=np.sin(meanTheta)*DeltaX+np.cos(meanTheta)*DeltaY
+        mySurvey['myDeltaX']=np.cos(meanTheta)*DeltaX-np.sin(meanTheta)*DeltaY
+    return B1_survey_filter,B2_survey_filter
+
+
+def _loopPreparingOptics(MADX_DICT):
+    """
+    It returns the prepared optics as computed by the loops of the first implementation of preparingOpticsFromMADX,
+    including its two bugs: the B2 IP1 elements use the B1 twiss and 'Delta MUY' is MUX on the right of IP1.
+    """
+    B1_survey_filter,B2_survey_filter=_loopSurvey(_loopMirrored(MADX_DICT.B1.Survey),
+                                                  _loopMirrored(MADX_DICT.B2.Survey))
+    twiss_filter={}
+    for beam in ['B1','B2']:
+        myTwiss=_loopMirrored(MADX_DICT[beam].Twiss)
+        muX_IP1L=myTwiss[myTwiss['NAME']=='IP1.L1']['MUX'].values[0]
+        muY_IP1L=myTwiss[myTwiss['NAME']=='IP1.L1']['MUY'].values[0]
+        muX_IP5=myTwiss[myTwiss['NAME']=='IP5']['MUX'].values[0]
+        muY_IP5=myTwiss[myTwiss['NAME']=='IP5']['MUY'].values[0]
+        myFilter=myTwiss[_loopFilter(myTwiss,beam)].copy()
+        myFilter['Delta MUX']=0.
+        myFilter['Delta MUY']=0.
+        myFilter['Ideal MUX']=0.
+        myFilter['Ideal MUY']=0.
+        IP1_twiss=twiss_filter['B1'] if beam=='B2' else myFilter
+        for i in myFilter.index:
+            if 'IP1_L' in myFilter.loc[i,'NAME']:
+                myFilter.loc[i,'Delta MUX']=-(muX_IP1L-IP1_twiss.loc[i,'MUX'])
+                myFilter.loc[i,'Ideal MUX']=-0.25
+                myFilter.loc[i,'Delta MUY']=-(muY_IP1L-IP1_twiss.loc[i,'MUY'])
+                myFilter.loc[i,'Ideal MUY']=-0.25
+            if 'IP1_R' in myFilter.loc[i,'NAME']:
+                myFilter.loc[i,'Delta MUX']=IP1_twiss.loc[i,'MUX']
+                myFilter.loc[i,'Ideal MUX']=0.25
+                myFilter.loc[i,'Delta MUY']=IP1_twiss.loc[i,'MUX']
+                myFilter.loc[i,'Ideal MUY']=0.25
+            if 'IP5_L' in myFilter.loc[i,'NAME']:
+                myFilter.loc[i,'Delta MUX']=myFilter.loc[i,'MUX']-muX_IP5
+                myFilter.loc[i,'Ideal MUX']=-0.25
+                myFilter.loc[i,'Delta MUY']=myFilter.loc[i,'MUY']-muY_IP5
+                myFilter.loc[i,'Ideal MUY']=-0.25
+            if 'IP5_R' in myFilter.loc[i,'NAME']:
+                myFilter.loc[i,'Delta MUX']=myFilter.loc[i,'MUX']-muX_IP5
+                myFilter.loc[i,'Ideal MUX']=0.25
+                myFilter.loc[i,'Delta MUY']=myFilter.loc[i,'MUY']-muY_IP5
+                myFilter.loc[i,'Ideal MUY']=0.25
+        twiss_filter[beam]=myFilter
+    B1_twiss_filter=twiss_filter['B1']
+    B2_twiss_filter=twiss_filter['B2']
+    B1_twiss_filter['myDeltaX']=B2_twiss_filter['X'].values-B1_twiss_filter['X'].values
+    B1_twiss_filter['myDeltaZ']=B2_twiss_filter['Y'].values-B1_twiss_filter['Y'].values
+    B2_twiss_filter['myDeltaX']=B1_twiss_filter['X'].values-B2_twiss_filter['X'].values
+    B2_twiss_filter['myDeltaZ']=B1_twiss_filter['Y'].values-B2_twiss_filter['Y'].values
+    B1_twiss_filter['B2-B1 complex distance']=(B1_twiss_filter['myDeltaX']+B1_survey_filter['myDeltaX']) \
+                                             +1j*(B1_twiss_filter['myDeltaZ']+B1_survey_filter['myDeltaZ'])
+    B2_twiss_filter['B1-B2 complex distance']=(B2_twiss_filter['myDeltaX']+B2_survey_filter['myDeltaX']) \
+                                             +1j*(B2_twiss_filter['myDeltaZ']+B2_survey_filter['myDeltaZ'])
+    return {'B1':{'Twiss':B1_twiss_filter,'Survey':B1_survey_filter},
+            'B2':{'Twiss':B2_twiss_filter,'Survey':B1_survey_filter}}
+
+
+@pytest.fixture(scope='module')
+def MADX_DICT():
+    B1_twiss,B2_twiss,B1_survey,B2_survey=syntheticInputs.MADX(numberOfLR=20,numberOfElements=2000)
+    # Different phase advances of B1 and B2, to check that the B2 IP1 elements use the B2 twiss
+    B2_twiss['MUX']=B2_twiss['MUX']+0.02*np.sin(B2_twiss['S'].values/37.)
+    B2_twiss['MUY']=B2_twiss['MUY']+0.02*np.cos(B2_twiss['S'].values/41.)
+    return dictOpticsFromMADX(B1_twiss,B2_twiss,B1_survey,B2_survey)
+
+
+@pytest.fixture(scope='module')
+def prepared(MADX_DICT):
+    return preparingOpticsFromMADX(MADX_DICT),_loopPreparingOptics(MADX_DICT)
+
+
+def _side(twiss,key):
+    return twiss['NAME'].str.contains(key).values
+
+
+def test_survey(prepared):
+    myOptics,reference=prepared
+    for beam in ['B1','B2']:
+        pd.testing.assert_frame_equal(myOptics[beam].Survey,reference[beam]['Survey'])
+
+
+@pytest.mark.parametrize('beam',['B1','B2'])
+def test_twiss(prepared,beam):
+    myOptics,reference=prepared
+    myTwiss=myOptics[beam].Twiss
+    referenceTwiss=reference[beam]['Twiss']
+    assert list(myTwiss.columns)==list(referenceTwiss.columns)
+    pd.testing.assert_index_equal(myTwiss.index,referenceTwiss.index)
+    # The IP1 elements differ by the fixes only (see test_IP1_right_MUY and test_B2_IP1)
+    if beam=='B1':
+        isFixed={'Delta MUY':_side(myTwiss,'IP1_R')}
+    else:
+        isFixed={'Delta MUX':_side(myTwiss,'IP1_'),'Delta MUY':_side(myTwiss,'IP1_')}
+    for column in myTwiss.columns:
+        myFilter=~isFixed.get(column,np.zeros(len(myTwiss),dtype=bool))
+        pd.testing.assert_series_equal(myTwiss[column][myFilter],referenceTwiss[column][myFilter])
+
+
+def test_IP1_right_MUY(prepared):
+    myOptics,reference=prepared
+    myTwiss=myOptics.B1.Twiss
+    myFilter=_side(myTwiss,'IP1_R')
+    assert myFilter.any()
+    np.testing.assert_array_equal(myTwiss['Delta MUY'].values[myFilter],myTwiss['MUY'].values[myFilter])
+    assert not np.array_equal(myTwiss['Delta MUY'].values[myFilter],
+                              reference['B1']['Twiss']['Delta MUY'].values[myFilter])
+
+
+def test_B2_IP1(prepared,MADX_DICT):
+    myOptics,reference=prepared
+    myTwiss=myOptics.B2.Twiss
+    myRow=MADX_DICT.B2.Twiss['NAME']=='IP1.L1'
+    for plane in ['X','Y']:
+        muIP1L=MADX_DICT.B2.Twiss['MU'+plane][myRow].values[0]
+        myLeft=_side(myTwiss,'IP1_L')
+        myRight=_side(myTwiss,'IP1_R')
+        assert myLeft.any() and myRight.any()
+        np.testing.assert_allclose(myTwiss['Delta MU'+plane].values[myLeft],
+                                   myTwiss['MU'+plane].values[myLeft]-muIP1L,rtol=0,atol=1e-12)
+        np.testing.assert_array_equal(myTwiss['Delta MU'+plane].values[myRight],myTwiss['MU'+plane].values[myRight])
+        assert not np.allclose(myTwiss['Delta MU'+plane].values[myLeft|myRight],
+                               reference['B2']['Twiss']['Delta MU'+plane].values[myLeft|myRight])
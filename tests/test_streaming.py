@@ -0,0 +1,51 @@
+"""
+Test of the peak memory of streamBBES (see streaming.py) on a time series of synthetic filling schemes: the results
+already consumed must be freed.
+
+===== EXAMPLE =====
+python -m pytest tests
+"""
+import os
+import sys
+import gc
+import tracemalloc
+import pytest
+
+myPath=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(myPath,'..','BeamBeamTools'))
+sys.path.insert(0,os.path.join(myPath,'..','benchmarks'))
+
+import syntheticInputs
+from BBES import computeBBMatrix
+from streaming import streamBBES, _nested_from_scratch
+
+
+def _tracedCall(function,*args):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start=tracemalloc.get_traced_memory()[0]
+        result=function(*args)
+        current,peak=tracemalloc.get_traced_memory()
+        return result,current-start,peak-start
+    finally:
+        tracemalloc.stop()
+
+
+def _consume(stream):
+    for timestamp,results in stream:
+        pass
+
+
+@pytest.mark.parametrize('incremental',[False,True])
+def test_stream_memory(incremental):
+    BBMatrixLHC=computeBBMatrix(20)
+    B1_fillingScheme=syntheticInputs.fillingScheme(300,'standard')
+    B2_fillingScheme=syntheticInputs.fillingScheme(300,'standard',firstSlot=5)
+    # A few bunches added and removed between the snapshots
+    snapshots=[(i,B1_fillingScheme[:len(B1_fillingScheme)-i%3],B2_fillingScheme) for i in range(20)]
+    results,resultMemory,_=_tracedCall(_nested_from_scratch,BBMatrixLHC,B1_fillingScheme,B2_fillingScheme,None,None)
+    del results
+    _,_,peak=_tracedCall(_consume,streamBBES(snapshots,BBMatrixLHC,incremental=incremental))
+    # The consumed result and the one being computed
+    assert peak<3*resultMemory